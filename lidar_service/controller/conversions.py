@@ -0,0 +1,119 @@
+"""
+Cached CSV conversions: a csv `LidarFile` converted from an HDF5 one keeps a
+`CsvConversion` of what it holds, so converting it again appends only the
+sessions (or rows of a session still being recorded) the source gained, and
+is skipped altogether while the source file is unchanged on disk.
+
+A `.csv.gz` is kept up to date the same way, its new rows are appended as
+new gzip members. Parquet, Arrow IPC and `.npy` exports are kept the same way but cannot be
+appended to, they are written again in full when the source changed.
+
+Batch exports of several files or days into one csv are selected here too.
+"""
+import os
+from datetime import datetime
+
+from lidar_export import EXPORT_FORMATS, GzipMembers, convert_hdf5, update_csv
+
+from .models import CsvConversion, LidarFile, LidarSession
+
+
+def source_stamp(lidar_file):
+    """
+    Returns `(mtime_ns, size)` of a file, which change with every write to it.
+    """
+    stat = os.stat(lidar_file.file.path)
+    return stat.st_mtime_ns, stat.st_size
+
+
+def is_current(conversion):
+    """
+    Whether the CSV of `conversion` holds everything its source has.
+    """
+    try:
+        stamp = source_stamp(conversion.source)
+    except OSError:
+        return False
+    return (conversion.source_mtime_ns, conversion.source_size) == stamp and os.path.exists(conversion.csv_file.file.path)
+
+
+def export_format(filename):
+    """
+    Returns the `lidar_export.EXPORT_FORMATS` format of an export from its extension, `None` when unknown.
+    A gzip compressed csv (`.csv.gz`) is a csv.
+    """
+    if filename.endswith('.gz'):
+        filename = filename[:-len('.gz')]
+    for format, extension in EXPORT_FORMATS.items():
+        if filename.endswith(extension):
+            return format
+    return None
+
+
+def update_conversion(conversion, progress=None):
+    """
+    Brings the export of `conversion` up to date with its source.
+
+    :return: The number of rows converted.
+    """
+    # taken first, a write during the conversion makes the next request convert again
+    mtime_ns, size = source_stamp(conversion.source)
+    format = export_format(conversion.csv_file.filename) or 'csv'
+
+    if format == 'csv':
+        with open(conversion.csv_file.file.path, 'r+b') as csv_file:
+            if conversion.csv_file.filename.endswith('.gz'):
+                csv_file = GzipMembers(csv_file)
+            sessions, rows = update_csv(conversion.source.file.path, csv_file, conversion.sessions, progress=progress)
+            csv_file.flush()
+        total = sum(session['rows'] for session in sessions)
+    else:
+        with open(conversion.csv_file.file.path, 'wb') as out_file:
+            rows = convert_hdf5(conversion.source.file.path, out_file, format, progress=progress)
+        sessions, total = [], rows
+
+    CsvConversion.objects.filter(pk=conversion.pk).update(
+        sessions=sessions, rows=total, source_mtime_ns=mtime_ns, source_size=size,
+    )
+    return rows
+
+
+def parse_day(value):
+    """
+    Returns the name of the day group of `value` (`YYYY-MM-DD` or `YYYY_MM_DD`), `None` for an empty value.
+
+    :raises ValueError: For anything else.
+    """
+    if not value:
+        return None
+    try:
+        return datetime.strptime(value.replace('-', '_'), '%Y_%m_%d').strftime('%Y_%m_%d')
+    except ValueError:
+        raise ValueError(f"Invalid day '{value}', expected YYYY-MM-DD")
+
+
+def export_sources(filenames=None, first_day=None, last_day=None):
+    """
+    Returns the HDF5 `LidarFile`s of a batch export, in the order their sessions are exported.
+
+    :param filenames: The files, in this order. When left out, every file the
+        session index knows sessions of between `first_day` and `last_day`, oldest first.
+    :raises LidarFile.DoesNotExist: When one of `filenames` does not exist.
+    :raises ValueError: When one of `filenames` is not an HDF5 file.
+    """
+    if filenames:
+        files = {lidar_file.filename: lidar_file for lidar_file in LidarFile.objects.filter(filename__in=filenames)}
+        missing = [filename for filename in filenames if filename not in files]
+        if missing:
+            raise LidarFile.DoesNotExist(f"File not found: {', '.join(missing)}")
+        not_hdf5 = [filename for filename in filenames if not filename.endswith('.h5')]
+        if not_hdf5:
+            raise ValueError(f"Not HDF5 files: {', '.join(not_hdf5)}")
+        return [files[filename] for filename in dict.fromkeys(filenames)]
+
+    sessions = LidarSession.objects.all()
+    if first_day:
+        sessions = sessions.filter(day__gte=first_day)
+    if last_day:
+        sessions = sessions.filter(day__lte=last_day)
+    return list(LidarFile.objects.filter(pk__in=sessions.values('file')).order_by('uploaded_at', 'pk'))
@@ -0,0 +1,208 @@
+import os
+import re
+import zlib
+
+from django.http import FileResponse, HttpResponse, StreamingHttpResponse
+from django.utils.http import content_disposition_header, http_date, parse_http_date_safe, quote_etag
+
+# bytes handed to the server per read, the response never holds more than this
+DOWNLOAD_BLOCK_SIZE = 256 * 1024
+
+RANGE_RE = re.compile(r'^bytes=(\d*)-(\d*)$')
+
+# levels of the on-the-fly compression: the fastest gzip level, it shrinks a
+# csv almost as much as the default one at several times the speed, so even
+# the Pi compresses faster than the link it sends over, and zstd's default
+ENCODING_LEVELS = {'zstd': 3, 'gzip': 1}
+
+
+class FileRange:
+    """
+    Read-only view of `length` bytes of `file` starting at `start`.
+
+    It deliberately has no `fileno`, so WSGI servers stream it through `read`
+    instead of sendfile-ing to the end of the underlying file.
+    """
+
+    def __init__(self, file, start, length):
+        self.file = file
+        self.remaining = length
+        self.file.seek(start)
+
+    def read(self, size=-1):
+        if size < 0 or size > self.remaining:
+            size = self.remaining
+        data = self.file.read(size)
+        self.remaining -= len(data)
+        return data
+
+    def close(self):
+        self.file.close()
+
+
+def parse_range(header, size):
+    """
+    Parses a single `bytes=` range against a file of `size` bytes.
+
+    :return: `(start, end)` with an inclusive end, `None` when the header
+        should be ignored (missing, malformed or multipart) and the whole
+        file sent, or `False` when the range cannot be satisfied.
+    """
+    if not header:
+        return None
+    match = RANGE_RE.match(header.strip())
+    if not match:
+        return None
+
+    first, last = match.groups()
+    if not first and not last:
+        return None
+    if not first:
+        # suffix range, the last N bytes
+        length = int(last)
+        if length == 0 or size == 0:
+            return False
+        return max(size - length, 0), size - 1
+
+    start = int(first)
+    end = int(last) if last else size - 1
+    if start >= size or end < start:
+        return False
+    return start, min(end, size - 1)
+
+
+def file_etag(stat, encoding=None):
+    suffix = f'-{encoding}' if encoding else ''
+    return quote_etag(f'{stat.st_mtime_ns:x}-{stat.st_size:x}{suffix}')
+
+
+def available_encodings():
+    """
+    Content codings the server can compress with, preferred first; zstd needs the `zstandard` package.
+    """
+    try:
+        import zstandard  # noqa: F401
+    except ImportError:
+        return ['gzip']
+    return ['zstd', 'gzip']
+
+
+def negotiate_encoding(header):
+    """
+    Picks the content coding of a response from an `Accept-Encoding` header.
+
+    :return: The available coding with the highest quality, the server's
+        preference breaking ties, or `None` to send the file as it is.
+    """
+    if not header:
+        return None
+    qualities = {}
+    for item in header.split(','):
+        coding, _, params = item.strip().partition(';')
+        quality = 1.0
+        for param in params.split(';'):
+            name, _, value = param.strip().partition('=')
+            if name == 'q':
+                try:
+                    quality = float(value)
+                except ValueError:
+                    quality = 0.0
+        qualities[coding.strip().lower()] = quality
+
+    best, best_quality = None, 0.0
+    for coding in available_encodings():
+        quality = qualities.get(coding, qualities.get('*', 0.0))
+        if quality > best_quality:
+            best, best_quality = coding, quality
+    return best
+
+
+def _compressor(encoding):
+    if encoding == 'zstd':
+        import zstandard
+        return zstandard.ZstdCompressor(level=ENCODING_LEVELS['zstd']).compressobj()
+    return zlib.compressobj(ENCODING_LEVELS['gzip'], zlib.DEFLATED, 31)
+
+
+def iter_compressed(path, encoding):
+    """
+    Yields the file at `path` compressed with `encoding`, a `DOWNLOAD_BLOCK_SIZE` block at a time.
+    """
+    compressor = _compressor(encoding)
+    with open(path, 'rb') as f:
+        while block := f.read(DOWNLOAD_BLOCK_SIZE):
+            data = compressor.compress(block)
+            if data:
+                yield data
+    yield compressor.flush()
+
+
+def file_download_response(request, path, content_type, filename=None, compress=False):
+    """
+    Streams the file at `path` as an attachment, honouring `Range` requests.
+
+    Whole-file responses keep the real file object so the server can use
+    sendfile, partial ones (206) stream the requested window in blocks.
+    Either way memory use is bounded by `DOWNLOAD_BLOCK_SIZE`.
+
+    :param compress: Whether the file is worth compressing (text). It is then
+        compressed on the fly with the best coding the client accepts, except
+        for `Range` requests, which resume the file as it is on disk.
+    """
+    stat = os.stat(path)
+    etag = file_etag(stat)
+    last_modified = http_date(stat.st_mtime)
+    filename = filename or os.path.basename(path)
+
+    encoding = negotiate_encoding(request.headers.get('Accept-Encoding')) if compress else None
+    if encoding and not request.headers.get('Range'):
+        response = StreamingHttpResponse(iter_compressed(path, encoding), content_type=content_type)
+        response['Content-Encoding'] = encoding
+        response['Content-Disposition'] = content_disposition_header(True, filename)
+        response['Vary'] = 'Accept-Encoding'
+        response['ETag'] = file_etag(stat, encoding)
+        response['Last-Modified'] = last_modified
+        return response
+
+    byte_range = parse_range(request.headers.get('Range'), stat.st_size)
+
+    # a resume against a file that changed since must restart from scratch
+    if_range = request.headers.get('If-Range')
+    if byte_range and if_range and if_range != etag:
+        if_range_date = parse_http_date_safe(if_range)
+        if if_range_date is None or int(stat.st_mtime) > if_range_date:
+            byte_range = None
+
+    if byte_range is False:
+        response = HttpResponse(status=416)
+        response['Content-Range'] = f'bytes */{stat.st_size}'
+        response['Accept-Ranges'] = 'bytes'
+        return response
+
+    f = open(path, 'rb')
+    if byte_range:
+        start, end = byte_range
+        response = FileResponse(
+            FileRange(f, start, end - start + 1),
+            status=206,
+            content_type=content_type,
+            as_attachment=True,
+            filename=filename,
+        )
+        response['Content-Range'] = f'bytes {start}-{end}/{stat.st_size}'
+        response['Content-Length'] = end - start + 1
+    else:
+        response = FileResponse(
+            f,
+            content_type=content_type,
+            as_attachment=True,
+            filename=filename,
+        )
+
+    response.block_size = DOWNLOAD_BLOCK_SIZE
+    response['Accept-Ranges'] = 'bytes'
+    response['ETag'] = etag
+    response['Last-Modified'] = last_modified
+    if compress:
+        response['Vary'] = 'Accept-Encoding'
+    return response
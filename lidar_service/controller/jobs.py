@@ -0,0 +1,247 @@
+import fcntl
+import os
+import socket
+import threading
+import time
+import traceback
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import close_old_connections
+from django.utils import timezone
+
+from lidar_control import LIDAR_LOCK_DIR
+from lidar_metrics import gauge, histogram
+
+from .models import Job
+
+# seconds an idle worker sleeps before looking for queued jobs again, new
+# submissions from the process running the jobs wake the workers immediately;
+# also how often a process waiting for the runner lock tries to take it
+POLL_INTERVAL = 5.0
+
+# seconds between two heartbeats of the running jobs of the runner, a running
+# job whose heartbeat is older than STALE_AFTER has lost its runner
+HEARTBEAT_INTERVAL = 10.0
+STALE_AFTER = 60.0
+
+# minimum seconds between two progress writes of the same job
+PROGRESS_INTERVAL = 0.5
+
+_handlers = {}
+_runner = None
+_runner_lock = threading.Lock()
+_wakeup = threading.Event()
+# ids of the jobs the workers of this process are running, their heartbeat is kept
+_running = set()
+
+JOB_BUCKETS = (0.1, 0.5, 1.0, 5.0, 10.0, 30.0, 60.0, 300.0, 900.0, 3600.0)
+JOB_WAIT_SECONDS = histogram(
+    'lidar_job_wait_seconds', 'Seconds jobs stayed queued before a worker took them', ('kind',), JOB_BUCKETS
+)
+JOB_SECONDS = histogram('lidar_job_seconds', 'Run time of jobs', ('kind', 'state'), JOB_BUCKETS)
+JOBS_RUNNING = gauge('lidar_jobs_running', 'Jobs being run by the workers of this process')
+
+
+def _owner():
+    return f'{socket.gethostname()}:{os.getpid()}'
+
+
+def register(kind):
+    """
+    Registers the decorated function as the handler of jobs of `kind`.
+
+    Handlers are called as `handler(params, progress)` where `progress(processed, total)`
+    reports how far the job got; their return value is stored as the job result.
+    """
+    def decorator(func):
+        _handlers[kind] = func
+        return func
+    return decorator
+
+
+def submit(kind, params):
+    """
+    Queues a job, run by the workers of whichever process holds the runner
+    lock, see `start_workers`.
+
+    :return: The created `Job`.
+    """
+    if kind not in _handlers:
+        raise ValueError(f'No handler registered for job kind {kind}')
+
+    job = Job.objects.create(kind=kind, params=params)
+    _wakeup.set()
+    return job
+
+
+def start_workers():
+    """
+    Starts the job runner of this process, once.
+
+    Only one process of the system runs jobs: the runner thread waits for the
+    runner lock file in `LIDAR_LOCK_DIR`, held until the process exits, then
+    starts the worker threads, again should one die, keeps the heartbeat of
+    the jobs they run and fails the jobs a dead runner left running. Until
+    then the process only queues jobs; when the runner dies another process
+    waiting takes over.
+
+    The pool size comes from `settings.LIDAR_JOB_WORKERS` and is the cap on
+    concurrently running jobs, it should leave a core for the capture thread.
+    Started by the web entry points (wsgi, asgi) when `settings.LIDAR_JOBS_IN_WEB`
+    is set and by `manage.py run_jobs`.
+
+    :return: The runner thread.
+    """
+    global _runner
+    with _runner_lock:
+        if _runner is None:
+            _runner = threading.Thread(target=_run_jobs, name='lidar-job-runner', daemon=True)
+            _runner.start()
+        return _runner
+
+
+def _take_runner_lock():
+    """
+    Waits for the runner lock file and returns it, see `start_workers`.
+    """
+    lock = open(os.path.join(LIDAR_LOCK_DIR, 'lidar-jobs.lock'), 'a+')
+    while True:
+        try:
+            fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            time.sleep(POLL_INTERVAL)
+            continue
+        lock.truncate(0)
+        lock.write(f'{os.getpid()}\n')
+        lock.flush()
+        return lock
+
+
+def _owner_alive(owner):
+    """
+    Whether the process `host:pid` still runs, `None` when it is on another host.
+    """
+    host, _, pid = owner.rpartition(':')
+    if host != socket.gethostname() or not pid.isdigit():
+        return None
+    try:
+        os.kill(int(pid), 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def fail_orphaned_jobs():
+    """
+    Fails the running jobs whose runner is gone: its process exited, or it
+    has not renewed their heartbeat for `STALE_AFTER` seconds.
+
+    :return: The number of failed jobs.
+    """
+    stale = timezone.now() - timedelta(seconds=STALE_AFTER)
+    orphaned = [
+        job.pk for job in Job.objects.filter(state=Job.RUNNING).only('owner', 'heartbeat_at')
+        if _owner_alive(job.owner) is False or job.heartbeat_at is None or job.heartbeat_at < stale
+    ]
+    if not orphaned:
+        return 0
+    return Job.objects.filter(pk__in=orphaned, state=Job.RUNNING).update(
+        state=Job.FAILED, error='Interrupted by a server restart', finished_at=timezone.now()
+    )
+
+
+def _run_jobs():
+    # the lock file stays open, so locked, as long as the process runs
+    lock = _take_runner_lock()  # noqa: F841
+    owner = _owner()
+    workers = [None] * getattr(settings, 'LIDAR_JOB_WORKERS', 1)
+
+    while True:
+        close_old_connections()
+        try:
+            Job.objects.filter(pk__in=list(_running), state=Job.RUNNING).update(heartbeat_at=timezone.now())
+            fail_orphaned_jobs()
+        except Exception:
+            traceback.print_exc()
+
+        # started on the first round, started again should one die
+        for i, worker in enumerate(workers):
+            if worker is None or not worker.is_alive():
+                if worker is not None:
+                    print(f'Job worker {i} died, starting it again')
+                workers[i] = threading.Thread(target=_work, args=(owner,), name=f'lidar-job-worker-{i}', daemon=True)
+                workers[i].start()
+        time.sleep(HEARTBEAT_INTERVAL)
+
+
+def _claim(owner):
+    """
+    Marks the oldest queued job as running by `owner` and returns it, or `None`.
+
+    The conditional update makes the claim atomic across threads and processes
+    sharing the database.
+    """
+    for job in Job.objects.filter(state=Job.QUEUED).order_by('created_at', 'id')[:5]:
+        now = timezone.now()
+        claimed = Job.objects.filter(pk=job.pk, state=Job.QUEUED).update(
+            state=Job.RUNNING, started_at=now, owner=owner, heartbeat_at=now
+        )
+        if claimed:
+            job.refresh_from_db()
+            return job
+    return None
+
+
+def _work(owner):
+    while True:
+        close_old_connections()
+        try:
+            job = _claim(owner)
+            if job is not None:
+                _run(job)
+                continue
+        except Exception:
+            # e.g. the database is locked, a job left running without a worker goes stale
+            traceback.print_exc()
+        _wakeup.wait(POLL_INTERVAL)
+        _wakeup.clear()
+
+
+def _run(job):
+    last_update = 0.0
+
+    def progress(processed, total=None):
+        nonlocal last_update
+        job.processed = processed
+        if total is not None:
+            job.total = total
+
+        now = time.monotonic()
+        if now - last_update < PROGRESS_INTERVAL:
+            return
+        last_update = now
+        Job.objects.filter(pk=job.pk).update(processed=job.processed, total=job.total)
+
+    JOB_WAIT_SECONDS.labels(job.kind).observe((job.started_at - job.created_at).total_seconds())
+    JOBS_RUNNING.inc()
+    _running.add(job.pk)
+    started = time.perf_counter()
+    try:
+        try:
+            job.result = _handlers[job.kind](job.params, progress)
+            job.state = Job.SUCCEEDED
+        except Exception as e:
+            traceback.print_exc()
+            job.state = Job.FAILED
+            job.error = str(e)
+        finally:
+            JOBS_RUNNING.dec()
+        JOB_SECONDS.labels(job.kind, job.state).observe(time.perf_counter() - started)
+
+        job.finished_at = timezone.now()
+        job.save(update_fields=['state', 'result', 'error', 'processed', 'total', 'finished_at'])
+    finally:
+        _running.discard(job.pk)
@@ -0,0 +1,50 @@
+import os
+
+from django.core.management.base import BaseCommand
+
+from controller.models import LidarFile
+from controller.sessions import index_file
+from lidar_lod import LOD_LEVELS, available_levels, build_lod
+from lidar_query import session_names
+from lidar_storage import open_file
+
+
+class Command(BaseCommand):
+    help = f'Builds the {", ".join(LOD_LEVELS)} min/mean/max overviews of recorded sessions.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('filenames', nargs='*', help='Files to process, every HDF5 file when left out')
+        parser.add_argument('--session', help='Only this day/session')
+        parser.add_argument('--force', action='store_true', help='Rebuild sessions that already have overviews')
+
+    def handle(self, *args, **options):
+        files = LidarFile.objects.filter(filename__endswith='.h5').order_by('pk')
+        if options['filenames']:
+            files = files.filter(filename__in=options['filenames'])
+
+        for lidar_file in files:
+            if not os.path.exists(lidar_file.file.path):
+                self.stderr.write(f'{lidar_file.filename}: missing on disk, skipped')
+                continue
+            try:
+                # fails while the file is being recorded, the capture holds it
+                with open_file(lidar_file.file.path, 'a') as f:
+                    for session in session_names(f):
+                        if options['session'] and session != options['session']:
+                            continue
+                        if available_levels(f[session]) and not options['force']:
+                            continue
+                        try:
+                            rows = build_lod(f[session])
+                        except ValueError as e:
+                            self.stderr.write(f'{lidar_file.filename} {session}: {e}')
+                            continue
+                        built = ', '.join(f'{count} {name} rows' for name, count in rows.items())
+                        self.stdout.write(f'{lidar_file.filename} {session}: {built}')
+            except OSError as e:
+                self.stderr.write(f'{lidar_file.filename}: {e}')
+                continue
+            # the overviews count in the sessions' bytes
+            index_file(lidar_file)
+
+        self.stdout.write(self.style.SUCCESS('Done'))
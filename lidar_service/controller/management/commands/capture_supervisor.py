@@ -0,0 +1,23 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from lidar_control import CaptureError
+
+from controller.supervisor import serve
+
+
+class Command(BaseCommand):
+    help = 'Runs the LiDAR captures of every web worker, see controller.supervisor.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--address', default=None,
+                            help='Unix socket path or host:port to listen on, LIDAR_SUPERVISOR by default')
+
+    def handle(self, *args, **options):
+        address = options['address'] or settings.LIDAR_SUPERVISOR
+        if not address:
+            raise CommandError('Set LIDAR_SUPERVISOR or pass --address')
+        try:
+            serve(address, settings.LIDAR_SUPERVISOR_KEY)
+        except (CaptureError, ValueError) as e:
+            raise CommandError(str(e))
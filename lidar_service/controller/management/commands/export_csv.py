@@ -0,0 +1,53 @@
+import os
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from lidar_export import GZIP_LEVEL, export_csv, plan_export
+
+from controller.conversions import export_sources, parse_day
+from controller.models import LidarFile
+
+
+class Command(BaseCommand):
+    help = 'Exports the sessions of several HDF5 lidar files, or of a range of days, into one csv file.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('filenames', nargs='*',
+                            help='Files exported in this order, every file with sessions in the days when left out')
+        parser.add_argument('--from', dest='start_day', default=None, help='First day exported, YYYY-MM-DD')
+        parser.add_argument('--to', dest='end_day', default=None, help='Last day exported, YYYY-MM-DD')
+        parser.add_argument('--output', required=True, help='Path of the csv file written, gzip compressed when it ends in .gz')
+        parser.add_argument('--workers', type=int, default=settings.LIDAR_EXPORT_WORKERS,
+                            help='Conversion processes, LIDAR_EXPORT_WORKERS by default')
+
+    def handle(self, *args, **options):
+        try:
+            first_day = parse_day(options['start_day'])
+            last_day = parse_day(options['end_day'])
+            if not options['filenames'] and not (first_day or last_day):
+                raise CommandError('Pass filenames or --from/--to')
+            files = export_sources(options['filenames'], first_day, last_day)
+        except (ValueError, LidarFile.DoesNotExist) as e:
+            raise CommandError(str(e))
+        if not files:
+            raise CommandError('No sessions recorded in these days')
+
+        parts = plan_export([lidar_file.file.path for lidar_file in files], first_day, last_day)
+        output = os.path.abspath(options['output'])
+
+        def progress(rows, total):
+            self.stdout.write(f'{rows:,} / {total:,} rows', ending='\r')
+
+        started = time.perf_counter()
+        with open(output, 'wb') as csvfile:
+            rows = export_csv(parts, csvfile, workers=options['workers'], work_dir=os.path.dirname(output),
+                              progress=progress, gzip_level=GZIP_LEVEL if output.endswith('.gz') else None)
+        elapsed = time.perf_counter() - started
+        self.stdout.write('')
+
+        self.stdout.write(self.style.SUCCESS(
+            f'Exported {rows:,} rows of {len(files)} files to {output} in {elapsed:.1f} s '
+            f'({rows / elapsed if elapsed else 0:,.0f} rows/s, {options["workers"]} workers)'
+        ))
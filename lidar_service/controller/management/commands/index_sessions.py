@@ -0,0 +1,33 @@
+import os
+
+from django.core.management.base import BaseCommand
+
+from controller.models import LidarFile
+from controller.sessions import index_file
+
+
+class Command(BaseCommand):
+    help = 'Rebuilds the session index of HDF5 lidar files from the files themselves.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('filenames', nargs='*', help='Files to index, every HDF5 file when left out')
+
+    def handle(self, *args, **options):
+        files = LidarFile.objects.filter(filename__endswith='.h5').order_by('pk')
+        if options['filenames']:
+            files = files.filter(filename__in=options['filenames'])
+
+        indexed = 0
+        for lidar_file in files:
+            if not os.path.exists(lidar_file.file.path):
+                self.stderr.write(f'{lidar_file.filename}: missing on disk, skipped')
+                continue
+            try:
+                count = index_file(lidar_file)
+            except OSError as e:
+                self.stderr.write(f'{lidar_file.filename}: {e}')
+                continue
+            indexed += count
+            self.stdout.write(f'{lidar_file.filename}: {count} sessions')
+
+        self.stdout.write(self.style.SUCCESS(f'Indexed {indexed} sessions'))
@@ -0,0 +1,153 @@
+import argparse
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from lidar_control import is_being_written, writing_file
+from lidar_repack import REPACK_CHUNK, REPACK_OPTIONS, repack_file
+from lidar_storage import COMPRESSIONS, storage_options
+
+from controller.models import CsvConversion, LidarFile
+from controller.sessions import index_file
+
+
+def _stamp(path):
+    stat = os.stat(path)
+    return stat.st_mtime_ns, stat.st_size
+
+
+def _fsync(path):
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+class Command(BaseCommand):
+    help = ('Rewrites HDF5 lidar files with contiguous, chunked and compressed sessions, '
+            'optionally merging small sessions, and swaps them in place once verified.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('filenames', nargs='*', help='Files to repack, every HDF5 file when left out')
+        parser.add_argument('--workers', type=int, default=settings.LIDAR_EXPORT_WORKERS,
+                            help='Files repacked at once, LIDAR_EXPORT_WORKERS by default')
+        parser.add_argument('--compression', choices=[c or 'none' for c in COMPRESSIONS],
+                            default=REPACK_OPTIONS['compression'])
+        parser.add_argument('--compression-level', type=int, default=None,
+                            help=f'gzip level 0-9, {REPACK_OPTIONS["compression_level"]} by default')
+        parser.add_argument('--shuffle', action=argparse.BooleanOptionalAction,
+                            default=REPACK_OPTIONS['shuffle'], help='Byte shuffle filter')
+        parser.add_argument('--chunk-points', type=int, default=None, help='Points per chunk of the point datasets')
+        parser.add_argument('--quantize', action='store_true', help='Store angles and distances as fixed-point integers')
+        parser.add_argument('--merge-below', type=int, default=0, metavar='POINTS',
+                            help='Merge sessions with fewer points into the session before them')
+        parser.add_argument('--dry-run', action='store_true', help='Write and verify the copies, then remove them')
+
+    def handle(self, *args, **options):
+        compression = options['compression']
+        level = options['compression_level']
+        if level is None and compression == 'gzip':
+            level = REPACK_OPTIONS['compression_level']
+        try:
+            storage = storage_options(
+                compression=compression, compression_level=level, shuffle=options['shuffle'],
+                chunk_points=options['chunk_points'], quantize=options['quantize'],
+            )
+        except ValueError as e:
+            raise CommandError(str(e))
+        if options['workers'] < 1:
+            raise CommandError('--workers must be positive')
+
+        files = LidarFile.objects.filter(filename__endswith='.h5').order_by('pk')
+        if options['filenames']:
+            files = files.filter(filename__in=options['filenames'])
+            missing = set(options['filenames']) - set(files.values_list('filename', flat=True))
+            if missing:
+                raise CommandError(f"File not found: {', '.join(sorted(missing))}")
+
+        jobs = {}
+        for lidar_file in files:
+            path = lidar_file.file.path
+            if not os.path.exists(path):
+                self.stderr.write(f'{lidar_file.filename}: missing on disk, skipped')
+                continue
+            if lidar_file.sessions.filter(recording=True).exists() or is_being_written(path):
+                self.stderr.write(f'{lidar_file.filename}: being recorded, skipped')
+                continue
+            # in the same directory, so the swap is a rename within one file system
+            target = os.path.join(os.path.dirname(path), f'.{os.path.basename(path)}.repack')
+            jobs[lidar_file.pk] = (lidar_file, path, target, _stamp(path))
+        if not jobs:
+            self.stdout.write('Nothing to repack')
+            return
+
+        before = after = 0
+        failed = 0
+        context = multiprocessing.get_context('spawn')
+        with ProcessPoolExecutor(max_workers=min(options['workers'], len(jobs)), mp_context=context) as pool:
+            futures = {
+                pool.submit(repack_file, path, target, storage, options['merge_below'], REPACK_CHUNK): pk
+                for pk, (_, path, target, _) in jobs.items()
+            }
+            for future in as_completed(futures):
+                lidar_file, path, target, stamp = jobs[futures[future]]
+                try:
+                    stats = future.result()
+                except Exception as e:
+                    failed += 1
+                    self.stderr.write(f'{lidar_file.filename}: {e}')
+                    continue
+                try:
+                    self._swap(lidar_file, path, target, stamp, options)
+                except (OSError, CommandError) as e:
+                    failed += 1
+                    self.stderr.write(f'{lidar_file.filename}: {e}')
+                    if os.path.exists(target):
+                        os.unlink(target)
+                    continue
+
+                before += stats['bytes_before']
+                after += stats['bytes_after']
+                merged = stats['sessions'] - stats['sessions_after']
+                self.stdout.write(
+                    f'{lidar_file.filename}: {stats["bytes_before"] / 1e6:,.1f} MB -> {stats["bytes_after"] / 1e6:,.1f} MB '
+                    f'({stats["bytes_before"] / max(stats["bytes_after"], 1):.2f}x), {stats["points"]:,} points in '
+                    f'{stats["sessions_after"]} sessions' + (f', {merged} merged' if merged else '')
+                )
+                for session in stats['lod_dropped']:
+                    self.stdout.write(f'  {session}: overviews dropped by the merge, rebuild them with build_lod')
+
+        summary = f'{"Verified" if options["dry_run"] else "Repacked"} {len(jobs) - failed} files: ' \
+                  f'{before / 1e6:,.1f} MB -> {after / 1e6:,.1f} MB'
+        if failed:
+            raise CommandError(f'{summary}, {failed} failed')
+        self.stdout.write(self.style.SUCCESS(summary))
+
+    def _swap(self, lidar_file, path, target, stamp, options):
+        """
+        Replaces `path` with its verified copy `target`, unless the file was
+        written to while it was repacked, and indexes its sessions again.
+        Holds the write lock of the file meanwhile, a capture starting on it waits.
+        """
+        if options['dry_run']:
+            os.unlink(target)
+            return
+        try:
+            with writing_file(path, blocking=False):
+                if _stamp(path) != stamp:
+                    raise CommandError('changed while it was repacked, left as it was')
+                _fsync(target)
+                os.replace(target, path)
+                _fsync(os.path.dirname(path))
+        except BlockingIOError:
+            raise CommandError('being recorded, left as it was')
+
+        # merged sessions lose their rows, the others get their new sizes
+        index_file(lidar_file)
+        if options['quantize']:
+            # the rounded values differ from those already converted
+            CsvConversion.objects.filter(source=lidar_file).update(sessions=[])
@@ -0,0 +1,19 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from controller import jobs
+
+
+class Command(BaseCommand):
+    help = ('Runs the background jobs (csv conversion, sift ingestion) queued by the web workers and the '
+            'capture supervisor, see controller.jobs. Set LIDAR_JOBS_IN_WEB=false for the web workers.')
+
+    def handle(self, *args, **options):
+        runner = jobs.start_workers()
+        self.stdout.write('Running jobs once no other process does, stop with Ctrl-C')
+        try:
+            while runner.is_alive():
+                time.sleep(1)
+        except KeyboardInterrupt:
+            pass
@@ -0,0 +1,40 @@
+# Generated by Django 5.1.1 on 2026-10-18 19:14
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('controller', '0002_job'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='lidarfile',
+            name='uploaded_at',
+            field=models.DateTimeField(auto_now_add=True, db_index=True),
+        ),
+        migrations.CreateModel(
+            name='LidarSession',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('day', models.CharField(max_length=10)),
+                ('name', models.CharField(max_length=50)),
+                ('layout', models.CharField(max_length=10)),
+                ('start_time', models.DateTimeField(blank=True, null=True)),
+                ('end_time', models.DateTimeField(blank=True, null=True)),
+                ('scan_count', models.BigIntegerField(blank=True, null=True)),
+                ('point_count', models.BigIntegerField(default=0)),
+                ('bytes', models.BigIntegerField(default=0)),
+                ('recording', models.BooleanField(default=False)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+                ('file', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='sessions', to='controller.lidarfile')),
+            ],
+            options={
+                'indexes': [models.Index(fields=['start_time'], name='controller__start_t_216509_idx'), models.Index(fields=['end_time'], name='controller__end_tim_c1ddcb_idx')],
+                'constraints': [models.UniqueConstraint(fields=('file', 'day', 'name'), name='unique_file_session')],
+            },
+        ),
+    ]
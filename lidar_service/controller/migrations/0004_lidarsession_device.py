@@ -0,0 +1,18 @@
+# Generated by Django 5.1.1 on 2026-10-18 19:27
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('controller', '0003_lidarsession'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='lidarsession',
+            name='device',
+            field=models.CharField(blank=True, default='', max_length=64),
+        ),
+    ]
@@ -0,0 +1,27 @@
+# Generated by Django 5.1.1 on 2026-10-18 19:33
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('controller', '0004_lidarsession_device'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='CsvConversion',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('sessions', models.JSONField(default=list)),
+                ('rows', models.BigIntegerField(default=0)),
+                ('source_mtime_ns', models.BigIntegerField(blank=True, null=True)),
+                ('source_size', models.BigIntegerField(blank=True, null=True)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+                ('csv_file', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, related_name='conversion', to='controller.lidarfile')),
+                ('source', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='conversions', to='controller.lidarfile')),
+            ],
+        ),
+    ]
@@ -5,7 +5,95 @@ from django.db import models
 class LidarFile(models.Model):
     filename = models.CharField(max_length=50)
     file = models.FileField(upload_to='lidar_files/')
-    uploaded_at = models.DateTimeField(auto_now_add=True)
+    uploaded_at = models.DateTimeField(auto_now_add=True, db_index=True)
 
     def __str__(self):
         return f"{self.filename} at {self.uploaded_at}"
+
+
+class LidarSession(models.Model):
+    """
+    What is known about one session of an HDF5 `LidarFile`, so listings never
+    have to open the file. Kept up to date by the capture and by the
+    `index_sessions` management command, see `controller.sessions`.
+    """
+    file = models.ForeignKey(LidarFile, on_delete=models.CASCADE, related_name='sessions')
+    day = models.CharField(max_length=10)
+    name = models.CharField(max_length=50)
+    layout = models.CharField(max_length=10)
+    start_time = models.DateTimeField(null=True, blank=True)
+    end_time = models.DateTimeField(null=True, blank=True)
+    scan_count = models.BigIntegerField(null=True, blank=True)
+    point_count = models.BigIntegerField(default=0)
+    bytes = models.BigIntegerField(default=0)
+    recording = models.BooleanField(default=False)
+    # configured LiDAR that recorded the session, see lidar_control.device_configs
+    device = models.CharField(max_length=64, blank=True, default='')
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['file', 'day', 'name'], name='unique_file_session'),
+        ]
+        indexes = [
+            models.Index(fields=['start_time']),
+            models.Index(fields=['end_time']),
+        ]
+
+    def __str__(self):
+        return f"{self.file.filename} {self.day}/{self.name}"
+
+
+class CsvConversion(models.Model):
+    """
+    What a csv (or Parquet, Arrow IPC, npy) `LidarFile` holds of its HDF5 source,
+    so converting it again only converts what the source gained since, see
+    `controller.conversions`.
+    """
+    csv_file = models.OneToOneField(LidarFile, on_delete=models.CASCADE, related_name='conversion')
+    source = models.ForeignKey(LidarFile, on_delete=models.CASCADE, related_name='conversions')
+    # `lidar_export.update_csv` state, one entry per converted session
+    sessions = models.JSONField(default=list)
+    rows = models.BigIntegerField(default=0)
+    # modification time and size of the source when it was last converted
+    source_mtime_ns = models.BigIntegerField(null=True, blank=True)
+    source_size = models.BigIntegerField(null=True, blank=True)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    def __str__(self):
+        return f"{self.csv_file.filename} from {self.source.filename}"
+
+
+class Job(models.Model):
+    """
+    A long running task (csv conversion, sift ingestion) executed by the
+    background workers in `controller.jobs`.
+    """
+    QUEUED = 'queued'
+    RUNNING = 'running'
+    SUCCEEDED = 'succeeded'
+    FAILED = 'failed'
+    STATE_CHOICES = [
+        (QUEUED, 'Queued'),
+        (RUNNING, 'Running'),
+        (SUCCEEDED, 'Succeeded'),
+        (FAILED, 'Failed'),
+    ]
+
+    kind = models.CharField(max_length=50)
+    params = models.JSONField(default=dict)
+    state = models.CharField(max_length=10, choices=STATE_CHOICES, default=QUEUED, db_index=True)
+    processed = models.BigIntegerField(default=0)
+    total = models.BigIntegerField(null=True, blank=True)
+    result = models.JSONField(null=True, blank=True)
+    error = models.TextField(blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+    started_at = models.DateTimeField(null=True, blank=True)
+    finished_at = models.DateTimeField(null=True, blank=True)
+    # `host:pid` of the process running the job and when it last said it still
+    # does, a running job whose owner is gone is failed, see controller.jobs
+    owner = models.CharField(max_length=100, blank=True, default='')
+    heartbeat_at = models.DateTimeField(null=True, blank=True)
+
+    def __str__(self):
+        return f"{self.kind} job {self.pk} ({self.state})"
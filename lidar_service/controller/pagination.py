@@ -0,0 +1,20 @@
+from rest_framework.pagination import CursorPagination
+
+
+class OptionalCursorPagination(CursorPagination):
+    """
+    Cursor pagination that is only used when the client asks for it with
+    `?page_size=`, so plain listings keep returning a bare array. The
+    `next`/`previous` links carry the page size on.
+    """
+    page_size = None
+    page_size_query_param = 'page_size'
+    max_page_size = 1000
+
+
+class FilePagination(OptionalCursorPagination):
+    ordering = ('-uploaded_at', '-id')
+
+
+class SessionPagination(OptionalCursorPagination):
+    ordering = ('day', 'name')
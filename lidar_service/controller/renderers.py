@@ -0,0 +1,36 @@
+from rest_framework.renderers import BaseRenderer, JSONRenderer
+
+
+class PassthroughRenderer(BaseRenderer):
+    """
+    Sends `bytes` response data as is. Anything else, e.g. an error dict, is
+    rendered as JSON and labelled so.
+    """
+    charset = None
+
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        if isinstance(data, (bytes, bytearray, memoryview)):
+            return bytes(data)
+
+        response = (renderer_context or {}).get('response')
+        if response is not None:
+            response['Content-Type'] = JSONRenderer.media_type
+        return JSONRenderer().render(data)
+
+
+class BinaryRenderer(PassthroughRenderer):
+    """
+    Selected with `?format=binary` or `Accept: application/octet-stream`.
+    """
+    media_type = 'application/octet-stream'
+    format = 'binary'
+    render_style = 'binary'
+
+
+class EventStreamRenderer(PassthroughRenderer):
+    """
+    Lets `Accept: text/event-stream` clients (EventSource) reach views that
+    answer with a streaming response, errors still come back as JSON.
+    """
+    media_type = 'text/event-stream'
+    format = 'event-stream'
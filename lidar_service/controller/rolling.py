@@ -0,0 +1,193 @@
+"""
+Rolling captures: a capture that records continuously into a series of HDF5
+files, moving on to a new one once the current one reaches a size or a
+duration (see `lidar_control.Rotation`), so no file grows without bound.
+
+Each file of the series is a `LidarFile` named `<prefix>_<YYYYmmdd_HHMMSS>.h5`.
+Before a new one is started the oldest files of the series are deleted
+until the series fits its disk budget and the file system keeps
+`settings.LIDAR_ROLLING_RESERVE_MB` free. With an ingestion run name every
+finished file is queued for Sift ingestion, and only ingested files are
+deleted.
+"""
+import os
+import re
+import shutil
+from datetime import datetime
+
+from django.conf import settings
+from django.core.files.base import ContentFile
+
+from lidar_control import Rotation
+from sift_stack.models import IngestCheckpoint
+
+from . import jobs
+from .models import Job, LidarFile, LidarSession
+from .sessions import capture_index
+
+# longest series prefix, a LidarFile filename holds at most 50 characters
+# and the date, time and counter suffix takes up to 22
+MAX_PREFIX_LENGTH = 28
+PREFIX = re.compile(rf'^[A-Za-z0-9_-]{{1,{MAX_PREFIX_LENGTH}}}$')
+
+MB = 1 << 20
+
+
+def series_prefix(filename):
+    """
+    Returns the prefix of the files of a rolling capture started with `filename`.
+
+    :raises ValueError: When it is not a valid prefix.
+    """
+    prefix = filename[:-len('.h5')] if filename.endswith('.h5') else filename
+    if not PREFIX.match(prefix):
+        raise ValueError(
+            f"A rolling capture's filename must be 1-{MAX_PREFIX_LENGTH} letters, digits, '_' or '-', its files "
+            f"are named <filename>_<date>_<time>.h5"
+        )
+    return prefix
+
+
+def series_files(prefix):
+    """
+    Returns the `LidarFile`s of the rolling capture series `prefix`, oldest first.
+    """
+    name = re.compile(rf'^{re.escape(prefix)}_\d{{8}}_\d{{6}}(_\d+)?\.h5$')
+    files = LidarFile.objects.filter(filename__startswith=f'{prefix}_').order_by('uploaded_at', 'pk')
+    return [lidar_file for lidar_file in files if name.match(lidar_file.filename)]
+
+
+def _file_size(lidar_file):
+    try:
+        return os.path.getsize(lidar_file.file.path)
+    except OSError:
+        return 0
+
+
+def _pending_files():
+    """
+    Returns the filenames and ids of the files queued or running jobs read.
+    """
+    pending = set()
+    for params in Job.objects.filter(state__in=(Job.QUEUED, Job.RUNNING)).values_list('params', flat=True):
+        pending.add(params.get('filename'))
+        pending.add(params.get('h5_file_id'))
+        pending.update(params.get('h5_file_ids') or ())
+    return pending
+
+
+def is_ingested(lidar_file):
+    """
+    Whether the file went through a Sift ingestion to its end.
+    """
+    return IngestCheckpoint.objects.filter(filename=lidar_file.filename, completed=True).exists()
+
+
+def evict_files(prefix, budget_bytes=None, incoming_bytes=0, ingested_only=False, keep=()):
+    """
+    Deletes the oldest files of the series `prefix`, with their `LidarFile`,
+    until `incoming_bytes` more fit in `budget_bytes` (when set) and in the
+    free space of the file system beyond `settings.LIDAR_ROLLING_RESERVE_MB`.
+
+    Files being recorded, read by a queued or running job or named in `keep`
+    are never deleted, nor files not ingested yet when `ingested_only`.
+
+    :return: The names of the deleted files.
+    """
+    files = series_files(prefix)
+    total = sum(_file_size(lidar_file) for lidar_file in files)
+    directory = os.path.join(settings.MEDIA_ROOT, 'lidar_files')
+    # the first file of the storage has not created it yet
+    os.makedirs(directory, exist_ok=True)
+    reserve = settings.LIDAR_ROLLING_RESERVE_MB * MB
+
+    def over():
+        if budget_bytes is not None and total + incoming_bytes > budget_bytes:
+            return True
+        return shutil.disk_usage(directory).free - incoming_bytes < reserve
+
+    recording = set(LidarSession.objects.filter(recording=True).values_list('file', flat=True))
+    pending = _pending_files()
+    evicted = []
+    for lidar_file in files:
+        if not over():
+            break
+        if (lidar_file.filename in keep or lidar_file.pk in recording
+                or lidar_file.filename in pending or lidar_file.pk in pending
+                or (ingested_only and not is_ingested(lidar_file))):
+            continue
+        size = _file_size(lidar_file)
+        lidar_file.file.delete(save=False)
+        lidar_file.delete()
+        total -= size
+        evicted.append(lidar_file.filename)
+    if evicted:
+        print(f"Rolling capture {prefix}: deleted {', '.join(evicted)}")
+    if over():
+        # nothing more may go, the capture still moves on so a full disk costs at most the newest file
+        print(f"Rolling capture {prefix}: over its disk budget or free space reserve")
+    return evicted
+
+
+class RollingFiles:
+    """
+    The `Rotation.next_file` of a rolling capture: every call creates the
+    next file of the series, after making room for it, see `evict_files`.
+
+    :param budget_mb: Disk budget of the whole series, `None` for no budget
+        beyond the free space reserve.
+    :param ingest_runname: Queue every finished file for ingestion into a
+        Sift run named after it, and only delete ingested files.
+    """
+
+    def __init__(self, prefix, rotate_mb=None, budget_mb=None, ingest_runname=None):
+        self.prefix = prefix
+        self.rotate_bytes = int(rotate_mb * MB) if rotate_mb else 0
+        self.budget_bytes = int(budget_mb * MB) if budget_mb else None
+        self.ingest_runname = ingest_runname
+        self.current = None
+
+    def __call__(self):
+        evict_files(self.prefix, self.budget_bytes, self.rotate_bytes, bool(self.ingest_runname),
+                    keep={self.current} if self.current else ())
+
+        stamp = datetime.now().strftime('%Y%m%d_%H%M%S')
+        filename = f'{self.prefix}_{stamp}.h5'
+        counter = 1
+        while LidarFile.objects.filter(filename=filename).exists():
+            counter += 1
+            filename = f'{self.prefix}_{stamp}_{counter}.h5'
+
+        lidar_file = LidarFile(filename=filename)
+        lidar_file.file.save(filename, ContentFile(''), save=True)
+        self.current = filename
+        return filename, lidar_file.file.path, self.index(lidar_file)
+
+    def index(self, lidar_file):
+        """
+        Returns the session index callback of a file of the series, which also
+        queues its ingestion once it is finished.
+        """
+        index = capture_index(lidar_file)
+        if not self.ingest_runname:
+            return index
+
+        def index_and_ingest(session, summary):
+            if not summary['recording']:
+                # only queued, the process running the jobs ingests it
+                try:
+                    jobs.submit('ingest_csv', {
+                        'filename': lidar_file.filename,
+                        'runname': self.ingest_runname,
+                        'path': lidar_file.file.path,
+                    })
+                except Exception as e:
+                    print(f"Ingestion of {lidar_file.filename} not queued: {e}")
+            index(session, summary)
+        return index_and_ingest
+
+    def rotation(self, rotate_seconds=None):
+        """
+        Returns the `lidar_control.Rotation` of the capture.
+        """
+        return Rotation(self, self.rotate_bytes or None, rotate_seconds)
@@ -1,7 +1,73 @@
 from rest_framework import serializers
-from .models import LidarFile
+from django.utils import timezone
+from .models import LidarFile, LidarSession, Job
 
 class LidarFileSerializer(serializers.ModelSerializer):
+    # totals over the file's sessions, annotated by LidarFileViewSet.get_queryset
+    session_count = serializers.IntegerField(read_only=True)
+    point_count = serializers.IntegerField(read_only=True)
+    bytes = serializers.IntegerField(read_only=True)
+    start_time = serializers.DateTimeField(read_only=True)
+    end_time = serializers.DateTimeField(read_only=True)
+
     class Meta:
         model = LidarFile
-        fields = ['id', 'filename']
+        fields = ['id', 'filename', 'uploaded_at', 'session_count', 'point_count', 'bytes', 'start_time', 'end_time']
+
+
+class LidarSessionSerializer(serializers.ModelSerializer):
+    session = serializers.SerializerMethodField()
+
+    class Meta:
+        model = LidarSession
+        fields = [
+            'id', 'session', 'day', 'name', 'layout', 'start_time', 'end_time',
+            'scan_count', 'point_count', 'bytes', 'recording', 'device', 'updated_at',
+        ]
+
+    def get_session(self, lidar_session):
+        """`day/session` name, as taken by the readings API."""
+        return f'{lidar_session.day}/{lidar_session.name}'
+
+
+class JobSerializer(serializers.ModelSerializer):
+    duration = serializers.SerializerMethodField()
+    rate = serializers.SerializerMethodField()
+
+    class Meta:
+        model = Job
+        fields = [
+            'id', 'kind', 'state', 'processed', 'total', 'rate', 'result', 'error',
+            'created_at', 'started_at', 'finished_at', 'duration',
+        ]
+
+    def get_duration(self, job):
+        """Seconds spent running so far, or in total once finished."""
+        if not job.started_at:
+            return None
+        end = job.finished_at or timezone.now()
+        return (end - job.started_at).total_seconds()
+
+    def get_rate(self, job):
+        """Rows processed per second."""
+        duration = self.get_duration(job)
+        if not duration:
+            return None
+        return job.processed / duration
+
+
+class StorageOptionsSerializer(serializers.Serializer):
+    """
+    How the datasets of new sessions are laid out, see lidar_storage.storage_options.
+    Use with partial=True so options left out fall back to the file's defaults.
+    """
+    chunk_points = serializers.IntegerField(min_value=1, required=False, help_text='Points per HDF5 chunk')
+    compression = serializers.ChoiceField(choices=['gzip', 'lzf', 'none'], required=False)
+    compression_level = serializers.IntegerField(min_value=0, max_value=9, required=False, help_text='gzip level')
+    shuffle = serializers.BooleanField(required=False, help_text='Byte shuffle filter before compression')
+    quantize = serializers.BooleanField(
+        required=False, help_text='Store distance as uint16 millimetres and angle as int16 0.1 mrad'
+    )
+    lod = serializers.BooleanField(
+        required=False, help_text='Keep per-second and per-minute min/mean/max overviews while recording'
+    )
@@ -0,0 +1,96 @@
+"""
+Session index: one `LidarSession` row per session of every HDF5 `LidarFile`.
+
+The capture keeps the row of the session it records up to date through the
+`index` callback of `lidar_control.start_lidar`, `index_file` rebuilds the
+rows of a file from the file itself (see the `index_sessions` command).
+"""
+from datetime import datetime, timezone as dt_timezone
+
+from django.db import connection
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+
+from lidar_query import session_names
+from lidar_storage import open_file, session_summary
+
+from .models import LidarSession
+
+
+def _datetime(epoch):
+    return None if epoch is None else datetime.fromtimestamp(epoch, tz=dt_timezone.utc)
+
+
+def parse_time(value):
+    """
+    Parses a query parameter given as epoch seconds or an ISO 8601 datetime
+    (UTC unless it carries an offset).
+
+    :raises ValueError: For anything else.
+    """
+    try:
+        return _datetime(float(value))
+    except ValueError:
+        pass
+    parsed = parse_datetime(value)
+    if parsed is None:
+        raise ValueError(f"Invalid time '{value}'")
+    return parsed if timezone.is_aware(parsed) else timezone.make_aware(parsed, dt_timezone.utc)
+
+
+def update_session(lidar_file, session, summary):
+    """
+    Creates or updates the row of `session` (`day/session` name) from a
+    `lidar_storage.session_summary`. `recording` is only changed when the
+    summary has it.
+    """
+    day, name = session.split('/')
+    fields = {
+        'layout': summary['layout'],
+        'start_time': _datetime(summary['start_time']),
+        'end_time': _datetime(summary['end_time']),
+        'scan_count': summary['scans'],
+        'point_count': summary['points'],
+        'bytes': summary['bytes'],
+        'device': summary['device'],
+    }
+    if 'recording' in summary:
+        fields['recording'] = summary['recording']
+    return LidarSession.objects.update_or_create(file=lidar_file, day=day, name=name, defaults=fields)[0]
+
+
+def index_file(lidar_file):
+    """
+    Brings the rows of an HDF5 file in line with its sessions: every session
+    is read again and rows of sessions no longer in the file are removed.
+
+    :return: The number of sessions indexed.
+    """
+    summaries = {}
+    with open_file(lidar_file.file.path) as f:
+        for session in session_names(f):
+            try:
+                summaries[session] = session_summary(f[session])
+            except ValueError as e:
+                # a group that is not a session
+                print(f"Skipping {lidar_file.filename} {session}: {e}")
+
+    kept = [update_session(lidar_file, session, summary).pk for session, summary in summaries.items()]
+    LidarSession.objects.filter(file=lidar_file).exclude(pk__in=kept).delete()
+    return len(kept)
+
+
+def capture_index(lidar_file):
+    """
+    Returns the `index` callback of a capture into `lidar_file`.
+
+    It runs in the capture's writer thread, which gives its database
+    connection back once the capture has ended.
+    """
+    def index(session, summary):
+        try:
+            update_session(lidar_file, session, summary)
+        finally:
+            if not summary['recording']:
+                connection.close()
+    return index
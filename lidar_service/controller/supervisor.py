@@ -0,0 +1,392 @@
+"""
+Who runs the captures: the web process itself, or a capture supervisor
+that every web worker talks to.
+
+Without `settings.LIDAR_SUPERVISOR` the captures run in the process that
+serves the request (`LocalCaptures`), which is only consistent with a single
+web process. With it, `manage.py capture_supervisor` owns the devices and
+listens on that address; web workers send it `start`, `stop` and `status`
+commands and relay its live scans to their viewers (`RemoteCaptures`), so
+any worker can stop a capture another one started.
+
+Commands travel as JSON `[command, args, kwargs]` messages over a
+`multiprocessing.connection`, one connection per command and one per watched
+live view; nothing received is unpickled. A TCP supervisor only accepts
+connections authenticated with `LIDAR_SUPERVISOR_KEY`, which must be set and
+differ from `SECRET_KEY`. A unix socket is only accessible to its user, the
+key is optional there.
+"""
+import fcntl
+import json
+import os
+import signal
+import threading
+import time
+from multiprocessing.connection import AuthenticationError, Client, Listener
+
+import numpy as np
+from django.conf import settings
+from django.db import connection
+
+from lidar_control import CAPTURE_METRICS, CaptureError, captures, get_capture
+from lidar_live import POLL_INTERVAL, LiveScans
+from lidar_metrics import expose
+
+from .models import LidarFile
+from .rolling import RollingFiles, series_prefix
+from .sessions import capture_index
+
+# seconds between two messages of a watched live view, a watcher that went
+# away is noticed when a message fails
+WATCH_HEARTBEAT = 1.0
+
+COMMANDS = ('devices', 'status', 'start', 'stop', 'metrics')
+
+# largest message accepted, in bytes: a command or reply, or an array of a scan
+MAX_MESSAGE = 16 << 20
+
+
+class SupervisorUnavailable(Exception):
+    """
+    The capture supervisor cannot be reached.
+    """
+
+
+def parse_address(address):
+    """
+    Returns a `multiprocessing.connection` address: `(host, port)` for
+    `host:port`, the socket path otherwise.
+    """
+    host, _, port = address.rpartition(':')
+    if host and port.isdigit() and not address.startswith('/'):
+        return host, int(port)
+    return address
+
+
+def supervisor_key(address, key):
+    """
+    Returns the authentication key of the supervisor at `address` as bytes,
+    `None` for no authentication.
+
+    :raises ValueError: For a TCP address without a key of its own: not set,
+        or `SECRET_KEY`, which is committed with the code.
+    """
+    if isinstance(parse_address(address), tuple) and (not key or key == settings.SECRET_KEY):
+        raise ValueError(
+            f"Set LIDAR_SUPERVISOR_KEY to a secret of its own to run the capture supervisor on {address}, "
+            f"or use a unix socket"
+        )
+    return key.encode() if key else None
+
+
+def _send(conn, message):
+    conn.send_bytes(json.dumps(message).encode())
+
+
+def _recv(conn):
+    return json.loads(conn.recv_bytes(MAX_MESSAGE))
+
+
+def _send_scan(conn, scan):
+    """
+    Sends the `(timestamp, angles, distances, intensities)` of a scan, the
+    arrays as raw bytes after a JSON header with their dtypes.
+    """
+    timestamp, *arrays = scan
+    _send(conn, [timestamp, [array.dtype.str for array in arrays]])
+    for array in arrays:
+        conn.send_bytes(np.ascontiguousarray(array))
+
+
+def _recv_scan(conn, header):
+    timestamp, dtypes = header
+    arrays = []
+    for dtype in dtypes:
+        dtype = np.dtype(dtype)
+        if dtype.kind not in 'fiub':
+            raise ValueError(f'Unexpected scan dtype {dtype}')
+        arrays.append(np.frombuffer(conn.recv_bytes(MAX_MESSAGE), dtype=dtype))
+    return (timestamp, *arrays)
+
+
+class LocalCaptures:
+    """
+    Captures run by this process, see `lidar_control.captures`.
+    """
+    remote = False
+
+    def devices(self):
+        return [capture.status() for capture in captures().values()]
+
+    def status(self, device=None):
+        return get_capture(device).status()
+
+    def start(self, device, filename, rolling=None, **options):
+        """
+        Starts recording `filename` on `device`, with the session index following the capture.
+
+        :param rolling: Records a rolling capture named `filename` instead, see
+            `controller.rolling`: a dict of `rotate_mb`, `rotate_seconds`,
+            `budget_mb` and `ingest_runname`.
+        :return: The name of the device.
+        """
+        capture = get_capture(device)
+        if not rolling:
+            lidar_file = LidarFile.objects.get(filename=filename)
+            capture.start(filename, os.path.join(settings.MEDIA_ROOT, 'lidar_files', filename),
+                          index=capture_index(lidar_file), **options)
+            return capture.name
+
+        files = RollingFiles(series_prefix(filename), rolling.get('rotate_mb'), rolling.get('budget_mb'),
+                             rolling.get('ingest_runname'))
+        rotation = files.rotation(rolling.get('rotate_seconds'))
+        first, path, index = files()
+        try:
+            capture.start(first, path, index=index, rotation=rotation, **options)
+        except BaseException:
+            LidarFile.objects.filter(filename=first).delete()
+            os.unlink(path)
+            raise
+        return capture.name
+
+    def stop(self, device=None):
+        capture = get_capture(device)
+        capture.stop()
+        return capture.name
+
+    def stop_all(self):
+        for capture in captures().values():
+            if capture.running:
+                capture.stop()
+
+    def live(self, device=None):
+        return get_capture(device).live
+
+    def metrics(self):
+        """
+        :return: `(names, text)` of the capture metrics of this process.
+        """
+        return CAPTURE_METRICS, expose(CAPTURE_METRICS)
+
+
+# exceptions raised again on the web worker side, by name
+_ERRORS = {
+    'CaptureError': CaptureError,
+    'KeyError': KeyError,
+    'ValueError': ValueError,
+    'DoesNotExist': LidarFile.DoesNotExist,
+}
+
+
+class RemoteCaptures:
+    """
+    Captures run by the capture supervisor at `address`, same methods as `LocalCaptures`.
+    """
+    remote = True
+
+    def __init__(self, address, key):
+        self.address = parse_address(address)
+        self.authkey = supervisor_key(address, key)
+        self.lock = threading.Lock()
+        self._live = {}
+
+    def connect(self):
+        try:
+            return Client(self.address, authkey=self.authkey)
+        except (OSError, EOFError, AuthenticationError) as e:
+            raise SupervisorUnavailable(f"Capture supervisor unavailable at {self.address}: {e}") from e
+
+    def call(self, command, *args, **kwargs):
+        with self.connect() as conn:
+            try:
+                _send(conn, [command, args, kwargs])
+                reply = _recv(conn)
+            except (OSError, EOFError) as e:
+                raise SupervisorUnavailable(f"Capture supervisor went away: {e}") from e
+        if reply[0] == 'ok':
+            return reply[1]
+        _, name, message = reply
+        raise _ERRORS.get(name, RuntimeError)(message)
+
+    def devices(self):
+        return self.call('devices')
+
+    def status(self, device=None):
+        return self.call('status', device)
+
+    def start(self, device, filename, **options):
+        return self.call('start', device, filename, **options)
+
+    def stop(self, device=None):
+        return self.call('stop', device)
+
+    def live(self, device=None):
+        # one relay per device, shared by the viewers of this worker
+        name = self.status(device)['device']
+        with self.lock:
+            if name not in self._live:
+                self._live[name] = RemoteLiveScans(self, name)
+            return self._live[name]
+
+    def metrics(self):
+        return self.call('metrics')
+
+
+class RemoteLiveScans(LiveScans):
+    """
+    Latest scan of a capture run by the supervisor. While this worker has
+    viewers, a thread watches the capture and publishes its scans here.
+    """
+
+    def __init__(self, captures, device):
+        super().__init__()
+        self.captures = captures
+        self.device = device
+        self._relay = None
+
+    def subscribe(self):
+        super().subscribe()
+        with self.lock:
+            if self._relay is None:
+                self._start_relay()
+
+    def _start_relay(self):
+        self._relay = threading.Thread(target=self._watch, name=f'lidar-live-{self.device}', daemon=True)
+        self._relay.start()
+
+    def _watch(self):
+        try:
+            with self.captures.connect() as conn:
+                _send(conn, ['watch', [self.device], {}])
+                while self.viewers:
+                    if conn.poll(WATCH_HEARTBEAT):
+                        header = _recv(conn)
+                        if header is not None:
+                            self.publish(*_recv_scan(conn, header))
+        except (SupervisorUnavailable, OSError, EOFError, ValueError) as e:
+            print(f"Live view of lidar {self.device} lost: {e}")
+            time.sleep(WATCH_HEARTBEAT)
+        finally:
+            with self.lock:
+                self._relay = None
+                # a viewer arrived as the relay was ending, or the supervisor went away
+                if self.viewers:
+                    self._start_relay()
+
+
+_backend = None
+_backend_lock = threading.Lock()
+
+
+def capture_backend():
+    """
+    Returns `RemoteCaptures` when `settings.LIDAR_SUPERVISOR` is set, `LocalCaptures` otherwise.
+    """
+    global _backend
+    with _backend_lock:
+        if _backend is None:
+            address = getattr(settings, 'LIDAR_SUPERVISOR', '')
+            if address:
+                _backend = RemoteCaptures(address, settings.LIDAR_SUPERVISOR_KEY)
+            else:
+                _backend = LocalCaptures()
+        return _backend
+
+
+def _watch(conn, local, device):
+    """
+    Sends the scans of a capture's live view to a web worker until it hangs up.
+    """
+    live = local.live(device)
+    live.subscribe()
+    try:
+        seen = 0
+        last_sent = time.monotonic()
+        while True:
+            scan = live.latest
+            now = time.monotonic()
+            if scan is not None and scan[0] != seen:
+                seen = scan[0]
+                _send_scan(conn, scan[1:])
+                last_sent = now
+            elif now - last_sent >= WATCH_HEARTBEAT:
+                _send(conn, None)
+                last_sent = now
+            time.sleep(POLL_INTERVAL)
+    finally:
+        live.unsubscribe()
+
+
+def _serve_connection(conn, local):
+    try:
+        with conn:
+            command, args, kwargs = _recv(conn)
+            if command == 'watch':
+                _watch(conn, local, *args)
+                return
+            try:
+                if command not in COMMANDS:
+                    raise ValueError(f"Unknown command '{command}'")
+                reply = ('ok', getattr(local, command)(*args, **kwargs))
+            except Exception as e:
+                message = e.args[0] if isinstance(e, KeyError) and e.args else str(e)
+                reply = ('error', type(e).__name__, message)
+            _send(conn, reply)
+    except (OSError, EOFError, ValueError):
+        # the web worker went away, or did not send a command
+        pass
+    finally:
+        connection.close()
+
+
+def serve(address, key, local=None):
+    """
+    Runs the capture supervisor: accepts commands on `address` until
+    interrupted, then stops the running captures so their files are complete.
+
+    A unix socket address is guarded by a lock file next to it, a second
+    supervisor on the same socket refuses to start, and created readable
+    and writable by its user only.
+
+    :param key: `LIDAR_SUPERVISOR_KEY`, see `supervisor_key`.
+    :raises ValueError: When a TCP address has no key of its own.
+    """
+    authkey = supervisor_key(address, key)
+    local = local or LocalCaptures()
+    address = parse_address(address)
+    lock = None
+    if isinstance(address, str):
+        lock = open(f'{address}.lock', 'a+')
+        try:
+            fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            lock.close()
+            raise CaptureError(f"Another capture supervisor is running on {address}")
+        # left behind by a supervisor that did not exit cleanly
+        if os.path.exists(address):
+            os.unlink(address)
+
+    # stop cleanly on `docker stop` and friends too
+    signal.signal(signal.SIGTERM, signal.default_int_handler)
+    # the socket file is created with the umask, no window where others can connect
+    umask = os.umask(0o177)
+    try:
+        listener = Listener(address, authkey=authkey)
+    finally:
+        os.umask(umask)
+    print(f"Capture supervisor listening on {listener.address}")
+    try:
+        while True:
+            try:
+                conn = listener.accept()
+            except (AuthenticationError, OSError, EOFError) as e:
+                print(f"Rejected connection: {e}")
+                continue
+            threading.Thread(target=_serve_connection, args=(conn, local), daemon=True).start()
+    except KeyboardInterrupt:
+        print("Capture supervisor stopping.")
+    finally:
+        listener.close()
+        local.stop_all()
+        if lock:
+            lock.close()
@@ -0,0 +1,53 @@
+import os
+
+from django.conf import settings
+
+from lidar_export import GZIP_LEVEL, export_csv, plan_export
+
+from . import jobs
+from .conversions import update_conversion
+from .models import CsvConversion, LidarFile
+
+
+@jobs.register('convert_csv')
+def convert_csv(params, progress):
+    """
+    Converts the HDF5 `LidarFile` `h5_file_id` into the (already created) csv `LidarFile` `csv_file_id`,
+    or appends what the HDF5 file gained since the csv was last converted.
+    """
+    h5_lidar_file = LidarFile.objects.get(pk=params['h5_file_id'])
+    csv_lidar_file = LidarFile.objects.get(pk=params['csv_file_id'])
+    conversion, _ = CsvConversion.objects.get_or_create(csv_file=csv_lidar_file, defaults={'source': h5_lidar_file})
+
+    # sessions are converted in bounded slices, see lidar_export
+    converted = update_conversion(conversion, progress=progress)
+    conversion.refresh_from_db()
+    return {'filename': csv_lidar_file.filename, 'rows': conversion.rows, 'converted_rows': converted}
+
+
+@jobs.register('export_csv')
+def export_csv_batch(params, progress):
+    """
+    Exports the sessions of the HDF5 `LidarFile`s `h5_file_ids` recorded between
+    `first_day` and `last_day` into the (already created) csv `LidarFile` `csv_file_id`,
+    converting them in parallel processes.
+    """
+    h5_lidar_files = LidarFile.objects.in_bulk(params['h5_file_ids'])
+    csv_lidar_file = LidarFile.objects.get(pk=params['csv_file_id'])
+    paths = [h5_lidar_files[pk].file.path for pk in params['h5_file_ids'] if pk in h5_lidar_files]
+
+    parts = plan_export(paths, params.get('first_day'), params.get('last_day'))
+    workers = params.get('workers') or settings.LIDAR_EXPORT_WORKERS
+    with open(csv_lidar_file.file.path, 'wb') as csvfile:
+        rows = export_csv(
+            parts, csvfile, workers=workers, work_dir=os.path.dirname(csv_lidar_file.file.path), progress=progress,
+            gzip_level=GZIP_LEVEL if csv_lidar_file.filename.endswith('.gz') else None,
+        )
+
+    return {
+        'filename': csv_lidar_file.filename,
+        'rows': rows,
+        'files': len(paths),
+        'sessions': len({(path, session) for path, session, _, _ in parts}),
+        'workers': workers,
+    }
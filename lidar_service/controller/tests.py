@@ -1,3 +1,498 @@
-from django.test import TestCase
+import gzip
+import os
+import pickle
+import socket
+import tempfile
+import time
+from datetime import timedelta
+from multiprocessing import Pipe
+from unittest import mock
 
-# Create your tests here.
+import numpy as np
+from django.db import DatabaseError
+from django.test import SimpleTestCase, TestCase, override_settings
+from django.utils import timezone
+
+from lidar_control import ScanDecimator, is_being_written, writing_file
+from lidar_export import GzipMembers, format_csv_block, update_csv
+from lidar_live import LiveScans, _Viewer, bin_scan
+from lidar_storage import SessionReader, append_scans, create_session, open_file
+
+from . import jobs, supervisor
+from .downloads import negotiate_encoding, parse_range
+from .models import Job
+
+
+def _rows(*columns):
+    return format_csv_block([np.asarray(column, dtype=np.float64) for column in columns]).decode('ascii').splitlines()
+
+
+def _record(path, session, timestamps, counts):
+    """
+    Appends scans of `counts` points at `timestamps` to `session` (`day/name`)
+    of the HDF5 file at `path`, creating both when missing. Point `i` of the
+    session has angle `i` and distance `2 * i`.
+    """
+    day, name = session.split('/')
+    with open_file(path, 'a') as f:
+        if session not in f:
+            create_session(f.require_group(day), name)
+        group = f[session]
+        first = group['points/angle'].shape[0]
+        points = np.arange(first, first + sum(counts), dtype=np.float32)
+        append_scans(group, timestamps, counts, points, 2 * points, np.zeros(len(points), dtype=np.uint8))
+
+
+class FormatCsvBlockTests(SimpleTestCase):
+
+    def test_fixed_point(self):
+        self.assertEqual(_rows([1.5, -2.25], [0.0, 12.0], [3.0, 0.000001]), [
+            '1.500000,0.000000,3.000000',
+            '-2.250000,12.000000,0.000001',
+        ])
+
+    def test_rounding_at_the_last_decimal(self):
+        zeros = [0.0] * 4
+        self.assertEqual([row.split(',')[0] for row in _rows([1.9999996, 0.0000004, 0.0000006, 9.9999999], zeros, zeros)],
+                         ['2.000000', '0.000000', '0.000001', '10.000000'])
+
+    def test_negative_zero(self):
+        # neither -0.0 nor a negative value rounding to zero gets a sign
+        self.assertEqual(_rows([-0.0, -0.0000004], [0.0, 0.0], [0.0, 0.0]), [
+            '0.000000,0.000000,0.000000',
+            '0.000000,0.000000,0.000000',
+        ])
+
+    def test_non_finite_values_fall_back_to_repr(self):
+        self.assertEqual(_rows([np.nan, 1.0], [np.inf, 2.0], [-np.inf, 3.0]), [
+            'nan,inf,-inf',
+            '1.0,2.0,3.0',
+        ])
+
+    def test_huge_values_fall_back_to_repr(self):
+        # 1e300 * 10**6 overflows the int64 digit arithmetic
+        self.assertEqual(_rows([1e300, 1.0], [1.0, 2.0], [-1e13, 3.0]), [
+            '1e+300,1.0,-10000000000000.0',
+            '1.0,2.0,3.0',
+        ])
+
+    def test_largest_fixed_point_value(self):
+        self.assertEqual(_rows([4.6e12], [0.0], [0.0]), ['4600000000000.000000,0.000000,0.000000'])
+
+
+class ParseRangeTests(SimpleTestCase):
+
+    def test_suffix(self):
+        self.assertEqual(parse_range('bytes=-100', 1000), (900, 999))
+        # longer than the file: all of it
+        self.assertEqual(parse_range('bytes=-5000', 1000), (0, 999))
+
+    def test_open_ended(self):
+        self.assertEqual(parse_range('bytes=100-', 1000), (100, 999))
+        self.assertEqual(parse_range('bytes=0-0', 1000), (0, 0))
+        # the end is clamped to the file
+        self.assertEqual(parse_range('bytes=500-2000', 1000), (500, 999))
+
+    def test_unsatisfiable(self):
+        for header in ('bytes=1000-', 'bytes=2000-3000', 'bytes=-0', 'bytes=5-2'):
+            self.assertIs(parse_range(header, 1000), False, header)
+        self.assertIs(parse_range('bytes=-10', 0), False)
+
+    def test_ignored(self):
+        # multipart ranges and malformed headers get the whole file
+        for header in (None, '', 'bytes=0-1,5-6', 'bytes=-', 'items=0-1', 'bytes=a-b'):
+            self.assertIsNone(parse_range(header, 1000), header)
+
+
+class FailOrphanedJobsTests(TestCase):
+
+    def running(self, owner, heartbeat_age):
+        heartbeat = None if heartbeat_age is None else timezone.now() - timedelta(seconds=heartbeat_age)
+        return Job.objects.create(kind='convert_csv', params={}, state=Job.RUNNING, owner=owner, heartbeat_at=heartbeat)
+
+    def test_only_jobs_of_gone_runners_fail(self):
+        host = socket.gethostname()
+        alive = self.running(f'{host}:{os.getpid()}', 1)
+        other_host = self.running('elsewhere:1', 1)
+        # no process runs with a pid above the kernel's maximum
+        dead = self.running(f'{host}:{1 << 30}', 1)
+        stale = self.running(f'{host}:{os.getpid()}', jobs.STALE_AFTER + 5)
+        unowned = self.running('', None)
+        queued = Job.objects.create(kind='convert_csv', params={})
+
+        self.assertEqual(jobs.fail_orphaned_jobs(), 3)
+        states = dict(Job.objects.values_list('pk', 'state'))
+        self.assertEqual([states[job.pk] for job in (alive, other_host, dead, stale, unowned, queued)],
+                         [Job.RUNNING, Job.RUNNING, Job.FAILED, Job.FAILED, Job.FAILED, Job.QUEUED])
+
+
+class RunJobsTests(TestCase):
+
+    def test_survives_database_errors_and_restarts_dead_workers(self):
+        rounds = []
+        real_sleep = time.sleep
+
+        def sleep(seconds):
+            rounds.append(seconds)
+            if len(rounds) == 3:
+                raise KeyboardInterrupt
+            # long enough for the worker to exit
+            real_sleep(0.1)
+
+        # the first round finds the database locked, every worker exits at once
+        orphans = mock.Mock(side_effect=[DatabaseError('database is locked'), 0, 0])
+        work = mock.Mock()
+        with mock.patch.object(jobs, '_take_runner_lock'), mock.patch.object(jobs, 'fail_orphaned_jobs', orphans), \
+                mock.patch.object(jobs, '_work', work), mock.patch.object(jobs.time, 'sleep', sleep), \
+                mock.patch.object(jobs.traceback, 'print_exc'), self.settings(LIDAR_JOB_WORKERS=1):
+            with self.assertRaises(KeyboardInterrupt):
+                jobs._run_jobs()
+        self.assertEqual(orphans.call_count, 3)
+        self.assertEqual(work.call_count, 3)
+
+
+class ClaimTests(TestCase):
+
+    def test_claims_the_oldest_queued_job(self):
+        first = Job.objects.create(kind='convert_csv', params={})
+        Job.objects.create(kind='convert_csv', params={})
+        Job.objects.create(kind='convert_csv', params={}, state=Job.FAILED)
+
+        job = jobs._claim('host:1')
+        self.assertEqual(job.pk, first.pk)
+        self.assertEqual((job.state, job.owner), (Job.RUNNING, 'host:1'))
+        self.assertIsNotNone(job.started_at)
+        self.assertEqual(job.started_at, job.heartbeat_at)
+        self.assertEqual(jobs._claim('host:1').pk, first.pk + 1)
+        self.assertIsNone(jobs._claim('host:1'))
+
+    def test_a_job_claimed_meanwhile_is_skipped(self):
+        first = Job.objects.create(kind='convert_csv', params={})
+        second = Job.objects.create(kind='convert_csv', params={})
+        now = timezone.now
+
+        def claimed_by_another_runner():
+            # runs between the query for queued jobs and the claim of the first one
+            if not Job.objects.filter(owner='other:2').exists():
+                Job.objects.filter(pk=first.pk).update(state=Job.RUNNING, owner='other:2')
+            return now()
+
+        with mock.patch('controller.jobs.timezone.now', side_effect=claimed_by_another_runner):
+            job = jobs._claim('host:1')
+        self.assertEqual(job.pk, second.pk)
+        first.refresh_from_db()
+        self.assertEqual(first.owner, 'other:2')
+
+
+class ScanDecimatorTests(SimpleTestCase):
+
+    @staticmethod
+    def kept(decimator, stamps):
+        return [stamp for stamp in stamps if decimator.keep(stamp)]
+
+    def test_every_scan_by_default(self):
+        stamps = [0.1 * i for i in range(10)]
+        self.assertEqual(self.kept(ScanDecimator(), stamps), stamps)
+
+    def test_every(self):
+        self.assertEqual(self.kept(ScanDecimator(every=3), list(range(10))), [0, 3, 6, 9])
+
+    def test_rate_despite_jitter(self):
+        # 5 Hz from a 10 Hz device keeps exactly every other scan
+        jitter = np.random.default_rng(0).uniform(-0.01, 0.01, 100)
+        stamps = 0.1 * np.arange(100) + jitter
+        self.assertEqual(self.kept(ScanDecimator(rate=5), stamps), list(stamps[::2]))
+
+    def test_rate_restarts_after_a_gap(self):
+        # the device stalls for 2.7 s, then records 2 s more
+        before = [0.1 * i for i in range(4)]
+        after = [3.0 + 0.1 * i for i in range(20)]
+        kept = self.kept(ScanDecimator(rate=5), before + after)
+        self.assertEqual(kept[:3], [0.0, 0.2, 3.0])
+        # the schedule starts over at 5 Hz instead of catching up on the stall
+        self.assertEqual(len(kept[2:]), 10)
+
+    def test_rate_and_every(self):
+        # every other scan first, then at most 2.5 Hz of those
+        stamps = [0.1 * i for i in range(20)]
+        self.assertEqual(self.kept(ScanDecimator(rate=2.5, every=2), stamps), stamps[::4])
+
+
+class SessionReaderTimeRangeTests(SimpleTestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp.cleanup)
+        self.path = os.path.join(self.tmp.name, 'capture.h5')
+        # scans at 10, 11, 12 and 13 s, their points start at 0, 2, 5 and 6
+        _record(self.path, '2024_10_17/session_001', [10.0, 11.0, 12.0, 13.0], [2, 3, 1, 4])
+
+    def time_range(self, start_time=None, end_time=None):
+        with open_file(self.path) as f:
+            return SessionReader(f['2024_10_17/session_001']).time_range(start_time, end_time)
+
+    def test_whole_session(self):
+        self.assertEqual(self.time_range(), (0, 10))
+        self.assertEqual(self.time_range(0.0, 100.0), (0, 10))
+
+    def test_start_included_end_excluded(self):
+        self.assertEqual(self.time_range(11.0, 13.0), (2, 6))
+        self.assertEqual(self.time_range(11.5, 12.5), (5, 6))
+        self.assertEqual(self.time_range(12.0, 12.0), (5, 5))
+
+    def test_outside_the_session(self):
+        self.assertEqual(self.time_range(end_time=10.0), (0, 0))
+        self.assertEqual(self.time_range(13.5), (10, 10))
+
+    def test_scans_without_their_points(self):
+        # a scan row written past the points on disk does not count yet
+        with open_file(self.path, 'a') as f:
+            group = f['2024_10_17/session_001']
+            for name, value in (('timestamp', 14.0), ('offset', 10), ('count', 5)):
+                group[f'scans/{name}'].resize((5,))
+                group[f'scans/{name}'][4] = value
+        self.assertEqual(self.time_range(), (0, 10))
+        self.assertEqual(self.time_range(13.0), (6, 10))
+
+    def test_readings_layout(self):
+        with open_file(self.path, 'a') as f:
+            group = f.require_group('2024_10_18').create_group('session_001')
+            group['readings/timestamp'] = [1.0, 1.0, 2.0, 2.0, 3.0]
+            group['readings/angle'] = np.zeros(5, dtype=np.float32)
+            group['readings/distance'] = np.zeros(5, dtype=np.float32)
+        with open_file(self.path) as f:
+            reader = SessionReader(f['2024_10_18/session_001'])
+            self.assertEqual(reader.time_range(2.0, 3.0), (2, 4))
+            self.assertEqual(reader.time_range(), (0, 5))
+            self.assertEqual(reader.time_range(3.5), (5, 5))
+
+
+class ReadingsParamsTests(TestCase):
+
+    def test_non_finite_times_are_refused(self):
+        for name in ('start', 'end', 'last'):
+            for value in ('nan', 'inf', '-inf', 'Infinity'):
+                response = self.client.get(f'/api/files/capture.h5/readings/?{name}={value}')
+                self.assertEqual(response.status_code, 400, f'{name}={value}')
+
+    def test_finite_times_get_through(self):
+        # to the file lookup
+        response = self.client.get('/api/files/capture.h5/readings/?start=1.5e9&end=1.6e9&last=10')
+        self.assertEqual(response.status_code, 404)
+
+
+class LiveScansTests(SimpleTestCase):
+
+    def publish(self, live, timestamp):
+        angles = np.array([-3.0, -0.1, 0.1, 0.2, 3.0], dtype=np.float32)
+        distances = np.array([1.0, 2.0, 0.0, 4.0, 5.0], dtype=np.float32)
+        live.publish(timestamp, angles, distances, np.zeros(5, dtype=np.uint8))
+
+    def test_bins_keep_the_nearest_valid_point(self):
+        angles = np.array([-3.0, -0.1, 0.1, 0.2, 3.0], dtype=np.float32)
+        distances = np.array([1.0, 2.0, 0.0, 4.0, 5.0], dtype=np.float32)
+        centres, nearest = bin_scan(angles, distances, 4)
+        np.testing.assert_allclose(centres, [-3 * np.pi / 4, -np.pi / 4, np.pi / 4, 3 * np.pi / 4], rtol=1e-6)
+        # the zero distance is no reading, the second quarter has no point
+        np.testing.assert_array_equal(nearest, [1.0, 2.0, 4.0, 5.0])
+        self.assertTrue(np.isnan(bin_scan(angles, distances, 8)[1][2]))
+
+    def test_scans_are_only_kept_while_watched(self):
+        live = LiveScans()
+        self.publish(live, 1.0)
+        self.assertIsNone(live.event())
+
+        live.subscribe()
+        self.publish(live, 2.0)
+        seq, event = live.event(bins=4)
+        self.assertEqual(seq, 1)
+        self.assertIn(b'"timestamp":2.0', event)
+        # encoded once per bins setting
+        self.assertIs(live.event(bins=4)[1], event)
+        live.unsubscribe()
+        self.assertIsNone(live.event())
+
+    def test_viewer_rate(self):
+        live = LiveScans()
+        live.subscribe()
+        now = 100.0
+        with mock.patch('lidar_live.time.monotonic', side_effect=lambda: now):
+            viewer = _Viewer(live, rate=4)
+            sent = []
+            # an 8 Hz capture, the viewer looks twice per scan
+            for tick in range(40):
+                now = 100.0 + 0.0625 * tick
+                if tick % 2 == 0:
+                    self.publish(live, now)
+                event, _ = viewer.next_event()
+                if event is not None:
+                    sent.append(viewer.seen)
+        # every other scan, none twice
+        self.assertEqual(sent, list(range(1, 21, 2)))
+
+
+class SupervisorProtocolTests(SimpleTestCase):
+
+    @override_settings(SECRET_KEY='django-insecure-secret')
+    def test_tcp_needs_a_key_of_its_own(self):
+        for key in ('', 'django-insecure-secret'):
+            with self.assertRaises(ValueError):
+                supervisor.supervisor_key('0.0.0.0:6000', key)
+        self.assertEqual(supervisor.supervisor_key('0.0.0.0:6000', 'shared'), b'shared')
+        self.assertIsNone(supervisor.supervisor_key('/tmp/lidar.sock', ''))
+
+    def test_scan_round_trip(self):
+        sent = (1.5, np.arange(3, dtype=np.float32), np.arange(3, dtype=np.uint16), np.arange(3, dtype=np.uint8))
+        reader, writer = Pipe()
+        supervisor._send_scan(writer, sent)
+        received = supervisor._recv_scan(reader, supervisor._recv(reader))
+        self.assertEqual(received[0], 1.5)
+        for expected, array in zip(sent[1:], received[1:]):
+            np.testing.assert_array_equal(array, expected)
+            self.assertEqual(array.dtype, expected.dtype)
+
+    def test_commands_are_json(self):
+        class Local:
+            def status(self, device=None):
+                return {'device': device}
+
+        client, server = Pipe()
+        supervisor._send(client, ['status', ['front'], {}])
+        supervisor._serve_connection(server, Local())
+        self.assertEqual(supervisor._recv(client), ['ok', {'device': 'front'}])
+
+    def test_pickles_are_not_loaded(self):
+        client, server = Pipe()
+        client.send_bytes(pickle.dumps(('status', (), {})))
+        supervisor._serve_connection(server, None)
+        # dropped without a reply
+        self.assertRaises(EOFError, client.recv_bytes)
+
+
+class UpdateCsvTests(SimpleTestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp.cleanup)
+        self.h5_path = os.path.join(self.tmp.name, 'capture.h5')
+        self.csv_path = os.path.join(self.tmp.name, 'capture.csv')
+        open(self.csv_path, 'wb').close()
+
+    def update(self, converted):
+        with open(self.csv_path, 'r+b') as csv_file:
+            return update_csv(self.h5_path, csv_file, converted)
+
+    def read(self):
+        with open(self.csv_path) as csv_file:
+            return csv_file.read().splitlines()
+
+    def test_appends_what_the_file_gained(self):
+        _record(self.h5_path, '2024_10_17/session_001', [10.0, 11.0], [2, 1])
+        converted, rows = self.update(None)
+        self.assertEqual(rows, 3)
+        self.assertEqual(self.read(), [
+            'Timestamp,Angle,Distance',
+            '10.000000,0.000000,0.000000',
+            '10.000000,1.000000,2.000000',
+            '11.000000,2.000000,4.000000',
+        ])
+
+        # the session records on, and a new one starts
+        _record(self.h5_path, '2024_10_17/session_001', [12.0], [1])
+        _record(self.h5_path, '2024_10_17/session_002', [20.0], [2])
+        converted, rows = self.update(converted)
+        self.assertEqual(rows, 3)
+        self.assertEqual(self.read()[4:], [
+            '12.000000,3.000000,6.000000',
+            '20.000000,0.000000,0.000000',
+            '20.000000,1.000000,2.000000',
+        ])
+        self.assertEqual([(session['session'], session['rows']) for session in converted],
+                         [('2024_10_17/session_001', 4), ('2024_10_17/session_002', 2)])
+        # nothing new
+        self.assertEqual(self.update(converted), (converted, 0))
+        self.assertEqual(len(self.read()), 7)
+
+    def test_converts_a_changed_session_again(self):
+        _record(self.h5_path, '2024_10_17/session_001', [10.0, 11.0], [2, 1])
+        converted, _ = self.update(None)
+        converted[0]['last_timestamp'] = 1.0
+        _, rows = self.update(converted)
+        self.assertEqual(rows, 3)
+        self.assertEqual(len(self.read()), 4)
+
+
+@mock.patch('controller.downloads.available_encodings', return_value=['zstd', 'gzip'])
+class NegotiateEncodingTests(SimpleTestCase):
+
+    def test_no_header(self, _):
+        self.assertIsNone(negotiate_encoding(None))
+        self.assertIsNone(negotiate_encoding(''))
+        self.assertIsNone(negotiate_encoding('identity, br'))
+
+    def test_server_preference_breaks_ties(self, _):
+        self.assertEqual(negotiate_encoding('gzip, deflate, zstd'), 'zstd')
+        self.assertEqual(negotiate_encoding('GZIP'), 'gzip')
+
+    def test_qualities(self, _):
+        self.assertEqual(negotiate_encoding('zstd;q=0.5, gzip'), 'gzip')
+        self.assertEqual(negotiate_encoding('zstd ; q=0.9, gzip;q=0.8'), 'zstd')
+        self.assertIsNone(negotiate_encoding('gzip;q=0'))
+        self.assertIsNone(negotiate_encoding('gzip;q=high'))
+
+    def test_wildcard(self, _):
+        self.assertEqual(negotiate_encoding('*'), 'zstd')
+        self.assertEqual(negotiate_encoding('zstd;q=0, *;q=0.1'), 'gzip')
+
+    def test_without_zstandard(self, available_encodings):
+        available_encodings.return_value = ['gzip']
+        self.assertEqual(negotiate_encoding('zstd, gzip;q=0.1'), 'gzip')
+        self.assertIsNone(negotiate_encoding('zstd'))
+
+
+class GzipUpdateCsvTests(UpdateCsvTests):
+
+    def setUp(self):
+        super().setUp()
+        self.csv_path += '.gz'
+        open(self.csv_path, 'wb').close()
+
+    def update(self, converted):
+        with open(self.csv_path, 'r+b') as raw:
+            csv_file = GzipMembers(raw)
+            converted, rows = update_csv(self.h5_path, csv_file, converted)
+            csv_file.flush()
+        return converted, rows
+
+    def read(self):
+        with gzip.open(self.csv_path, 'rt') as csv_file:
+            return csv_file.read().splitlines()
+
+    def test_appends_gzip_members(self):
+        _record(self.h5_path, '2024_10_17/session_001', [10.0, 11.0], [2, 1])
+        converted, _ = self.update(None)
+        first_member = os.path.getsize(self.csv_path)
+
+        _record(self.h5_path, '2024_10_17/session_001', [12.0], [1])
+        self.assertEqual(self.update(converted)[1], 1)
+        # the new rows are a gzip member after the first one, which is kept as it is
+        with open(self.csv_path, 'rb') as raw:
+            self.assertEqual(raw.read(2), b'\x1f\x8b')
+            raw.seek(first_member)
+            self.assertEqual(raw.read(2), b'\x1f\x8b')
+        self.assertEqual(self.read()[-1], '12.000000,3.000000,6.000000')
+
+
+class WritingFileTests(SimpleTestCase):
+
+    def test_write_lock_is_seen_without_opening_the_file(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'capture.h5')
+            self.assertFalse(is_being_written(path))
+            with writing_file(path):
+                self.assertTrue(is_being_written(path))
+                self.assertTrue(is_being_written(os.path.join(directory, '.', 'capture.h5')))
+                self.assertFalse(is_being_written(os.path.join(directory, 'other.h5')))
+            self.assertFalse(is_being_written(path))
+            # never created by the check
+            self.assertFalse(os.path.exists(path))
@@ -5,6 +5,7 @@ from . import views
 router = DefaultRouter()
 router.register(f'files', views.LidarFileViewSet)
 router.register(r'lidar', views.LidarViewSet, basename='lidar')
+router.register(r'jobs', views.JobViewSet)
 
 urlpatterns = [
     path('', include(router.urls)),
@@ -1,24 +1,50 @@
 from django.shortcuts import render, HttpResponse
 from django.core.files.storage import default_storage
-from django.http import JsonResponse
+from django.http import JsonResponse, StreamingHttpResponse
+from django.core.handlers.asgi import ASGIRequest
 from django.conf import settings
 from django.core.files import File
-from django.core.cache import cache
 from django.core.files.base import ContentFile
+from django.db.models import Count, Exists, Max, Min, OuterRef, Sum
 
 from rest_framework import viewsets
 from rest_framework import status
 from rest_framework import response
 from rest_framework.response import Response
 from rest_framework.decorators import action
-from drf_spectacular.utils import extend_schema, OpenApiParameter
+from rest_framework.renderers import JSONRenderer, BrowsableAPIRenderer
+from drf_spectacular.utils import extend_schema, OpenApiParameter, OpenApiResponse
 
-from .models import LidarFile
-from .serializers import LidarFileSerializer
+from .models import LidarFile, LidarSession, Job, CsvConversion
+from .serializers import LidarFileSerializer, LidarSessionSerializer, JobSerializer, StorageOptionsSerializer
+from .downloads import file_download_response
+from .renderers import BinaryRenderer, EventStreamRenderer
+from .pagination import FilePagination, SessionPagination
+from .sessions import parse_time
+from .conversions import is_current, export_format, export_sources, parse_day
+from .supervisor import capture_backend, SupervisorUnavailable
+from .rolling import series_prefix
+from . import jobs, tasks
 # imported through path (look at init.py)
-from lidar_control import start_lidar, stop_lidar
+from lidar_control import CaptureError, DROP_POLICIES
+from lidar_live import MAX_BINS, iter_events, aiter_events
+from lidar_export import EXPORT_FORMATS
+from lidar_metrics import CONTENT_TYPE as METRICS_CONTENT_TYPE, expose as expose_metrics
+from lidar_storage import storage_options, write_storage_defaults, open_file
+from lidar_query import (
+    MAX_QUERY_POINTS, RESOLUTIONS, RAW_RESOLUTION, find_session, read_window, window_columns, encode_window,
+    window_to_json,
+)
 
-import h5py, os, csv
+import h5py, os, csv, math
+
+# Content-Type of downloaded exports, HDF5 for everything else
+EXPORT_CONTENT_TYPES = {
+    'csv': 'text/csv',
+    'parquet': 'application/vnd.apache.parquet',
+    'arrow': 'application/vnd.apache.arrow.file',
+    'npy': 'application/octet-stream',
+}
 
 def index(req):
     """
@@ -32,17 +58,104 @@ def index(req):
         return JsonResponse({'status': 'Error starting Lidar process', 'error': str(e)}, status=500)
 
 
+def metrics(req):
+    """
+    Capture, conversion, ingestion and job metrics of this process in the Prometheus text format.
+    The capture metrics come from the capture supervisor when there is one.
+    """
+    backend = capture_backend()
+    if backend.remote:
+        try:
+            names, text = backend.metrics()
+            return HttpResponse(text + expose_metrics(exclude=names), content_type=METRICS_CONTENT_TYPE)
+        except SupervisorUnavailable:
+            pass
+    return HttpResponse(expose_metrics(), content_type=METRICS_CONTENT_TYPE)
+
+
 class LidarFileViewSet(viewsets.ModelViewSet):
     queryset = LidarFile.objects.all()
     serializer_class = LidarFileSerializer
     lookup_field = 'filename'
+    # filenames carry an extension, the default pattern stops at the first dot
+    lookup_value_regex = '[^/]+'
+    pagination_class = FilePagination
+
+    def get_queryset(self):
+        # session totals come from the session index, no file is opened
+        return LidarFile.objects.annotate(
+            session_count=Count('sessions'),
+            point_count=Sum('sessions__point_count'),
+            bytes=Sum('sessions__bytes'),
+            start_time=Min('sessions__start_time'),
+            end_time=Max('sessions__end_time'),
+        )
+
+    def filter_sessions(self, sessions):
+        """
+        Applies the `day`, `device`, `start` and `end` query parameters to a `LidarSession` queryset.
 
+        :raises ValueError: For invalid times.
+        """
+        params = self.request.query_params
+        if params.get('day'):
+            sessions = sessions.filter(day=params['day'].replace('-', '_'))
+        if params.get('device'):
+            sessions = sessions.filter(device=params['device'])
+        # sessions overlapping [start, end)
+        if params.get('start'):
+            sessions = sessions.filter(end_time__gte=parse_time(params['start']))
+        if params.get('end'):
+            sessions = sessions.filter(start_time__lt=parse_time(params['end']))
+        return sessions
+
+    @extend_schema(
+        parameters=[
+            OpenApiParameter('filename', str, description='Part of the filename'),
+            OpenApiParameter('day', str, description='Only files with a session on this day, e.g. 2024_10_08'),
+            OpenApiParameter('device', str, description='Only files with a session recorded by this device'),
+            OpenApiParameter('start', str, description='Only files with readings at or after this time (epoch seconds or ISO 8601)'),
+            OpenApiParameter('end', str, description='Only files with readings before this time (epoch seconds or ISO 8601)'),
+            OpenApiParameter('page_size', int, description='Page through the files, newest first, with cursor links'),
+        ],
+    )
+    def list(self, request, *args, **kwargs):
+        files = self.get_queryset()
+        params = request.query_params
+        if params.get('filename'):
+            files = files.filter(filename__icontains=params['filename'])
+        if any(params.get(name) for name in ('day', 'device', 'start', 'end')):
+            try:
+                sessions = self.filter_sessions(LidarSession.objects.filter(file=OuterRef('pk')))
+            except ValueError as e:
+                return Response({'error': str(e)}, status=status.HTTP_400_BAD_REQUEST)
+            files = files.filter(Exists(sessions))
+
+        page = self.paginate_queryset(files)
+        if page is not None:
+            return self.get_paginated_response(self.get_serializer(page, many=True).data)
+        return Response(self.get_serializer(files, many=True).data)
+
+    @extend_schema(request=StorageOptionsSerializer)
     def create(self, request, *args, **kwargs):
         filename = request.data.get('filename', 'linear_data.h5')
         if not filename.endswith('.h5'):
             filename += '.h5'
+
+        # optional storage defaults for every session recorded into this file
+        storage = StorageOptionsSerializer(data=request.data, partial=True)
+        if not storage.is_valid():
+            return Response({'error': storage.errors}, status=status.HTTP_400_BAD_REQUEST)
+        try:
+            storage_options(**storage.validated_data)
+        except ValueError as e:
+            return Response({'error': str(e)}, status=status.HTTP_400_BAD_REQUEST)
+
         lidar_file = LidarFile(filename=filename) 
         lidar_file.file.save(filename, ContentFile(''), save=True)
+        if storage.validated_data:
+            with open_file(lidar_file.file.path, 'a') as f:
+                write_storage_defaults(f, storage.validated_data)
 
         return Response({
             'message': 'File created successfully',
@@ -53,21 +166,150 @@ class LidarFileViewSet(viewsets.ModelViewSet):
     def download(self, request, filename=None):
         try:
             file = LidarFile.objects.get(filename=filename)
-            with open(file.file.path, 'rb') as f:
-                if filename.endswith('.csv'):
-                    response = HttpResponse(f.read(), content_type='text/csv')
-                else:
-                    response = HttpResponse(f.read(), content_type='application/x-hdf')
-
-                response['Content-Disposition'] = f'attachment; filename={os.path.basename(file.file.path)}'
-                return response
-            
-            return Response({'message': 'compiled'}, status=status.HTTP_200_OK)
+            if filename.endswith('.gz'):
+                content_type = 'application/gzip'
+            else:
+                content_type = EXPORT_CONTENT_TYPES.get(export_format(filename), 'application/x-hdf')
+
+            # streamed from disk in blocks, supports resuming through Range; csv
+            # is compressed on the fly for clients sending Accept-Encoding
+            return file_download_response(request, file.file.path, content_type, compress=content_type == 'text/csv')
+        except LidarFile.DoesNotExist:
+            return Response({'error': f'File not found {filename}'}, status=status.HTTP_404_NOT_FOUND)
+        except Exception as e:
+            return Response({'error': str(e)}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
+
+    @extend_schema(
+        parameters=[
+            OpenApiParameter('session', str, description='day/session, e.g. 2024_10_08/session_001 (default: latest session)'),
+            OpenApiParameter('start', float, description='Epoch seconds, inclusive (default: session start)'),
+            OpenApiParameter('end', float, description='Epoch seconds, exclusive (default: session end)'),
+            OpenApiParameter('last', float, description='Seconds before the last reading of the session, replaces start'),
+            OpenApiParameter('limit', int, description=f'Maximum points returned, at most {MAX_QUERY_POINTS}'),
+            OpenApiParameter(
+                'resolution', str, enum=RESOLUTIONS,
+                description='raw points (default), a min/mean/max overview level, or auto: the finest that fits limit'
+            ),
+            OpenApiParameter('format', str, enum=['json', 'binary']),
+        ],
+        responses={
+            200: {'description': 'Readings of the window, as JSON columns or as raw little-endian columns (binary)'},
+            400: {'description': 'Invalid parameter or not an HDF5 file'},
+            404: {'description': 'File or session not found'},
+        },
+    )
+    @action(detail=True, methods=['get'], url_path='readings',
+            renderer_classes=[JSONRenderer, BrowsableAPIRenderer, BinaryRenderer])
+    def readings(self, request, filename=None):
+        if not filename.endswith('.h5'):
+            return Response({'error': 'filename not HDF5 file type'}, status=status.HTTP_400_BAD_REQUEST)
+
+        params = request.query_params
+        try:
+            window = {
+                name: float(params[name]) for name in ('start', 'end', 'last') if params.get(name)
+            }
+            window['limit'] = int(params.get('limit') or MAX_QUERY_POINTS)
+            # float() takes nan and inf, which make no window
+            if not all(math.isfinite(value) for value in window.values()):
+                raise ValueError
+            if not 0 < window['limit'] <= MAX_QUERY_POINTS or window.get('last', 0) < 0:
+                raise ValueError
+        except ValueError:
+            return Response(
+                {'error': f'start, end and last must be finite numbers, limit between 1 and {MAX_QUERY_POINTS}'},
+                status=status.HTTP_400_BAD_REQUEST
+            )
+        window['resolution'] = params.get('resolution') or RAW_RESOLUTION
+        if window['resolution'] not in RESOLUTIONS:
+            return Response(
+                {'error': f"resolution must be one of {', '.join(RESOLUTIONS)}"}, status=status.HTTP_400_BAD_REQUEST
+            )
+
+        try:
+            file = LidarFile.objects.get(filename=filename)
+            with open_file(file.file.path) as f:
+                session, session_group = find_session(f, params.get('session'))
+                result = read_window(session_group, **window)
         except LidarFile.DoesNotExist:
             return Response({'error': f'File not found {filename}'}, status=status.HTTP_404_NOT_FOUND)
+        except KeyError as e:
+            return Response({'error': e.args[0]}, status=status.HTTP_404_NOT_FOUND)
         except Exception as e:
             return Response({'error': str(e)}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
 
+        if request.accepted_renderer.format == BinaryRenderer.format:
+            response = Response(encode_window(result), status=status.HTTP_200_OK)
+            response['X-Lidar-Session'] = session
+            response['X-Lidar-Resolution'] = result['resolution']
+            response['X-Lidar-Count'] = result['count']
+            response['X-Lidar-Columns'] = ','.join(f'{name}:{dtype}' for name, dtype in window_columns(result))
+            response['X-Lidar-Truncated'] = str(result['truncated']).lower()
+            if result['next_start'] is not None:
+                response['X-Lidar-Next-Start'] = repr(result['next_start'])
+            return response
+
+        return Response({
+            'session': session,
+            'layout': result['layout'],
+            'resolution': result['resolution'],
+            'count': result['count'],
+            'truncated': result['truncated'],
+            'next_start': result['next_start'],
+            'readings': window_to_json(result),
+        }, status=status.HTTP_200_OK)
+
+    @extend_schema(
+        parameters=[
+            OpenApiParameter('day', str, description='Only sessions of this day, e.g. 2024_10_08'),
+            OpenApiParameter('device', str, description='Only sessions recorded by this device'),
+            OpenApiParameter('start', str, description='Only sessions with readings at or after this time (epoch seconds or ISO 8601)'),
+            OpenApiParameter('end', str, description='Only sessions with readings before this time (epoch seconds or ISO 8601)'),
+            OpenApiParameter('page_size', int, description='Page through the sessions, oldest first, with cursor links'),
+        ],
+        responses={
+            200: LidarSessionSerializer(many=True),
+            400: {'description': 'Invalid time'},
+            404: {'description': 'File not found'},
+        },
+    )
+    @action(detail=True, methods=['get'], url_path='sessions')
+    def sessions(self, request, filename=None):
+        try:
+            file = LidarFile.objects.get(filename=filename)
+            sessions = self.filter_sessions(file.sessions.all())
+        except LidarFile.DoesNotExist:
+            return Response({'error': f'File not found {filename}'}, status=status.HTTP_404_NOT_FOUND)
+        except ValueError as e:
+            return Response({'error': str(e)}, status=status.HTTP_400_BAD_REQUEST)
+
+        paginator = SessionPagination()
+        page = paginator.paginate_queryset(sessions, request, view=self)
+        if page is not None:
+            return paginator.get_paginated_response(LidarSessionSerializer(page, many=True).data)
+        return Response(LidarSessionSerializer(sessions.order_by('day', 'name'), many=True).data)
+
+    @extend_schema(
+        request={
+            'application/json': {
+                'type': 'object',
+                'properties': {
+                    'filename': {'type': 'string', 'description': 'HDF5 file to convert'},
+                    'format': {'type': 'string', 'enum': tuple(EXPORT_FORMATS), 'description': 'Export format, csv by default'},
+                    'compression': {'type': 'string', 'enum': ['gzip'], 'description': 'Write a gzip compressed csv (.csv.gz)'},
+                    'csvfilename': {'type': 'string', 'description': 'Name of the export, the HDF5 name with the extension of the format by default'},
+                },
+                'required': ['filename'],
+            },
+        },
+        responses={
+            200: {'description': 'Conversion up to date, nothing queued'},
+            202: {'description': 'Conversion queued'},
+            400: {'description': 'Bad request. Filename not provided or not HDF5, unknown format or csv filename already exists'},
+            404: {'description': 'File not found'},
+            500: {'description': 'Internal server error'},
+        },
+    )
     @action(detail=False, methods=['post'], url_path="convert-to-csv", url_name="convert-to-csv")
     def convert_to_csv(self, request):
         filename = request.data.get('filename')
@@ -78,97 +320,402 @@ class LidarFileViewSet(viewsets.ModelViewSet):
         if not filename.endswith('.h5'):
             return Response({'error': 'filename not HDF5 file type'}, status=status.HTTP_400_BAD_REQUEST)
         
-        csv_filename = request.data.get('csvfilename', filename.replace('.h5','.csv'))
-        if LidarFile.objects.filter(filename=csv_filename).exists():
-            return Response({'error': 'csv filename already exists'}, status=status.HTTP_400_BAD_REQUEST)
-        
+        format = request.data.get('format', 'csv')
+        if format not in EXPORT_FORMATS:
+            return Response({'error': f"format must be one of {', '.join(EXPORT_FORMATS)}"}, status=status.HTTP_400_BAD_REQUEST)
+
+        compression = request.data.get('compression') or None
+        if compression not in (None, 'gzip') or (compression and format != 'csv'):
+            return Response({'error': 'compression must be gzip, for the csv format'}, status=status.HTTP_400_BAD_REQUEST)
+
+        extension = EXPORT_FORMATS[format] + ('.gz' if compression else '')
+        csv_filename = request.data.get('csvfilename', filename.replace('.h5', extension))
+        # the format of an existing export is known from its extension
+        gzipped = csv_filename.endswith('.gz')
+        if (export_format(csv_filename) or 'csv') != format or (compression and not gzipped) or (gzipped and format != 'csv'):
+            return Response({'error': f'csvfilename must end with {extension}'}, status=status.HTTP_400_BAD_REQUEST)
+
         try:
             h5_lidar_file = LidarFile.objects.get(filename=filename)
-            self.convert_hdf5_to_csv(h5_lidar_file.file.path, csv_filename)
 
-            return Response({'message':f'Successfully converted file'}, status=status.HTTP_200_OK)
+            csv_lidar_file = LidarFile.objects.filter(filename=csv_filename).first()
+            if csv_lidar_file is None:
+                # reserve the csv name now, the conversion itself runs as a background job
+                csv_lidar_file = LidarFile(filename=csv_filename)
+                csv_lidar_file.file.save(csv_filename, ContentFile(''), save=True)
+                conversion = CsvConversion.objects.create(csv_file=csv_lidar_file, source=h5_lidar_file)
+            else:
+                # converting the same file again only converts what it gained since
+                conversion = CsvConversion.objects.filter(csv_file=csv_lidar_file).first()
+                if conversion is None or conversion.source_id != h5_lidar_file.id:
+                    return Response({'error': 'csv filename already exists'}, status=status.HTTP_400_BAD_REQUEST)
+
+                pending = Job.objects.filter(
+                    kind='convert_csv', state__in=(Job.QUEUED, Job.RUNNING), params__csv_file_id=csv_lidar_file.id,
+                ).first()
+                if pending is not None:
+                    return Response({'message': 'Conversion queued', 'job_id': pending.id}, status=status.HTTP_202_ACCEPTED)
+                if is_current(conversion):
+                    return Response({
+                        'message': 'Conversion up to date',
+                        'filename': csv_filename,
+                        'rows': conversion.rows,
+                    }, status=status.HTTP_200_OK)
+
+            job = jobs.submit('convert_csv', {
+                'h5_file_id': h5_lidar_file.id,
+                'csv_file_id': csv_lidar_file.id,
+            })
+            return Response({'message': 'Conversion queued', 'job_id': job.id}, status=status.HTTP_202_ACCEPTED)
         except LidarFile.DoesNotExist:
             return Response({'error': 'File not found'}, status=status.HTTP_404_NOT_FOUND)
         except Exception as e:
             return Response({'error': str(e) }, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
 
-    def convert_hdf5_to_csv(self, h5_file_path, csv_filename):
-        """
-        Converts the HDF5 file at `h5_file_path` into a CSV file at `csv_file_path`.
-        """
-        new_lidar_csv_file = LidarFile(filename=csv_filename) 
-        new_lidar_csv_file.file.save(csv_filename, ContentFile(''), save=True)
-
-        with open(new_lidar_csv_file.file.path, 'w', newline='') as csvfile:
-            csv_writer = csv.writer(csvfile)
-            csv_writer.writerow(['Timestamp', 'Angle', 'Distance'])
-
-            # Open the HDF5 file and extract the data (adjust according to the structure)
-            with h5py.File(h5_file_path, 'r') as f:
-                for day_group_name in f.keys():
-                    day_group = f[day_group_name]
-                    for session_name in day_group:
-                        session_group = day_group[session_name]
-                        readings = session_group['readings']
-
-                        timestamps = readings['timestamp'][:]
-                        angles = readings['angle'][:]
-                        distances = readings['distance'][:]
-
-                        # Write each row to the CSV file
-                        for timestamp, angle, distance in zip(timestamps, angles, distances):
-                            csv_writer.writerow([timestamp, angle, distance])
-
-class LidarViewSet(viewsets.ViewSet):
-
     @extend_schema(
         request={
             'application/json': {
                 'type': 'object',
                 'properties': {
-                    'filename': {'type': 'string', 'description': 'Name of the file to start Lidar'},
+                    'filenames': {
+                        'type': 'array', 'items': {'type': 'string'},
+                        'description': 'HDF5 files exported in this order, every file with sessions in the days when left out',
+                    },
+                    'start_day': {'type': 'string', 'description': 'First day exported, YYYY-MM-DD'},
+                    'end_day': {'type': 'string', 'description': 'Last day exported, YYYY-MM-DD'},
+                    'csvfilename': {'type': 'string', 'description': 'Name of the csv file created'},
+                    'workers': {'type': 'integer', 'description': 'Conversion processes, LIDAR_EXPORT_WORKERS by default'},
+                    'compression': {'type': 'string', 'enum': ['gzip'], 'description': 'Write a gzip compressed csv (.csv.gz)'},
                 },
-                'required': ['filename'],
             },
         },
         responses={
-            200: {'description': 'Lidar started successfully'},
-            400: {'description': 'Bad request. Filename not provided or Lidar already running'},
+            202: {'description': 'Export queued'},
+            400: {'description': 'Bad request. No files or days, invalid day, nothing to export or csv filename already exists'},
             404: {'description': 'File not found'},
-            500: {'description': 'Internal server error'}
+            500: {'description': 'Internal server error'},
         },
     )
-    @action(detail=False, methods=['post'])
-    def start(self, request):
-        if cache.get('lidar_running'):
-            return Response({"error": "Lidar is already running"}, status=status.HTTP_400_BAD_REQUEST)
-        cache.set('lidar_running', True)
+    @action(detail=False, methods=['post'], url_path="export-csv", url_name="export-csv")
+    def export_csv(self, request):
+        filenames = request.data.get('filenames') or []
+        if isinstance(filenames, str):
+            filenames = [filenames]
+
         try:
-            filename = request.data.get('filename')
-            if not filename:
-                return Response({"error": f"Filename not {provided}"}, status=status.HTTP_400_BAD_REQUEST)
-            if not LidarFile.objects.filter(filename=filename).exists():
-                return Response({"error": f"File does not exist"}, status=status.HTTP_404_NOT_FOUND)
-            start_lidar(filename, os.path.join(settings.MEDIA_ROOT, 'lidar_files', filename))
-            return Response({"message": f"Lidar started successfully"}, status=status.HTTP_200_OK)
+            first_day = parse_day(request.data.get('start_day'))
+            last_day = parse_day(request.data.get('end_day'))
+            workers = int(request.data.get('workers') or 0)
+        except ValueError as e:
+            return Response({'error': str(e)}, status=status.HTTP_400_BAD_REQUEST)
+        if not filenames and not (first_day or last_day):
+            return Response({'error': 'filenames or start_day/end_day not provided'}, status=status.HTTP_400_BAD_REQUEST)
+        if workers < 0:
+            return Response({'error': 'workers must be positive'}, status=status.HTTP_400_BAD_REQUEST)
+
+        compression = request.data.get('compression') or None
+        if compression not in (None, 'gzip'):
+            return Response({'error': 'compression must be gzip'}, status=status.HTTP_400_BAD_REQUEST)
+
+        extension = '.csv.gz' if compression else '.csv'
+        csv_filename = request.data.get('csvfilename') or f"export_{first_day or 'start'}_{last_day or 'end'}{extension}"
+        if LidarFile.objects.filter(filename=csv_filename).exists():
+            return Response({'error': 'csv filename already exists'}, status=status.HTTP_400_BAD_REQUEST)
+
+        try:
+            h5_lidar_files = export_sources(filenames, first_day, last_day)
+            if not h5_lidar_files:
+                return Response({'error': 'No sessions recorded in these days'}, status=status.HTTP_400_BAD_REQUEST)
+
+            csv_lidar_file = LidarFile(filename=csv_filename)
+            csv_lidar_file.file.save(csv_filename, ContentFile(''), save=True)
+
+            job = jobs.submit('export_csv', {
+                'h5_file_ids': [lidar_file.id for lidar_file in h5_lidar_files],
+                'csv_file_id': csv_lidar_file.id,
+                'first_day': first_day,
+                'last_day': last_day,
+                'workers': workers or None,
+            })
+            return Response({'message': 'Export queued', 'job_id': job.id}, status=status.HTTP_202_ACCEPTED)
+        except LidarFile.DoesNotExist as e:
+            return Response({'error': str(e)}, status=status.HTTP_404_NOT_FOUND)
+        except ValueError as e:
+            return Response({'error': str(e)}, status=status.HTTP_400_BAD_REQUEST)
         except Exception as e:
-            return Response({"error": str(e)}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
+            return Response({'error': str(e) }, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
+
+
+class JobViewSet(viewsets.ReadOnlyModelViewSet):
+    """
+    Status of the background jobs queued by convert-to-csv, export-csv and ingest-csv.
+    """
+    queryset = Job.objects.order_by('-created_at')
+    serializer_class = JobSerializer
+
+DEVICE_PARAMETER = OpenApiParameter('device', str, OpenApiParameter.PATH, description='Name of a configured LiDAR device')
+
+# shared by the default device routes (/lidar/start/) and the per-device ones (/lidar/{device}/start/)
+start_schema = extend_schema(
+    request={
+        'application/json': {
+            'type': 'object',
+            'properties': {
+                'filename': {'type': 'string', 'description': 'Name of the file to start Lidar, the name of the series of a rolling capture'},
+                'drop_policy': {
+                    'type': 'string',
+                    'enum': list(DROP_POLICIES),
+                    'description': 'What to do with new scans when the writer falls behind (default drop_newest)',
+                },
+                'queue_size': {'type': 'integer', 'description': 'Scans buffered between the device and the writer'},
+                'batch_scans': {'type': 'integer', 'description': 'Scans appended to the file per write'},
+                'rate': {'type': 'number', 'description': 'Scans per second to record, omit for the full device rate'},
+                'every': {'type': 'integer', 'description': 'Record one scan out of every N read from the device'},
+                'chunk_points': {'type': 'integer', 'description': 'Points per HDF5 chunk'},
+                'compression': {'type': 'string', 'enum': ['gzip', 'lzf', 'none']},
+                'compression_level': {'type': 'integer', 'description': 'gzip level 0-9'},
+                'shuffle': {'type': 'boolean', 'description': 'Byte shuffle filter before compression'},
+                'quantize': {'type': 'boolean', 'description': 'Store distance as uint16 mm and angle as int16 0.1 mrad'},
+                'rotate_mb': {'type': 'number', 'description': 'Rolling capture: move on to a new file once the current one reaches this size'},
+                'rotate_seconds': {'type': 'number', 'description': 'Rolling capture: move on to a new file after this long'},
+                'budget_mb': {'type': 'number', 'description': 'Rolling capture: delete the oldest files to keep the series within this size'},
+                'ingest_runname': {'type': 'string', 'description': 'Rolling capture: ingest every finished file into Sift under this run name, only ingested files are deleted'},
+            },
+            'required': ['filename'],
+        },
+    },
+    responses={
+        200: {'description': 'Lidar started successfully'},
+        400: {'description': 'Bad request. Filename not provided, invalid option, Lidar already running or file recorded by another device'},
+        404: {'description': 'File or device not found'},
+        500: {'description': 'Internal server error'},
+        503: {'description': 'Capture supervisor unavailable'},
+    },
+)
+stop_schema = extend_schema(
+    responses={
+        200: {'description': "Lidar stopped successfully"},
+        400: {'description': "Bad request. Lidar already stopped"},
+        404: {'description': 'Device not found'},
+        503: {'description': 'Capture supervisor unavailable'},
+    }
+)
+status_schema = extend_schema(
+    responses={
+        200: {'description': "Counters of the current (or last) capture: scans read, captured, written and dropped, queue depth, and the achieved device/capture/write rates in scans per second"},
+        404: {'description': 'Device not found'},
+        503: {'description': 'Capture supervisor unavailable'},
+    }
+)
+live_schema = extend_schema(
+    parameters=[
+        OpenApiParameter('rate', float, description='Maximum scans per second sent to this client (default: every scan)'),
+        OpenApiParameter('bins', int, description=f'Reduce each scan to the nearest distance in this many angular bins, 1-{MAX_BINS} (default: every point)'),
+    ],
+    responses={
+        200: {'description': 'text/event-stream of `scan` events with the latest scans of the running capture'},
+        400: {'description': 'Invalid rate or bins'},
+        404: {'description': 'Device not found'},
+        503: {'description': 'Capture supervisor unavailable'},
+    },
+)
+
+
+class LidarViewSet(viewsets.ViewSet):
+    """
+    Captures of the configured LiDAR devices (see `lidar_control.device_configs`).
+    `/lidar/start/`, `/lidar/stop/`, `/lidar/status/` and `/lidar/live/` act on
+    the default device, `/lidar/{device}/...` on any of them. The captures run
+    in this process or in the capture supervisor, see `controller.supervisor`.
+    """
+    lookup_field = 'device'
+    lookup_value_regex = '[A-Za-z0-9_-]+'
 
     @extend_schema(
         responses={
-            200: {'description': "Lidar stopped successfully"},
-            400: {'description': "Bad request. Lidar already stopped"}
+            200: OpenApiResponse(description='Status of every configured device, default device first'),
+            503: OpenApiResponse(description='Capture supervisor unavailable'),
         }
     )
+    def list(self, request):
+        try:
+            return Response(capture_backend().devices(), status=status.HTTP_200_OK)
+        except SupervisorUnavailable as e:
+            return Response({"error": str(e)}, status=status.HTTP_503_SERVICE_UNAVAILABLE)
+
+    @start_schema
+    @action(detail=False, methods=['post'])
+    def start(self, request):
+        return self.start_capture(request)
+
+    @start_schema
+    @extend_schema(operation_id='lidar_device_start', parameters=[DEVICE_PARAMETER])
+    @action(detail=True, methods=['post'], url_path='start', url_name='device-start')
+    def device_start(self, request, device=None):
+        return self.start_capture(request, device)
+
+    @stop_schema
     @action(detail=False, methods=['get'])
     def stop(self, request):
-        if not cache.get('lidar_running'):
-            return Response({"error": "Lidar is already stopped"}, status=status.HTTP_400_BAD_REQUEST)
-        cache.set('lidar_running', False)
+        return self.stop_capture(request)
+
+    @stop_schema
+    @extend_schema(operation_id='lidar_device_stop', parameters=[DEVICE_PARAMETER], request=None)
+    @action(detail=True, methods=['post'], url_path='stop', url_name='device-stop')
+    def device_stop(self, request, device=None):
+        return self.stop_capture(request, device)
+
+    @status_schema
+    @action(detail=False, methods=['get'], url_path='status')
+    def capture_status(self, request):
+        return self.status_response(request)
+
+    @status_schema
+    @extend_schema(operation_id='lidar_device_status', parameters=[DEVICE_PARAMETER])
+    @action(detail=True, methods=['get'], url_path='status', url_name='device-status')
+    def device_status(self, request, device=None):
+        return self.status_response(request, device)
+
+    @live_schema
+    @action(detail=False, methods=['get'], url_path='live',
+            renderer_classes=[EventStreamRenderer, JSONRenderer])
+    def live(self, request):
+        return self.live_events(request)
+
+    @live_schema
+    @extend_schema(operation_id='lidar_device_live', parameters=[DEVICE_PARAMETER])
+    @action(detail=True, methods=['get'], url_path='live', url_name='device-live',
+            renderer_classes=[EventStreamRenderer, JSONRenderer])
+    def device_live(self, request, device=None):
+        return self.live_events(request, device)
+
+    def status_response(self, request, device=None):
         try:
-            stop_lidar()  # Replace with your function to start the Lidar
-            cache.set('lidar_running', False)
-            return Response({"message": "Lidar stopped successfully"}, status=status.HTTP_200_OK)
+            return Response(capture_backend().status(device), status=status.HTTP_200_OK)
+        except KeyError as e:
+            return Response({"error": e.args[0]}, status=status.HTTP_404_NOT_FOUND)
+        except SupervisorUnavailable as e:
+            return Response({"error": str(e)}, status=status.HTTP_503_SERVICE_UNAVAILABLE)
+
+    def start_capture(self, request, device=None):
+        backend = capture_backend()
+        try:
+            if backend.status(device)['running']:
+                return Response({"error": "Lidar is already running"}, status=status.HTTP_400_BAD_REQUEST)
+        except KeyError as e:
+            return Response({"error": e.args[0]}, status=status.HTTP_404_NOT_FOUND)
+        except SupervisorUnavailable as e:
+            return Response({"error": str(e)}, status=status.HTTP_503_SERVICE_UNAVAILABLE)
+        try:
+            filename = request.data.get('filename')
+            if not filename:
+                return Response({"error": "Filename not provided"}, status=status.HTTP_400_BAD_REQUEST)
+
+            # a rolling capture records into new files named after `filename`, see controller.rolling
+            rolling = {
+                name: request.data[name]
+                for name in ('rotate_mb', 'rotate_seconds', 'budget_mb', 'ingest_runname')
+                if request.data.get(name) not in (None, '')
+            }
+            if rolling:
+                try:
+                    for name in ('rotate_mb', 'rotate_seconds', 'budget_mb'):
+                        if name in rolling:
+                            rolling[name] = float(rolling[name])
+                            if not rolling[name] > 0:
+                                raise ValueError
+                except (TypeError, ValueError):
+                    return Response({"error": "rotate_mb, rotate_seconds and budget_mb must be positive numbers"}, status=status.HTTP_400_BAD_REQUEST)
+                if 'rotate_mb' not in rolling and 'rotate_seconds' not in rolling:
+                    return Response({"error": "A rolling capture needs rotate_mb or rotate_seconds"}, status=status.HTTP_400_BAD_REQUEST)
+                if 'budget_mb' in rolling and rolling['budget_mb'] <= rolling.get('rotate_mb', 0):
+                    return Response({"error": "budget_mb must be larger than rotate_mb"}, status=status.HTTP_400_BAD_REQUEST)
+                try:
+                    series_prefix(filename)
+                except ValueError as e:
+                    return Response({"error": str(e)}, status=status.HTTP_400_BAD_REQUEST)
+            elif not LidarFile.objects.filter(filename=filename).exists():
+                return Response({"error": f"File does not exist"}, status=status.HTTP_404_NOT_FOUND)
+            if request.data.get('drop_policy', DROP_POLICIES[0]) not in DROP_POLICIES:
+                return Response({"error": f"drop_policy must be one of {', '.join(DROP_POLICIES)}"}, status=status.HTTP_400_BAD_REQUEST)
+
+            # optional capture rate and pipeline tuning, see lidar_control.start_lidar
+            options = {
+                name: request.data[name]
+                for name in ('drop_policy', 'queue_size', 'batch_scans', 'rate', 'every')
+                if request.data.get(name) is not None
+            }
+            try:
+                for name in ('queue_size', 'batch_scans', 'every'):
+                    if name in options:
+                        options[name] = int(options[name])
+                if 'rate' in options:
+                    options['rate'] = float(options['rate'])
+                if any(options[name] <= 0 for name in ('queue_size', 'batch_scans', 'rate', 'every') if name in options):
+                    raise ValueError
+            except (TypeError, ValueError):
+                return Response({"error": "rate, every, queue_size and batch_scans must be positive numbers"}, status=status.HTTP_400_BAD_REQUEST)
+
+            # storage overrides for the new session, on top of the file's defaults
+            storage = StorageOptionsSerializer(data=request.data, partial=True)
+            if not storage.is_valid():
+                return Response({"error": storage.errors}, status=status.HTTP_400_BAD_REQUEST)
+            try:
+                storage_options(**storage.validated_data)
+            except ValueError as e:
+                return Response({"error": str(e)}, status=status.HTTP_400_BAD_REQUEST)
+            options['storage'] = storage.validated_data
+            if rolling:
+                options['rolling'] = rolling
+
+            # the session's row in the session index follows the capture
+            name = backend.start(device, filename, **options)
+            return Response({"message": f"Lidar started successfully", "device": name}, status=status.HTTP_200_OK)
+        except CaptureError as e:
+            # running already, or the file is recorded by another device
+            return Response({"error": str(e)}, status=status.HTTP_400_BAD_REQUEST)
+        except SupervisorUnavailable as e:
+            return Response({"error": str(e)}, status=status.HTTP_503_SERVICE_UNAVAILABLE)
+        except Exception as e:
+            return Response({"error": str(e)}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
+
+    def stop_capture(self, request, device=None):
+        backend = capture_backend()
+        try:
+            if not backend.status(device)['running']:
+                return Response({"error": "Lidar is already stopped"}, status=status.HTTP_400_BAD_REQUEST)
+            name = backend.stop(device)
+            return Response({"message": "Lidar stopped successfully", "device": name}, status=status.HTTP_200_OK)
+        except KeyError as e:
+            return Response({"error": e.args[0]}, status=status.HTTP_404_NOT_FOUND)
+        except CaptureError as e:
+            return Response({"error": str(e)}, status=status.HTTP_400_BAD_REQUEST)
+        except SupervisorUnavailable as e:
+            return Response({"error": str(e)}, status=status.HTTP_503_SERVICE_UNAVAILABLE)
         except Exception as e:
             return Response({"error": str(e)}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
 
+    def live_events(self, request, device=None):
+        try:
+            live = capture_backend().live(device)
+        except KeyError as e:
+            return Response({"error": e.args[0]}, status=status.HTTP_404_NOT_FOUND)
+        except SupervisorUnavailable as e:
+            return Response({"error": str(e)}, status=status.HTTP_503_SERVICE_UNAVAILABLE)
+        try:
+            rate = float(request.query_params['rate']) if request.query_params.get('rate') else None
+            bins = int(request.query_params['bins']) if request.query_params.get('bins') else None
+            if (rate is not None and not rate > 0) or (bins is not None and not 0 < bins <= MAX_BINS):
+                raise ValueError
+        except ValueError:
+            return Response({"error": f"rate must be a positive number and bins between 1 and {MAX_BINS}"}, status=status.HTTP_400_BAD_REQUEST)
+
+        # viewers only read the latest scan the capture published, see lidar_live
+        if isinstance(request._request, ASGIRequest):
+            events = aiter_events(live, rate, bins)
+        else:
+            events = iter_events(live, rate, bins)
+        response = StreamingHttpResponse(events, content_type='text/event-stream')
+        response['Cache-Control'] = 'no-cache'
+        response['X-Accel-Buffering'] = 'no'
+        return response
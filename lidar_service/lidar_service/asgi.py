@@ -9,8 +9,14 @@ https://docs.djangoproject.com/en/5.1/howto/deployment/asgi/
 
 import os
 
+from django.conf import settings
 from django.core.asgi import get_asgi_application
 
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'lidar_service.settings')
 
 application = get_asgi_application()
+
+if settings.LIDAR_JOBS_IN_WEB:
+    from controller import jobs
+
+    jobs.start_workers()
@@ -40,6 +40,7 @@ INSTALLED_APPS = [
 
     # project apps
     'controller',
+    'sift_stack',
 
     # third party
     'rest_framework',
@@ -143,3 +144,31 @@ DEFAULT_AUTO_FIELD = 'django.db.models.BigAutoField'
 
 MEDIA_ROOT = os.path.join(BASE_DIR, 'media')
 MEDIA_URL = '/media/'
+
+# Background jobs (csv conversion, sift ingestion), see controller/jobs.py.
+# Maximum number of jobs running at once, keep it below the core count so
+# the capture thread always has a core to itself. A single process of the
+# system runs the jobs, the others only queue them.
+LIDAR_JOB_WORKERS = int(os.getenv('LIDAR_JOB_WORKERS', 1))
+
+# Whether the web workers run the jobs (the first one to start does), turn it
+# off to run them in `manage.py run_jobs` instead.
+LIDAR_JOBS_IN_WEB = os.getenv('LIDAR_JOBS_IN_WEB', 'true').lower() not in ('0', 'false', 'no')
+
+# Processes converting the sessions of a batch export (export-csv) in
+# parallel, all cores but one by default, see lidar_export.export_csv.
+LIDAR_EXPORT_WORKERS = int(os.getenv('LIDAR_EXPORT_WORKERS') or max(1, (os.cpu_count() or 1) - 1))
+
+# Free space a rolling capture always leaves on the media file system, it
+# deletes the oldest files of its series to keep it, see controller/rolling.py.
+LIDAR_ROLLING_RESERVE_MB = int(os.getenv('LIDAR_ROLLING_RESERVE_MB', 512))
+
+# Capture supervisor, see controller/supervisor.py. When set (a unix socket
+# path or host:port), `manage.py capture_supervisor` runs the captures and
+# every web worker controls them through it, which is needed as soon as
+# there is more than one web worker. When empty the captures run in the web
+# process itself.
+LIDAR_SUPERVISOR = os.getenv('LIDAR_SUPERVISOR', '')
+# Shared secret authenticating the web workers to the supervisor, required
+# (and distinct from SECRET_KEY) when it listens on a TCP host:port.
+LIDAR_SUPERVISOR_KEY = os.getenv('LIDAR_SUPERVISOR_KEY', '')
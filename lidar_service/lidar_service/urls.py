@@ -18,10 +18,13 @@ from django.contrib import admin
 from django.urls import path, include
 from drf_spectacular.views import SpectacularAPIView, SpectacularSwaggerView
 
+from controller.views import metrics
+
 urlpatterns = [
     path('admin/', admin.site.urls),
     path('api/', include("controller.urls")),
     path('api/sift-stack/', include("sift_stack.urls")),
+    path('metrics', metrics, name='metrics'),
 
     # third party
     path('api-auth/', include('rest_framework.urls')),
@@ -9,8 +9,14 @@ https://docs.djangoproject.com/en/5.1/howto/deployment/wsgi/
 
 import os
 
+from django.conf import settings
 from django.core.wsgi import get_wsgi_application
 
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'lidar_service.settings')
 
 application = get_wsgi_application()
+
+if settings.LIDAR_JOBS_IN_WEB:
+    from controller import jobs
+
+    jobs.start_workers()
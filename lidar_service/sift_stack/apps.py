@@ -4,3 +4,7 @@ from django.apps import AppConfig
 class SiftStackConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'sift_stack'
+
+    def ready(self):
+        # registers the job handlers of the app, see controller.jobs
+        from . import tasks  # noqa: F401
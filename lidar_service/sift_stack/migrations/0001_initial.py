@@ -0,0 +1,33 @@
+# Generated by Django 5.1.1 on 2026-10-18 19:04
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    initial = True
+
+    dependencies = [
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='IngestCheckpoint',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('filename', models.CharField(max_length=50)),
+                ('runname', models.CharField(max_length=100)),
+                ('sift_run_name', models.CharField(max_length=200)),
+                ('rows', models.BigIntegerField(default=0)),
+                ('timestamp', models.FloatField(blank=True, null=True)),
+                ('completed', models.BooleanField(default=False)),
+                ('source_mtime_ns', models.BigIntegerField(blank=True, null=True)),
+                ('source_size', models.BigIntegerField(blank=True, null=True)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+            ],
+            options={
+                'indexes': [models.Index(fields=['filename', 'runname'], name='sift_stack__filenam_4cba47_idx')],
+            },
+        ),
+    ]
@@ -1,3 +1,27 @@
 from django.db import models
 
 # Create your models here.
+
+class IngestCheckpoint(models.Model):
+    """
+    How far the ingestion of a file into a sift run got, a retried ingestion
+    with the same file and run name resumes from it instead of starting over,
+    as long as the file did not change since.
+    """
+    filename = models.CharField(max_length=50)
+    runname = models.CharField(max_length=100)
+    sift_run_name = models.CharField(max_length=200)
+    rows = models.BigIntegerField(default=0)
+    timestamp = models.FloatField(null=True, blank=True)
+    # modification time and size of the file when its ingestion started
+    source_mtime_ns = models.BigIntegerField(null=True, blank=True)
+    source_size = models.BigIntegerField(null=True, blank=True)
+    completed = models.BooleanField(default=False)
+    created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        indexes = [models.Index(fields=['filename', 'runname'])]
+
+    def __str__(self):
+        return f"{self.filename} -> {self.sift_run_name} ({self.rows} rows)"
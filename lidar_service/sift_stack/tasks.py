@@ -0,0 +1,49 @@
+import os
+from datetime import datetime
+
+from controller import jobs
+
+from csv_ingest import main as ingest_main, INGEST_BATCH_SIZE, INGEST_WORKERS
+from .models import IngestCheckpoint
+
+
+@jobs.register('ingest_csv')
+def ingest_csv(params, progress):
+    """
+    Ingests the csv or HDF5 file at `path` into a sift run named after `runname`.
+
+    An earlier ingestion of the same file and run name that did not finish is
+    resumed: its sift run is reused and the rows it already uploaded skipped.
+    Only while the file is unchanged since that ingestion started, a file
+    rewritten or recorded on is ingested into a new run.
+    """
+    stat = os.stat(params['path'])
+    stamp = {'source_mtime_ns': stat.st_mtime_ns, 'source_size': stat.st_size}
+    checkpoint = (
+        IngestCheckpoint.objects
+        .filter(filename=params['filename'], runname=params['runname'], completed=False, **stamp)
+        .order_by('-created_at')
+        .first()
+    )
+    if checkpoint is None:
+        checkpoint = IngestCheckpoint.objects.create(
+            filename=params['filename'],
+            runname=params['runname'],
+            sift_run_name=f"{params['runname']}-{datetime.now()}",
+            **stamp,
+        )
+
+    def save_checkpoint(rows, timestamp):
+        IngestCheckpoint.objects.filter(pk=checkpoint.pk).update(rows=rows, timestamp=timestamp)
+
+    result = ingest_main(
+        params['filename'], params['runname'], params['path'],
+        progress=progress,
+        batch_size=params.get('batch_size') or INGEST_BATCH_SIZE,
+        workers=params.get('workers') or INGEST_WORKERS,
+        run_name=checkpoint.sift_run_name,
+        start_row=checkpoint.rows,
+        checkpoint=save_checkpoint,
+    )
+    IngestCheckpoint.objects.filter(pk=checkpoint.pk).update(completed=True)
+    return {'filename': params['filename'], 'runname': params['runname'], **result}
@@ -1,3 +1,148 @@
-from django.test import TestCase
+import os
+import tempfile
+import tracemalloc
+from unittest import mock
 
-# Create your tests here.
+import numpy as np
+from django.test import SimpleTestCase, TestCase
+
+from benchmarks.sift_server import FakeSiftServer
+from csv_ingest import channel_names, count_source_rows, iter_csv_blocks, main as ingest_main
+from lidar_export import CSV_HEADER, CSV_LINE_TERMINATOR, GzipMembers, format_csv_block
+
+from .models import IngestCheckpoint
+from .tasks import ingest_csv
+
+
+class IterCsvBlocksTests(SimpleTestCase):
+    rows = 1_000_000
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.tmp = tempfile.TemporaryDirectory()
+        cls.path = os.path.join(cls.tmp.name, 'capture.csv')
+        index = np.arange(cls.rows, dtype=np.float64)
+        with open(cls.path, 'wb') as csv_file:
+            csv_file.write((','.join(CSV_HEADER) + CSV_LINE_TERMINATOR).encode('ascii'))
+            for start in range(0, cls.rows, 100_000):
+                block = index[start:start + 100_000]
+                csv_file.write(format_csv_block([1.7e9 + block, block % 360, block / 1000]))
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.tmp.cleanup()
+        super().tearDownClass()
+
+    def test_reads_every_row(self):
+        blocks = list(iter_csv_blocks(self.path, batch_size=300_000))
+        self.assertEqual([len(timestamps) for timestamps, _ in blocks], [300_000, 300_000, 300_000, 100_000])
+        self.assertEqual(blocks[0][1].shape, (300_000, 2))
+
+    def test_resumes_at_a_large_row_count(self):
+        start_row = self.rows - 2500
+        tracemalloc.start()
+        try:
+            blocks = list(iter_csv_blocks(self.path, batch_size=1000, start_row=start_row))
+            peak = tracemalloc.get_traced_memory()[1]
+        finally:
+            tracemalloc.stop()
+
+        timestamps = np.concatenate([timestamps for timestamps, _ in blocks])
+        np.testing.assert_array_equal(timestamps, 1.7e9 + np.arange(start_row, self.rows))
+        np.testing.assert_array_equal(blocks[0][1][0], [start_row % 360, start_row / 1000])
+        # the skipped rows are scanned past, never held in memory
+        self.assertLess(peak, 16 << 20)
+
+    def test_resumes_at_the_end(self):
+        self.assertEqual(list(iter_csv_blocks(self.path, start_row=self.rows)), [])
+        self.assertEqual(list(iter_csv_blocks(self.path, start_row=self.rows + 10)), [])
+
+
+def _fake_sift(test):
+    """
+    Starts a `FakeSiftServer` for the test and points the ingestion at it.
+    """
+    server = FakeSiftServer()
+    environ = {
+        'SIFT_API_URI': server.start(), 'SIFT_API_KEY': 'test', 'SIFT_USE_SSL': 'false',
+        'ASSET_NAME': 'lidar', 'INGESTION_CLIENT_KEY': 'lidar-test',
+    }
+    test.addCleanup(server.stop)
+    patcher = mock.patch.dict(os.environ, environ)
+    patcher.start()
+    test.addCleanup(patcher.stop)
+    return server
+
+
+class GzipCsvIngestTests(SimpleTestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp.cleanup)
+        self.path = os.path.join(self.tmp.name, 'capture.csv.gz')
+        index = np.arange(2500, dtype=np.float64)
+        # two gzip members, as an incrementally updated conversion has
+        with open(self.path, 'wb') as raw:
+            csv_file = GzipMembers(raw)
+            csv_file.write((','.join(CSV_HEADER) + CSV_LINE_TERMINATOR).encode('ascii'))
+            csv_file.write(format_csv_block([1.7e9 + index[:1000], index[:1000] % 360, index[:1000] / 1000]))
+            csv_file.flush()
+            csv_file.write(format_csv_block([1.7e9 + index[1000:], index[1000:] % 360, index[1000:] / 1000]))
+            csv_file.close()
+
+    def test_reads_the_decompressed_rows(self):
+        self.assertEqual(channel_names(self.path), CSV_HEADER[1:])
+        self.assertEqual(count_source_rows(self.path), 2500)
+        timestamps = np.concatenate([block[0] for block in iter_csv_blocks(self.path, batch_size=1000, start_row=900)])
+        np.testing.assert_array_equal(timestamps, 1.7e9 + np.arange(900, 2500))
+
+    def test_ingests(self):
+        server = _fake_sift(self)
+        result = ingest_main('capture.csv.gz', 'capture', self.path, batch_size=1000)
+        self.assertEqual(result['rows'], 2500)
+        self.assertEqual((server.requests, server.values), (2500, 5000))
+
+
+class IngestResumeTests(TestCase):
+
+    def setUp(self):
+        self.server = _fake_sift(self)
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.path = os.path.join(tmp.name, 'capture.csv')
+        self.write(2000)
+
+    def write(self, rows):
+        index = np.arange(rows, dtype=np.float64)
+        with open(self.path, 'wb') as csv_file:
+            csv_file.write((','.join(CSV_HEADER) + CSV_LINE_TERMINATOR).encode('ascii'))
+            csv_file.write(format_csv_block([1.7e9 + index, index % 360, index / 1000]))
+
+    def interrupted(self):
+        # an ingestion that uploaded 1500 rows and failed, then the source as it is now
+        stat = os.stat(self.path)
+        checkpoint = IngestCheckpoint.objects.create(
+            filename='capture.csv', runname='yard', sift_run_name='yard-1', rows=1500,
+            source_mtime_ns=stat.st_mtime_ns, source_size=stat.st_size,
+        )
+        return checkpoint
+
+    def ingest(self):
+        return ingest_csv({'filename': 'capture.csv', 'runname': 'yard', 'path': self.path}, lambda *args: None)
+
+    def test_resumes_an_unchanged_source(self):
+        checkpoint = self.interrupted()
+        result = self.ingest()
+        self.assertEqual((result['run_name'], result['resumed_from'], result['rows']), ('yard-1', 1500, 500))
+        checkpoint.refresh_from_db()
+        self.assertTrue(checkpoint.completed)
+
+    def test_starts_over_when_the_source_changed(self):
+        checkpoint = self.interrupted()
+        self.write(3000)
+        result = self.ingest()
+        self.assertNotEqual(result['run_name'], 'yard-1')
+        self.assertEqual((result['resumed_from'], result['rows']), (0, 3000))
+        checkpoint.refresh_from_db()
+        self.assertFalse(checkpoint.completed)
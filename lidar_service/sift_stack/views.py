@@ -7,7 +7,9 @@ from rest_framework.response import Response
 from rest_framework.decorators import action
 from drf_spectacular.utils import extend_schema
 
-from csv_ingest import main as ingest_main
+from controller import jobs
+from . import tasks
+from csv_ingest import INGEST_BATCH_SIZE, INGEST_WORKERS
 
 import os
 
@@ -23,15 +25,17 @@ class IngestFileViewSet(viewsets.ViewSet):
             'application/json': {
                 'type': 'object',
                 'properties': {
-                    'filename': {'type': 'string', 'description': 'Name of the csv file to ingest'},
+                    'filename': {'type': 'string', 'description': 'Name of the csv, Parquet, Arrow IPC, npy or HDF5 file to ingest'},
                     'runname': {'type': 'string', 'description': 'Name of the run to create on sift stack'},
+                    'batch_size': {'type': 'integer', 'description': 'Rows per uploaded segment'},
+                    'workers': {'type': 'integer', 'description': 'Segments uploaded concurrently'},
                 },
                 'required': ['filename', 'runname'],
             },
         },
         responses={
-            200: {'description': 'Successfully ingested csv file'},
-            400: {'description': 'Bad request. Filename or runname not provided'},
+            202: {'description': 'Ingestion queued, poll /jobs/{job_id} for its progress. Resumes an unfinished ingestion of the same file and runname'},
+            400: {'description': 'Bad request. Filename or runname not provided, or invalid batch_size or workers'},
             404: {'description': 'Bad request. File not found'},
             500: {'description': 'Internal or Sift server error'},
         },
@@ -52,6 +56,18 @@ class IngestFileViewSet(viewsets.ViewSet):
                         status = status.HTTP_400_BAD_REQUEST
                 )
 
+            try:
+                batch_size = request.data.get('batch_size')
+                batch_size = INGEST_BATCH_SIZE if batch_size in (None, '') else int(batch_size)
+                workers = request.data.get('workers')
+                workers = INGEST_WORKERS if workers in (None, '') else int(workers)
+                if batch_size <= 0 or workers <= 0:
+                    raise ValueError
+            except (TypeError, ValueError):
+                return Response(
+                        {'error': "batch_size and workers must be positive integers"},
+                        status = status.HTTP_400_BAD_REQUEST
+                )
 
             if not LidarFile.objects.filter(filename=filename).exists():
                 return Response(
@@ -59,11 +75,17 @@ class IngestFileViewSet(viewsets.ViewSet):
                         status=status.HTTP_404_NOT_FOUND
                 )
 
-            ingest_main(filename, runname, os.path.join(settings.MEDIA_ROOT, 'lidar_files', filename))
+            job = jobs.submit('ingest_csv', {
+                'filename': filename,
+                'runname': runname,
+                'path': os.path.join(settings.MEDIA_ROOT, 'lidar_files', filename),
+                'batch_size': batch_size,
+                'workers': workers,
+            })
 
             return Response(
-                    {"message": 'Ingested File'}, 
-                    status = status.HTTP_200_OK
+                    {"message": 'Ingestion queued', 'job_id': job.id}, 
+                    status = status.HTTP_202_ACCEPTED
             )
         except Exception as e:
             return Response(
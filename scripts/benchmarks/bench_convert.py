@@ -0,0 +1,90 @@
+"""
+Throughput of the HDF5 -> CSV conversion on a synthetic capture.
+
+    python scripts/benchmarks/bench_convert.py --points 10000000
+
+Builds a file with the layout written by `lidar_control.start_lidar`, then
+times `lidar_export.convert_hdf5_to_csv` over it, the batch export
+`lidar_export.export_csv` with `--workers` processes, and the previous
+one-`writerow`-per-point loop over a sample of it.
+"""
+import argparse
+import csv
+import os
+import resource
+import sys
+import tempfile
+import time
+
+import h5py
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from lidar_export import EXPORT_WORKERS, convert_hdf5_to_csv, export_csv, iter_sessions, plan_export  # noqa: E402
+
+
+def write_synthetic_file(path, num_points, points_per_scan=500, scan_hz=10.0):
+    rng = np.random.default_rng(0)
+    num_scans = -(-num_points // points_per_scan)
+    timestamps = np.repeat(1.7e9 + np.arange(num_scans) / scan_hz, points_per_scan)[:num_points]
+    angles = np.tile(np.linspace(-np.pi, np.pi, points_per_scan, dtype=np.float32), num_scans)[:num_points]
+    distances = rng.uniform(0.05, 12.0, num_points).astype(np.float32)
+
+    with h5py.File(path, 'w') as f:
+        session_group = f.create_group('2024_10_08').create_group('session_001')
+        session_group.create_dataset('readings/timestamp', data=timestamps, maxshape=(None,), dtype='float64')
+        session_group.create_dataset('readings/angle', data=angles, maxshape=(None,), dtype='float32')
+        session_group.create_dataset('readings/distance', data=distances, maxshape=(None,))
+
+
+def legacy_convert(h5_file_path, csv_path, limit):
+    with open(csv_path, 'w', newline='') as csvfile:
+        csv_writer = csv.writer(csvfile)
+        csv_writer.writerow(['Timestamp', 'Angle', 'Distance'])
+        with h5py.File(h5_file_path, 'r') as f:
+            for _, _, session_group in iter_sessions(f):
+                readings = session_group['readings']
+                for row in zip(readings['timestamp'][:limit], readings['angle'][:limit], readings['distance'][:limit]):
+                    csv_writer.writerow(row)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--points', type=int, default=10_000_000)
+    parser.add_argument('--legacy-points', type=int, default=500_000,
+                        help='points converted with the old loop to estimate its rate')
+    parser.add_argument('--workers', type=int, default=EXPORT_WORKERS, help='processes of the batch export')
+    parser.add_argument('--dir', default=None, help='directory for the temporary files')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory(dir=args.dir) as tmp:
+        h5_path = os.path.join(tmp, 'synthetic.h5')
+        csv_path = os.path.join(tmp, 'synthetic.csv')
+        write_synthetic_file(h5_path, args.points)
+
+        start = time.perf_counter()
+        legacy_convert(h5_path, csv_path, args.legacy_points)
+        legacy_rate = args.legacy_points / (time.perf_counter() - start)
+        rss_before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+        start = time.perf_counter()
+        with open(csv_path, 'wb') as csvfile:
+            rows = convert_hdf5_to_csv(h5_path, csvfile)
+        elapsed = time.perf_counter() - start
+        rss_after = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+        start = time.perf_counter()
+        with open(csv_path, 'wb') as csvfile:
+            export_csv(plan_export([h5_path]), csvfile, workers=args.workers, work_dir=tmp)
+        export_elapsed = time.perf_counter() - start
+
+        print(f'points:            {rows:,}')
+        print(f'csv size:          {os.path.getsize(csv_path) / 1e6:,.1f} MB')
+        print(f'legacy writerow:   {legacy_rate:,.0f} points/s')
+        print(f'chunked converter: {rows / elapsed:,.0f} points/s ({elapsed:.1f} s)')
+        print(f'batch export:      {rows / export_elapsed:,.0f} points/s ({export_elapsed:.1f} s, {args.workers} workers)')
+        print(f'peak RSS:          {rss_after / 1024:,.0f} MB (before conversion {rss_before / 1024:,.0f} MB)')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,90 @@
+"""
+Size and speed of the export formats against csv on one synthetic capture.
+
+    python scripts/benchmarks/bench_formats.py --points 10000000 --ingest 500000
+
+Writes a synthetic capture, exports it with `lidar_export.convert_hdf5` to
+every format of `EXPORT_FORMATS`, and for each reports the file size, the
+export rate and the rate `csv_ingest.iter_source_blocks` reads it back into
+ingestion blocks at. With `--ingest N` it also ingests the first N points of
+each export into `sift_server.FakeSiftServer` with `csv_ingest.main`.
+"""
+import argparse
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from bench_convert import write_synthetic_file  # noqa: E402
+from lidar_export import EXPORT_FORMATS, convert_hdf5  # noqa: E402
+
+
+def read_back(path, batch_size):
+    from csv_ingest import iter_source_blocks
+
+    rows = 0
+    for timestamps, _ in iter_source_blocks(path, batch_size):
+        rows += len(timestamps)
+    return rows
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--points', type=int, default=10_000_000)
+    parser.add_argument('--batch-size', type=int, default=10_000, help='rows per ingestion block')
+    parser.add_argument('--ingest', type=int, default=0, help='points ingested into the Sift stand-in, 0 to skip')
+    parser.add_argument('--dir', default=None, help='directory for the temporary files')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory(dir=args.dir) as tmp:
+        h5_path = os.path.join(tmp, 'synthetic.h5')
+        write_synthetic_file(h5_path, args.points)
+        paths = {}
+
+        print(f'points: {args.points:,}')
+        print(f'{"format":<8} {"MB":>9} {"bytes/pt":>9} {"export pts/s":>13} {"read pts/s":>13}')
+        for format, extension in EXPORT_FORMATS.items():
+            path = paths[format] = os.path.join(tmp, f'synthetic{extension}')
+            start = time.perf_counter()
+            with open(path, 'wb') as out_file:
+                rows = convert_hdf5(h5_path, out_file, format)
+            export_seconds = time.perf_counter() - start
+
+            start = time.perf_counter()
+            read_rows = read_back(path, args.batch_size)
+            read_seconds = time.perf_counter() - start
+            assert read_rows == rows, f'{format}: read {read_rows} of {rows} rows'
+
+            size = os.path.getsize(path)
+            print(f'{format:<8} {size / 1e6:>9,.1f} {size / rows:>9.1f} '
+                  f'{rows / export_seconds:>13,.0f} {rows / read_seconds:>13,.0f}')
+
+        if args.ingest:
+            ingest(paths, args)
+
+
+def ingest(paths, args):
+    import csv_ingest
+    from sift_server import FakeSiftServer
+
+    server = FakeSiftServer()
+    os.environ.update(
+        SIFT_API_URI=server.start(), SIFT_API_KEY='bench', SIFT_USE_SSL='false',
+        ASSET_NAME='bench-asset', INGESTION_CLIENT_KEY='bench-key',
+    )
+    try:
+        print(f'ingestion of {args.ingest:,} points')
+        for format, path in paths.items():
+            # the same number of rows from every format: skip all but the last `--ingest`
+            start_row = max(csv_ingest.count_source_rows(path) - args.ingest, 0)
+            result = csv_ingest.main(os.path.basename(path), 'bench', path, batch_size=args.batch_size,
+                                     start_row=start_row)
+            print(f'{format:<8} {result["points_per_second"]:>13,.0f} points/s')
+    finally:
+        server.stop()
+
+
+if __name__ == '__main__':
+    main()
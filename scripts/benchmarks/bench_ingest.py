@@ -0,0 +1,135 @@
+"""
+Throughput and peak memory of Sift ingestion against a local stand-in server.
+
+    python scripts/benchmarks/bench_ingest.py --points 500000 --latency 0.05
+
+Writes a synthetic capture and its csv export, starts `sift_server.FakeSiftServer`
+and ingests them with the previous parse-everything-then-send path and with
+the streaming `csv_ingest.main`, from the csv and straight from the HDF5 file,
+with one upload worker and with `--workers`. `--latency` delays every
+stream's answer like a remote server would. Each variant runs in its own
+process so its peak RSS is its own.
+"""
+import argparse
+import csv
+import json
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+
+import pandas as pd
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from bench_convert import write_synthetic_file  # noqa: E402
+from lidar_export import convert_hdf5_to_csv  # noqa: E402
+from sift_server import FakeSiftServer  # noqa: E402
+
+VARIANTS = ('legacy-csv', 'stream-csv', 'stream-h5', 'segmented-h5')
+
+
+def legacy_ingest(path_to_csv, batch_size):
+    """
+    The previous `csv_ingest.main`: every row parsed into a flow dict first.
+    """
+    from sift_py.grpc.transport import SiftChannelConfig, use_sift_channel
+    from sift_py.ingestion.channel import double_value
+    from sift_py.ingestion.service import IngestionService
+
+    import csv_ingest
+
+    telemetry_config = csv_ingest.load_telemetry_config(path_to_csv, 'bench-asset', 'bench-key')
+    flow = telemetry_config.flows[0]
+    flows_data = []
+    with open(path_to_csv, 'r') as csv_file:
+        reader = csv.reader(csv_file)
+        next(reader)
+        for row in reader:
+            flows_data.append({
+                "flow_name": flow.name,
+                "timestamp": pd.Timestamp.utcfromtimestamp(float(row[0])),
+                "channel_values": [double_value(float(raw_value)) for raw_value in row[1:]],
+            })
+
+    config = SiftChannelConfig(uri=os.environ['SIFT_API_URI'], apikey='bench', use_ssl=False)
+    with use_sift_channel(config) as channel:
+        ingestion_service = IngestionService(channel=channel, config=telemetry_config)
+        ingestion_service.attach_run(channel, 'bench-legacy', 'benchmark')
+        with ingestion_service.buffered_ingestion() as buffered_ingestion:
+            for start in range(0, len(flows_data), batch_size):
+                buffered_ingestion.ingest_flows(*flows_data[start:start + batch_size])
+    return len(flows_data)
+
+
+def run_variant(variant, path, batch_size, workers):
+    import csv_ingest
+
+    start = time.perf_counter()
+    if variant == 'legacy-csv':
+        rows = legacy_ingest(path, batch_size)
+    else:
+        workers = workers if variant.startswith('segmented') else 1
+        rows = csv_ingest.main(os.path.basename(path), 'bench', path, batch_size=batch_size, workers=workers)['rows']
+    elapsed = time.perf_counter() - start
+    print(json.dumps({
+        'rows': rows,
+        'seconds': elapsed,
+        'peak_rss_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+    }))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--points', type=int, default=500_000)
+    parser.add_argument('--batch-size', type=int, default=10_000)
+    parser.add_argument('--workers', type=int, default=4, help='upload workers of the segmented variant')
+    parser.add_argument('--latency', type=float, default=0.0, help='seconds the server waits before answering a stream')
+    parser.add_argument('--dir', default=None, help='directory for the temporary files')
+    parser.add_argument('--variant', choices=VARIANTS, help=argparse.SUPPRESS)
+    parser.add_argument('--path', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.variant:
+        run_variant(args.variant, args.path, args.batch_size, args.workers)
+        return
+
+    server = FakeSiftServer(latency=args.latency)
+    env = dict(
+        os.environ,
+        SIFT_API_URI=server.start(),
+        SIFT_API_KEY='bench',
+        SIFT_USE_SSL='false',
+        ASSET_NAME='bench-asset',
+        INGESTION_CLIENT_KEY='bench-key',
+    )
+    try:
+        with tempfile.TemporaryDirectory(dir=args.dir) as tmp:
+            h5_path = os.path.join(tmp, 'synthetic.h5')
+            csv_path = os.path.join(tmp, 'synthetic.csv')
+            write_synthetic_file(h5_path, args.points)
+            with open(csv_path, 'wb') as csv_file:
+                convert_hdf5_to_csv(h5_path, csv_file)
+
+            print(f'points: {args.points:,}, batch size {args.batch_size:,}, '
+                  f'{args.workers} workers, {args.latency * 1000:.0f} ms latency')
+            for variant in VARIANTS:
+                path = h5_path if variant.endswith('h5') else csv_path
+                values_before = server.values
+                output = subprocess.run(
+                    [sys.executable, os.path.abspath(__file__), '--variant', variant, '--path', path,
+                     '--batch-size', str(args.batch_size), '--workers', str(args.workers)],
+                    env=env, check=True, capture_output=True, text=True,
+                ).stdout
+                result = json.loads(output.strip().splitlines()[-1])
+                received = (server.values - values_before) // 2
+                print(f'{variant:<12} {result["rows"] / result["seconds"]:>10,.0f} points/s '
+                      f'peak RSS {result["peak_rss_mb"]:>7,.0f} MB  (server received {received:,} points)')
+    finally:
+        server.stop()
+
+
+if __name__ == '__main__':
+    main()
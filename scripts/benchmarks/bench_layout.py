@@ -0,0 +1,104 @@
+"""
+File size and per-scan access of the `readings` and `scans` session layouts.
+
+    python scripts/benchmarks/bench_layout.py --scans 20000 --points 500
+
+Writes the same synthetic capture in batches of 50 scans, as the capture
+writer does, once per layout (see `lidar_storage`), then times reading
+random whole scans back.
+"""
+import argparse
+import bisect
+import os
+import sys
+import tempfile
+import time
+
+import h5py
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from lidar_storage import SessionReader, append_scans, create_session  # noqa: E402
+
+BATCH_SCANS = 50
+
+
+def synthetic_batches(num_scans, points_per_scan, scan_hz=10.0):
+    rng = np.random.default_rng(0)
+    angles = np.linspace(-np.pi, np.pi, points_per_scan, dtype=np.float32)
+    for first in range(0, num_scans, BATCH_SCANS):
+        count = min(BATCH_SCANS, num_scans - first)
+        timestamps = 1.7e9 + (first + np.arange(count)) / scan_hz
+        distances = rng.uniform(0.05, 12.0, count * points_per_scan).astype(np.float32)
+        intensities = rng.uniform(0, 1000, count * points_per_scan).astype(np.float32)
+        yield timestamps, np.full(count, points_per_scan), np.tile(angles, count), distances, intensities
+
+
+def write_readings(path, batches, with_intensity):
+    with h5py.File(path, 'w') as f:
+        session_group = f.create_group('2024_10_08').create_group('session_001')
+        names = ['timestamp', 'angle', 'distance'] + (['intensity'] if with_intensity else [])
+        datasets = [
+            session_group.create_dataset(f'readings/{name}', shape=(0,), maxshape=(None,),
+                                         dtype='float64' if name == 'timestamp' else 'float32')
+            for name in names
+        ]
+        for timestamps, counts, angles, distances, intensities in batches:
+            columns = [np.repeat(timestamps, counts), angles, distances, intensities][:len(datasets)]
+            for dataset, values in zip(datasets, columns):
+                dataset.resize(dataset.shape[0] + len(values), axis=0)
+                dataset[-len(values):] = values
+
+
+def write_scans(path, batches):
+    with h5py.File(path, 'w') as f:
+        session_group = create_session(f.create_group('2024_10_08'), 'session_001')
+        for batch in batches:
+            append_scans(session_group, *batch)
+
+
+def time_random_scans(path, num_scans, points_per_scan, samples=200):
+    rng = np.random.default_rng(1)
+    wanted = rng.integers(0, num_scans, samples)
+    with h5py.File(path, 'r') as f:
+        reader = SessionReader(f['2024_10_08/session_001'])
+        start = time.perf_counter()
+        for index in wanted:
+            if reader.layout == 'scans':
+                reader.read_scan(int(index))
+            else:
+                # no scan index: locate the scan's points by its timestamp
+                timestamp = reader.timestamps[int(index) * points_per_scan]
+                first = bisect.bisect_left(reader.timestamps, timestamp, 0, reader.num_points)
+                last = bisect.bisect_right(reader.timestamps, timestamp, first, reader.num_points)
+                reader.read_points(first, last)
+        return (time.perf_counter() - start) / samples * 1e3
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--scans', type=int, default=20000)
+    parser.add_argument('--points', type=int, default=500, help='points per scan')
+    parser.add_argument('--dir', default=None, help='directory for the temporary files')
+    args = parser.parse_args()
+
+    num_points = args.scans * args.points
+    with tempfile.TemporaryDirectory(dir=args.dir) as tmp:
+        variants = {
+            'readings (no intensity)': lambda path: write_readings(path, synthetic_batches(args.scans, args.points), False),
+            'readings + intensity': lambda path: write_readings(path, synthetic_batches(args.scans, args.points), True),
+            'scans': lambda path: write_scans(path, synthetic_batches(args.scans, args.points)),
+        }
+
+        print(f'{args.scans:,} scans x {args.points} points')
+        print(f'{"layout":26s} {"size MB":>9s} {"B/point":>8s} {"scan read ms":>13s}')
+        for name, write in variants.items():
+            path = os.path.join(tmp, name.replace(' ', '_') + '.h5')
+            write(path)
+            size = os.path.getsize(path)
+            access = time_random_scans(path, args.scans, args.points)
+            print(f'{name:26s} {size / 1e6:9.1f} {size / num_points:8.2f} {access:13.3f}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,247 @@
+"""
+End-to-end benchmark of the capture pipeline on the simulated LiDAR.
+
+    python scripts/benchmarks/bench_pipeline.py --duration 30 --frequency 10 --sample-rate 5
+
+Drives every stage a recording goes through, each in its own process so its
+peak RSS is its own:
+
+- capture: `start_lidar` -> `stop_lidar` with `LIDAR_DEVICE=simulated`,
+  latency from a scan's timestamp to the flush of the batch holding it
+- convert: `lidar_export.convert_hdf5_to_csv`, latency per converted slice
+- download: `controller.downloads.file_download_response` of the csv and the
+  HDF5 file, latency to the first byte of whole and 1 MiB range requests
+- ingest: `csv_ingest.main` from the HDF5 file against `sift_server.FakeSiftServer`,
+  latency between acknowledged segments
+
+and prints throughput, latency percentiles and peak RSS per stage.
+"""
+import argparse
+import json
+import os
+import random
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+SCRIPTS_DIR = os.path.dirname(BENCH_DIR)
+SERVICE_DIR = os.path.join(os.path.dirname(SCRIPTS_DIR), 'lidar_service')
+sys.path.insert(0, SCRIPTS_DIR)
+sys.path.insert(0, BENCH_DIR)
+
+STAGES = ('capture', 'convert', 'download', 'ingest')
+
+# bytes asked for by each range request of the download stage
+RANGE_SIZE = 1024 * 1024
+
+
+def percentiles(latencies):
+    """
+    Returns the 50th, 95th and 99th percentiles of latencies given in seconds, in milliseconds.
+    """
+    if not latencies:
+        return None
+    return [float(value) * 1000 for value in np.percentile(latencies, [50, 95, 99])]
+
+
+def report(stage, seconds, points=None, size=None, latencies=(), **extra):
+    print(json.dumps(dict(
+        stage=stage,
+        seconds=seconds,
+        points=points,
+        bytes=size,
+        latency_ms=percentiles(list(latencies)),
+        peak_rss_mb=resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+        **extra,
+    )))
+
+
+def run_capture(path, duration, batch_scans):
+    import lidar_control
+
+    latencies = []
+    write_batch = lidar_control.write_batch
+
+    def timed_write_batch(f, session_group, batch, *args, **kwargs):
+        oldest = batch[0][0]
+        write_batch(f, session_group, batch, *args, **kwargs)
+        latencies.append(time.time() - oldest)
+
+    lidar_control.write_batch = timed_write_batch
+
+    start = time.perf_counter()
+    lidar_control.start_lidar(os.path.basename(path), path, batch_scans=batch_scans)
+    time.sleep(duration)
+    stopping = time.perf_counter()
+    lidar_control.stop_lidar()
+    end = time.perf_counter()
+
+    status = lidar_control.capture_status()
+    report(
+        'capture', end - start, status['points_written'], os.path.getsize(path), latencies,
+        scans_read=status['scans_read'], scans_dropped=status['scans_dropped'], stop_seconds=end - stopping,
+    )
+
+
+def run_convert(path, csv_path):
+    from lidar_export import convert_hdf5_to_csv
+
+    latencies = []
+    last = time.perf_counter()
+
+    def progress(rows, total):
+        nonlocal last
+        now = time.perf_counter()
+        latencies.append(now - last)
+        last = now
+
+    start = time.perf_counter()
+    with open(csv_path, 'wb') as csv_file:
+        rows = convert_hdf5_to_csv(path, csv_file, progress=progress)
+    report('convert', time.perf_counter() - start, rows, os.path.getsize(csv_path), latencies)
+
+
+def run_download(paths, repeat, ranges):
+    sys.path.insert(0, SERVICE_DIR)
+    from django.conf import settings
+    settings.configure()
+    from django.test import RequestFactory
+    from controller.downloads import file_download_response
+
+    factory = RequestFactory()
+    latencies = []
+    total = 0
+
+    def fetch(path, **headers):
+        nonlocal total
+        requested = time.perf_counter()
+        response = file_download_response(factory.get('/download', **headers), path, 'application/octet-stream')
+        first_byte = None
+        for block in response.streaming_content:
+            if first_byte is None:
+                first_byte = time.perf_counter()
+            total += len(block)
+        response.close()
+        latencies.append((first_byte or time.perf_counter()) - requested)
+
+    start = time.perf_counter()
+    rng = random.Random(0)
+    for path in paths:
+        size = os.path.getsize(path)
+        for _ in range(repeat):
+            fetch(path)
+        for _ in range(ranges):
+            first = rng.randrange(max(size - RANGE_SIZE, 1))
+            fetch(path, HTTP_RANGE=f'bytes={first}-{first + RANGE_SIZE - 1}')
+    report('download', time.perf_counter() - start, None, total, latencies)
+
+
+def run_ingest(path, batch_size, workers):
+    import csv_ingest
+
+    latencies = []
+    last = time.perf_counter()
+
+    def progress(rows, total):
+        nonlocal last
+        now = time.perf_counter()
+        latencies.append(now - last)
+        last = now
+
+    start = time.perf_counter()
+    result = csv_ingest.main(
+        os.path.basename(path), 'bench', path, progress=progress, batch_size=batch_size, workers=workers
+    )
+    report('ingest', time.perf_counter() - start, result['rows'], None, latencies, retries=result['retries'])
+
+
+def run_stage(args):
+    if args.stage == 'capture':
+        run_capture(args.path, args.duration, args.batch_scans)
+    elif args.stage == 'convert':
+        run_convert(args.path, args.csv_path)
+    elif args.stage == 'download':
+        run_download([args.csv_path, args.path], args.downloads, args.ranges)
+    else:
+        run_ingest(args.path, args.batch_size, args.workers)
+
+
+def stage_command(args, stage, h5_path, csv_path):
+    return [
+        sys.executable, os.path.abspath(__file__), '--stage', stage, '--path', h5_path, '--csv-path', csv_path,
+        '--duration', str(args.duration), '--batch-scans', str(args.batch_scans),
+        '--downloads', str(args.downloads), '--ranges', str(args.ranges),
+        '--batch-size', str(args.batch_size), '--workers', str(args.workers),
+    ]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--duration', type=float, default=30.0, help='seconds of capture')
+    parser.add_argument('--frequency', type=float, default=10.0, help='simulated scans per second')
+    parser.add_argument('--sample-rate', type=int, default=5, help='simulated thousand points per second')
+    parser.add_argument('--batch-scans', type=int, default=50, help='scans per HDF5 write')
+    parser.add_argument('--downloads', type=int, default=3, help='whole downloads of each file')
+    parser.add_argument('--ranges', type=int, default=20, help='1 MiB range requests on each file')
+    parser.add_argument('--batch-size', type=int, default=10_000, help='rows per ingested segment')
+    parser.add_argument('--workers', type=int, default=4, help='ingestion upload workers')
+    parser.add_argument('--latency', type=float, default=0.0, help='seconds the Sift stand-in waits per stream')
+    parser.add_argument('--dir', default=None, help='directory for the temporary files')
+    parser.add_argument('--stage', choices=STAGES, help=argparse.SUPPRESS)
+    parser.add_argument('--path', help=argparse.SUPPRESS)
+    parser.add_argument('--csv-path', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.stage:
+        run_stage(args)
+        return
+
+    from sift_server import FakeSiftServer
+
+    server = FakeSiftServer(latency=args.latency)
+    env = dict(
+        os.environ,
+        PYTHONPATH=os.pathsep.join([SCRIPTS_DIR, os.environ.get('PYTHONPATH', '')]),
+        LIDAR_DEVICE='simulated',
+        LIDAR_SCAN_FREQUENCY=str(args.frequency),
+        LIDAR_SAMPLE_RATE=str(args.sample_rate),
+        SIFT_API_URI=server.start(),
+        SIFT_API_KEY='bench',
+        SIFT_USE_SSL='false',
+        ASSET_NAME='bench-asset',
+        INGESTION_CLIENT_KEY='bench-key',
+    )
+    try:
+        with tempfile.TemporaryDirectory(dir=args.dir) as tmp:
+            h5_path = os.path.join(tmp, 'pipeline.h5')
+            csv_path = os.path.join(tmp, 'pipeline.csv')
+
+            print(f'{args.duration:g} s capture at {args.frequency:g} Hz, '
+                  f'{args.sample_rate * 1000 / args.frequency:.0f} points per scan')
+            print(f'{"stage":<10} {"seconds":>8} {"points/s":>12} {"MB/s":>8} '
+                  f'{"p50 ms":>9} {"p95 ms":>9} {"p99 ms":>9} {"peak RSS MB":>12}')
+            for stage in STAGES:
+                output = subprocess.run(
+                    stage_command(args, stage, h5_path, csv_path), env=env, check=True, capture_output=True, text=True,
+                ).stdout
+                result = json.loads(output.strip().splitlines()[-1])
+                seconds = result['seconds']
+                rate = f'{result["points"] / seconds:,.0f}' if result['points'] else '-'
+                mb_rate = f'{result["bytes"] / seconds / 1e6:,.1f}' if result['bytes'] else '-'
+                latency = [f'{value:,.1f}' for value in result['latency_ms']] if result['latency_ms'] else ['-'] * 3
+                print(f'{stage:<10} {seconds:>8.2f} {rate:>12} {mb_rate:>8} '
+                      f'{latency[0]:>9} {latency[1]:>9} {latency[2]:>9} {result["peak_rss_mb"]:>12,.0f}')
+                if stage == 'capture':
+                    print(f'{"":<10} {result["scans_read"]} scans read, {result["scans_dropped"]} dropped, '
+                          f'stop took {result["stop_seconds"] * 1000:.0f} ms')
+    finally:
+        server.stop()
+
+
+if __name__ == '__main__':
+    main()
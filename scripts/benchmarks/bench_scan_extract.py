@@ -0,0 +1,112 @@
+"""
+Per-scan overhead of turning a `LaserScan` into arrays for the writer.
+
+    python scripts/benchmarks/bench_scan_extract.py --points 500
+
+The ydlidar SWIG bindings create a proxy object for every point each time
+`outscan.points` is iterated, the stand-in scan below does the same so the
+comparison holds without a sensor. Absolute numbers on the Pi are higher,
+the ratio between the two paths is what to look at.
+"""
+import argparse
+import math
+import operator
+import os
+import random
+import sys
+import time
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+
+class Point:
+    # SWIG proxies expose fields through properties backed by C getters
+    __slots__ = ('_angle', '_range', '_intensity')
+    angle = property(operator.attrgetter('_angle'))
+    range = property(operator.attrgetter('_range'))
+    intensity = property(operator.attrgetter('_intensity'))
+
+    def __init__(self, angle, range, intensity):
+        self._angle = angle
+        self._range = range
+        self._intensity = intensity
+
+
+class PointVector:
+    def __init__(self, raw):
+        self.raw = raw
+
+    def __len__(self):
+        return len(self.raw)
+
+    def __iter__(self):
+        # new proxy per element and per iteration, like the SWIG vector
+        for values in self.raw:
+            yield Point(*values)
+
+
+class Scan:
+    def __init__(self, num_points):
+        self.raw = [
+            (-math.pi + 2 * math.pi * i / num_points, random.uniform(0.05, 12.0), random.uniform(0, 1000))
+            for i in range(num_points)
+        ]
+
+    @property
+    def points(self):
+        return PointVector(self.raw)
+
+
+def legacy(outscan, epoch_time):
+    # list comprehensions in start_scanning, then the copies made by append_to_hdf5
+    angles = [point.angle for point in outscan.points]
+    distances = [point.range for point in outscan.points]
+    return np.full(len(angles), epoch_time), np.asarray(angles, dtype=np.float32), np.asarray(distances, dtype=np.float32)
+
+
+def legacy_with_intensity(outscan, epoch_time):
+    # what keeping intensity would cost with another list comprehension
+    timestamps, angles, distances = legacy(outscan, epoch_time)
+    intensities = [point.intensity for point in outscan.points]
+    return timestamps, angles, distances, np.asarray(intensities, dtype=np.float32)
+
+
+def buffered(outscan, buffers):
+    slot = buffers.acquire()
+    count, _ = buffers.fill(slot, outscan.points)
+    views = buffers.view(slot, count)
+    buffers.release(slot)
+    return views
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--points', type=int, default=500, help='points per scan')
+    parser.add_argument('--scans', type=int, default=5000)
+    args = parser.parse_args()
+
+    from lidar_control import ScanBuffers
+
+    outscan = Scan(args.points)
+    buffers = ScanBuffers(4, max(args.points, 1))
+
+    results = {}
+    for name, run in (('legacy lists', lambda: legacy(outscan, 1.7e9)),
+                      ('legacy + intensity', lambda: legacy_with_intensity(outscan, 1.7e9)),
+                      ('preallocated buffers', lambda: buffered(outscan, buffers))):
+        run()
+        start = time.perf_counter()
+        for _ in range(args.scans):
+            run()
+        results[name] = (time.perf_counter() - start) / args.scans * 1e6
+
+    print(f'points per scan: {args.points}')
+    for name, micros in results.items():
+        print(f'{name:22s} {micros:8.1f} us/scan')
+    print('(legacy lists keep angle and distance only, the buffers also keep intensity)')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,96 @@
+"""
+Write throughput and bytes per point of the session storage options.
+
+    python scripts/benchmarks/bench_storage.py --scans 6000 --points 500
+
+Synthetic scans look like a sensor in a room: distances follow the walls
+with millimetre resolution and a few millimetres of noise, a few points are
+invalid (0), intensities are integers. Scans are appended 50 at a time as the
+capture writer does, see `lidar_storage.storage_options` for the options.
+"""
+import argparse
+import os
+import sys
+import tempfile
+import time
+
+import h5py
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from lidar_storage import POINT_FIELDS, SCAN_FIELDS, append_scans, create_session, storage_options  # noqa: E402
+
+BATCH_SCANS = 50
+
+SETTINGS = [
+    ('h5py auto chunks', None),
+    ('chunk 64k', {}),
+    ('chunk 64k lzf+shuffle', {'compression': 'lzf', 'shuffle': True}),
+    ('chunk 64k gzip4+shuffle', {'compression': 'gzip', 'compression_level': 4, 'shuffle': True}),
+    ('quantize', {'quantize': True}),
+    ('quantize lzf+shuffle', {'quantize': True, 'compression': 'lzf', 'shuffle': True}),
+    ('quantize gzip4+shuffle', {'quantize': True, 'compression': 'gzip', 'compression_level': 4, 'shuffle': True}),
+]
+
+
+def synthetic_batches(num_scans, points_per_scan, scan_hz=10.0):
+    rng = np.random.default_rng(0)
+    angles = np.linspace(-np.pi, np.pi, points_per_scan, endpoint=False).astype(np.float32)
+    # distance to the walls of a 6 x 4 m room seen from off-centre
+    walls = np.minimum(
+        np.abs(np.where(np.cos(angles) > 0, 4.0, 2.0) / np.maximum(np.abs(np.cos(angles)), 1e-6)),
+        np.abs(np.where(np.sin(angles) > 0, 1.5, 2.5) / np.maximum(np.abs(np.sin(angles)), 1e-6)),
+    )
+    for first in range(0, num_scans, BATCH_SCANS):
+        count = min(BATCH_SCANS, num_scans - first)
+        timestamps = 1.7e9 + (first + np.arange(count)) / scan_hz
+        distances = np.tile(walls, count) + rng.normal(0, 0.004, count * points_per_scan)
+        distances = np.round(distances, 3).astype(np.float32)
+        distances[rng.random(distances.shape) < 0.02] = 0
+        intensities = np.clip(1000 / (1 + distances), 0, 1023).round().astype(np.float32)
+        yield timestamps, np.full(count, points_per_scan), np.tile(angles, count), distances, intensities
+
+
+def create_autochunk_session(day_group, session_name):
+    # what start_lidar created before storage options existed
+    session_group = day_group.create_group(session_name)
+    for name, dtype in SCAN_FIELDS.items():
+        session_group.create_dataset(f'scans/{name}', shape=(0,), maxshape=(None,), dtype=dtype)
+    for name, dtype in POINT_FIELDS.items():
+        session_group.create_dataset(f'points/{name}', shape=(0,), maxshape=(None,), dtype=dtype)
+    return session_group
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--scans', type=int, default=6000)
+    parser.add_argument('--points', type=int, default=500, help='points per scan')
+    parser.add_argument('--dir', default=None, help='directory for the temporary files')
+    args = parser.parse_args()
+
+    batches = list(synthetic_batches(args.scans, args.points))
+    num_points = args.scans * args.points
+
+    print(f'{args.scans:,} scans x {args.points} points')
+    print(f'| {"setting":25s} | {"write Mpoints/s":>15s} | {"bytes/point":>11s} |')
+    print(f'|{"-" * 27}|{"-" * 17}|{"-" * 13}|')
+    with tempfile.TemporaryDirectory(dir=args.dir) as tmp:
+        for index, (name, options) in enumerate(SETTINGS):
+            path = os.path.join(tmp, f'{index}.h5')
+            start = time.perf_counter()
+            with h5py.File(path, 'w') as f:
+                day_group = f.create_group('2024_10_08')
+                if options is None:
+                    session_group = create_autochunk_session(day_group, 'session_001')
+                else:
+                    session_group = create_session(day_group, 'session_001', storage_options(**options))
+                for batch in batches:
+                    append_scans(session_group, *batch)
+                    f.flush()
+            elapsed = time.perf_counter() - start
+            size = os.path.getsize(path)
+            print(f'| {name:25s} | {num_points / elapsed / 1e6:15.2f} | {size / num_points:11.2f} |')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,116 @@
+"""
+Local stand-in for the parts of Sift's gRPC API used by `csv_ingest`.
+
+    server = FakeSiftServer()
+    address = server.start()    # e.g. '127.0.0.1:50123'
+    ...                         # SIFT_API_URI=address SIFT_USE_SSL=false
+    server.stop()
+
+It answers the ingestion config and run calls made when an
+`IngestionService` is created and a run attached, and counts what is
+streamed to `IngestWithConfigDataStream` without keeping it.
+
+`latency` delays the answer to every data stream, like a slow uplink, and
+`fail` makes streams fail on demand to exercise retries and resumes.
+"""
+import itertools
+import threading
+import time
+from concurrent import futures
+
+import grpc
+from sift.ingest.v1 import ingest_pb2, ingest_pb2_grpc
+from sift.ingestion_configs.v1 import ingestion_configs_pb2, ingestion_configs_pb2_grpc
+from sift.runs.v2 import runs_pb2, runs_pb2_grpc
+
+
+class FakeSiftServer(
+    ingest_pb2_grpc.IngestServiceServicer,
+    ingestion_configs_pb2_grpc.IngestionConfigServiceServicer,
+    runs_pb2_grpc.RunServiceServicer,
+):
+    def __init__(self, max_workers=16, latency=0.0):
+        self.max_workers = max_workers
+        self.latency = latency
+        self.server = None
+        self.lock = threading.Lock()
+        self.ids = itertools.count(1)
+        self.runs = {}
+        self.requests = 0
+        self.values = 0
+        self.streams = 0
+        self.failures = []
+
+    def fail(self, count=1, code=grpc.StatusCode.UNAVAILABLE, after=0):
+        """
+        Makes `count` data streams fail with `code`, after letting `after` more succeed.
+        """
+        with self.lock:
+            self.failures.extend([None] * after + [code] * count)
+
+    def start(self, host='127.0.0.1'):
+        self.server = grpc.server(futures.ThreadPoolExecutor(max_workers=self.max_workers))
+        ingest_pb2_grpc.add_IngestServiceServicer_to_server(self, self.server)
+        ingestion_configs_pb2_grpc.add_IngestionConfigServiceServicer_to_server(self, self.server)
+        runs_pb2_grpc.add_RunServiceServicer_to_server(self, self.server)
+        port = self.server.add_insecure_port(f'{host}:0')
+        self.server.start()
+        return f'{host}:{port}'
+
+    def stop(self):
+        if self.server:
+            self.server.stop(grace=None)
+
+    # ingestion configs, always a fresh one without flows
+
+    def ListIngestionConfigs(self, request, context):
+        return ingestion_configs_pb2.ListIngestionConfigsResponse()
+
+    def CreateIngestionConfig(self, request, context):
+        return ingestion_configs_pb2.CreateIngestionConfigResponse(
+            ingestion_config=ingestion_configs_pb2.IngestionConfig(
+                ingestion_config_id=f'config-{next(self.ids)}',
+                asset_id='asset-1',
+                client_key=request.client_key,
+            )
+        )
+
+    def ListIngestionConfigFlows(self, request, context):
+        return ingestion_configs_pb2.ListIngestionConfigFlowsResponse()
+
+    def CreateIngestionConfigFlows(self, request, context):
+        return ingestion_configs_pb2.CreateIngestionConfigFlowsResponse()
+
+    # runs
+
+    def ListRuns(self, request, context):
+        name = request.filter.partition('=="')[2].rstrip('"')
+        with self.lock:
+            runs = [self.runs[name]] if name in self.runs else []
+        return runs_pb2.ListRunsResponse(runs=runs)
+
+    def CreateRun(self, request, context):
+        run = runs_pb2.Run(run_id=f'run-{next(self.ids)}', name=request.name)
+        with self.lock:
+            self.runs[request.name] = run
+        return runs_pb2.CreateRunResponse(run=run)
+
+    # data
+
+    def IngestWithConfigDataStream(self, request_iterator, context):
+        requests = values = 0
+        for request in request_iterator:
+            requests += 1
+            values += len(request.channel_values)
+        if self.latency:
+            time.sleep(self.latency)
+
+        with self.lock:
+            code = self.failures.pop(0) if self.failures else None
+            if code is None:
+                self.requests += requests
+                self.values += values
+                self.streams += 1
+        if code is not None:
+            context.abort(code, 'injected failure')
+        return ingest_pb2.IngestWithConfigDataStreamResponse()
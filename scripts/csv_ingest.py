@@ -1,10 +1,16 @@
-import csv
+import gzip
+import io
 import os
-import pandas as pd
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 from pathlib import Path
-from typing import List
+from typing import Iterator, List, Tuple
 
+import grpc
+import numpy as np
+import pandas as pd
 from dotenv import load_dotenv
 from sift_py.grpc.transport import SiftChannelConfig, use_sift_channel
 from sift_py.ingestion.channel import ChannelConfig, ChannelDataType, double_value
@@ -12,59 +18,409 @@ from sift_py.ingestion.config.telemetry import TelemetryConfig
 from sift_py.ingestion.flow import FlowConfig, FlowOrderedChannelValues
 from sift_py.ingestion.service import IngestionService
 
-def parse_csv(
-        path_to_csv: Path, telemetry_config: TelemetryConfig
-) -> List[FlowOrderedChannelValues]:
-    flows: List[FlowOrderedChannelValues] = []
-
-    flow = telemetry_config.flows[0] # we have one csv, and one flow to consume the csv
-
-    with open(path_to_csv, 'r') as csv_file:
-        reader = csv.reader(csv_file)
-        next(reader) #skip header
-        
-        for row in reader:
-            timestamp_str, values = row[0], row[1:]
-            
-            assert len(values) == len(flow.channels), "number of channels don't match number of features in row"
-            flows.append(
-                    {
-                        "flow_name": flow.name,
-                        "timestamp": 
-                           pd.Timestamp.utcfromtimestamp(float(timestamp_str)), 
-                        "channel_values": 
-                            [double_value(float(raw_value)) for raw_value in values]
-                    }
-            )
-
-    return flows
+from lidar_export import CSV_HEADER, EXPORT_FORMATS, count_readings, iter_sessions
+from lidar_metrics import counter, gauge, histogram
+from lidar_storage import SessionReader, open_file
 
-def load_telemetry_config(
-        path_to_csv: Path, asset_name: str, ingestion_client_key: str
-) -> TelemetryConfig:
-    channels = []
+# rows read, converted and uploaded at a time, each batch is one segment sent
+# over its own gRPC stream; this bounds memory regardless of the source size
+INGEST_BATCH_SIZE = 10000
+
+# segments uploaded concurrently, a single stream does not fill the uplink
+INGEST_WORKERS = 4
+
+# a failed segment is sent again this many times in total, waiting
+# RETRY_BACKOFF seconds before the first retry and twice as long each time after
+UPLOAD_ATTEMPTS = 5
+RETRY_BACKOFF = 0.5
+RETRYABLE_CODES = (
+    grpc.StatusCode.UNAVAILABLE,
+    grpc.StatusCode.DEADLINE_EXCEEDED,
+    grpc.StatusCode.RESOURCE_EXHAUSTED,
+    grpc.StatusCode.ABORTED,
+    grpc.StatusCode.INTERNAL,
+    grpc.StatusCode.UNKNOWN,
+)
+
+INGEST_ROWS = counter('sift_ingest_rows_total', 'Rows acknowledged by Sift')
+INGEST_RETRIES = counter('sift_ingest_retries_total', 'Segment uploads retried after a transient failure')
+INGEST_FAILURES = counter('sift_ingest_failures_total', 'Segment uploads that failed for good')
+SEGMENT_SECONDS = histogram(
+    'sift_ingest_segment_seconds', 'Time to send one segment over its gRPC stream, retries included',
+    buckets=(0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0),
+)
+SEGMENTS_IN_FLIGHT = gauge('sift_ingest_segments_in_flight', 'Segments submitted and not yet acknowledged')
+LAST_INGESTED = gauge('sift_ingest_last_timestamp_seconds', 'Timestamp of the last acknowledged row')
+gauge(
+    'sift_ingest_lag_seconds', 'Seconds between now and the last acknowledged row',
+    function=lambda: time.time() - LAST_INGESTED.value if LAST_INGESTED.value else None,
+)
+
+# (timestamps, values) with one row of channel values per timestamp
+Block = Tuple[np.ndarray, np.ndarray]
+
+
+def is_hdf5(path) -> bool:
+    return str(path).endswith('.h5')
+
+
+def source_format(path) -> str:
+    """
+    Returns `hdf5` or the `lidar_export.EXPORT_FORMATS` format of a source, from
+    its extension; a gzip compressed csv (`.csv.gz`) is a csv.
+    """
+    if is_hdf5(path):
+        return 'hdf5'
+    for format, extension in EXPORT_FORMATS.items():
+        if str(path).endswith(extension):
+            return format
+    return 'csv'
+
+
+def open_csv(path_to_csv: Path, buffering: int = io.DEFAULT_BUFFER_SIZE):
+    """
+    Opens a csv for reading as a buffered binary file, decompressing a `.gz` one on the fly.
+    """
+    if str(path_to_csv).endswith('.gz'):
+        # every gzip member of an incrementally updated `.csv.gz` is read as one stream
+        return io.BufferedReader(gzip.open(path_to_csv, 'rb'), buffer_size=buffering)
+    return open(path_to_csv, 'rb', buffering=buffering)
+
+
+def count_csv_rows(path_to_csv: Path) -> int:
+    """
+    Counts the data rows of a csv by scanning it for line breaks in fixed-size blocks.
+    """
+    lines = 0
+    last = b'\n'
+    with open_csv(path_to_csv) as csv_file:
+        while block := csv_file.read(1 << 20):
+            lines += block.count(b'\n')
+            last = block[-1:]
+    if last != b'\n':
+        lines += 1  # no line break after the last row
+    return max(lines - 1, 0)  # header
+
+
+# bytes of a csv scanned at a time when skipping rows already ingested
+SKIP_BLOCK_SIZE = 1 << 20
+
+
+def _skip_lines(csv_file, lines: int) -> None:
+    """
+    Moves the buffered binary file `csv_file` past its next `lines` line breaks.
+
+    Scans the file in `SKIP_BLOCK_SIZE` blocks, so memory does not grow with `lines`.
+    """
+    while lines:
+        block = csv_file.peek(SKIP_BLOCK_SIZE)[:SKIP_BLOCK_SIZE]
+        if not block:
+            return
+        count = block.count(b'\n')
+        if count < lines:
+            csv_file.read(len(block))
+            lines -= count
+        else:
+            # up to and including the last line break to skip
+            end = np.flatnonzero(np.frombuffer(block, dtype=np.uint8) == ord('\n'))[lines - 1]
+            csv_file.read(int(end) + 1)
+            lines = 0
+
+
+def iter_csv_blocks(path_to_csv: Path, batch_size: int = INGEST_BATCH_SIZE, start_row: int = 0) -> Iterator[Block]:
+    """
+    Yields `(timestamps, values)` blocks of at most `batch_size` rows of a csv.
+
+    The first column holds epoch seconds, the others one channel each.
+
+    :param start_row: Number of data rows to skip, scanned past without parsing them.
+    """
+    with open_csv(path_to_csv, SKIP_BLOCK_SIZE) as csv_file:
+        names = [name.strip() for name in csv_file.readline().decode('ascii').split(',')]
+        _skip_lines(csv_file, start_row)
+        for chunk in pd.read_csv(csv_file, chunksize=batch_size, dtype=np.float64, header=None, names=names):
+            # an empty chunk when nothing is left after the skipped rows
+            if len(chunk):
+                values = chunk.to_numpy()
+                yield values[:, 0], values[:, 1:]
+
+
+def iter_hdf5_blocks(path_to_h5: Path, batch_size: int = INGEST_BATCH_SIZE, start_row: int = 0) -> Iterator[Block]:
+    """
+    Yields `(timestamps, values)` blocks of at most `batch_size` readings of
+    every session of a lidar HDF5 file, with the same channels as its csv export.
+
+    :param start_row: Number of readings to skip, counted over all sessions in file order.
+    """
+    with open_file(path_to_h5) as f:
+        for _, _, session_group in iter_sessions(f):
+            reader = SessionReader(session_group)
+            if start_row >= reader.num_points:
+                start_row -= reader.num_points
+                continue
+
+            for start in range(start_row, reader.num_points, batch_size):
+                timestamps, angles, distances, _ = reader.read_points(start, start + batch_size)
+                yield timestamps, np.column_stack((angles, distances)).astype(np.float64)
+            start_row = 0
+
+
+def _table_block(columns) -> Block:
+    timestamps = np.asarray(columns[0], dtype=np.float64)
+    return timestamps, np.column_stack(columns[1:]).astype(np.float64)
+
+
+def iter_npy_blocks(path_to_npy: Path, batch_size: int = INGEST_BATCH_SIZE, start_row: int = 0) -> Iterator[Block]:
+    """
+    Yields `(timestamps, values)` blocks of at most `batch_size` rows of a `.npy`
+    record array export, memory-mapped so only the rows of a block are read.
+
+    :param start_row: Number of rows to skip.
+    """
+    records = np.load(path_to_npy, mmap_mode='r')
+    for start in range(start_row, len(records), batch_size):
+        block = records[start:start + batch_size]
+        yield _table_block([block[name] for name in records.dtype.names])
+
+
+def iter_arrow_blocks(path_to_arrow: Path, batch_size: int = INGEST_BATCH_SIZE, start_row: int = 0) -> Iterator[Block]:
+    """
+    Yields `(timestamps, values)` blocks of at most `batch_size` rows of an
+    Arrow IPC file export, memory-mapped and read without copying.
+
+    :param start_row: Number of rows to skip, whole record batches are skipped without reading them.
+    """
+    import pyarrow as pa
 
-    with open(path_to_csv, "r") as csv_file:
-        reader = csv.reader(csv_file)
-        header = next(reader) #only need headers to load telemetry
+    with pa.memory_map(str(path_to_arrow)) as source:
+        reader = pa.ipc.open_file(source)
+        for index in range(reader.num_record_batches):
+            batch = reader.get_batch(index)
+            if start_row >= batch.num_rows:
+                start_row -= batch.num_rows
+                continue
+            for start in range(start_row, batch.num_rows, batch_size):
+                block = batch.slice(start, batch_size)
+                yield _table_block([column.to_numpy() for column in block.columns])
+            start_row = 0
 
-        channel_names = header[1:] #skip time series column
 
-        for name in channel_names:
-            channels.append(
-                    ChannelConfig(
-                        name=name,
-                        data_type = ChannelDataType.DOUBLE
-                    )
-            )
+def iter_parquet_blocks(path_to_parquet: Path, batch_size: int = INGEST_BATCH_SIZE, start_row: int = 0) -> Iterator[Block]:
+    """
+    Yields `(timestamps, values)` blocks of at most `batch_size` rows of a Parquet export.
+
+    :param start_row: Number of rows to skip, whole row groups are skipped without reading them.
+    """
+    import pyarrow.parquet as pq
+
+    with pq.ParquetFile(path_to_parquet) as parquet_file:
+        row_groups = []
+        for index in range(parquet_file.metadata.num_row_groups):
+            num_rows = parquet_file.metadata.row_group(index).num_rows
+            if not row_groups and start_row >= num_rows:
+                start_row -= num_rows
+                continue
+            row_groups.append(index)
+
+        for batch in parquet_file.iter_batches(batch_size=batch_size, row_groups=row_groups):
+            if start_row >= batch.num_rows:
+                start_row -= batch.num_rows
+                continue
+            batch = batch.slice(start_row)
+            start_row = 0
+            yield _table_block([column.to_numpy() for column in batch.columns])
+
+
+def to_utc_datetimes(timestamps: np.ndarray) -> np.ndarray:
+    """
+    Converts epoch seconds to timezone-aware UTC datetimes for a whole block at once.
+    """
+    return pd.to_datetime(timestamps, unit='s', utc=True).to_pydatetime()
+
+
+def iter_flows(blocks: Iterator[Block], flow_name: str) -> Iterator[List[FlowOrderedChannelValues]]:
+    """
+    Turns `(timestamps, values)` blocks into batches of flows, one per block.
+
+    Only one block is materialised at a time, the timestamps of a block are
+    converted in one vectorized call.
+    """
+    for timestamps, values in blocks:
+        yield [
+            {
+                "flow_name": flow_name,
+                "timestamp": timestamp,
+                "channel_values": [double_value(value) for value in row],
+            }
+            for timestamp, row in zip(to_utc_datetimes(timestamps), values.tolist())
+        ]
+
+
+def channel_names(path: Path) -> List[str]:
+    """
+    Names of the channels of a source (its columns minus the time column), those of the csv export for HDF5.
+    """
+    format = source_format(path)
+    if format == 'hdf5':
+        return CSV_HEADER[1:]
+    if format == 'npy':
+        return list(np.load(path, mmap_mode='r').dtype.names[1:])
+    if format == 'arrow':
+        import pyarrow as pa
+        with pa.memory_map(str(path)) as source:
+            return pa.ipc.open_file(source).schema.names[1:]
+    if format == 'parquet':
+        import pyarrow.parquet as pq
+        return pq.read_schema(path).names[1:]
+
+    with open_csv(path) as csv_file:
+        header = csv_file.readline().decode('ascii').strip()
+    return [name.strip() for name in header.split(',')[1:]]
+
+
+def load_telemetry_config(
+        path: Path, asset_name: str, ingestion_client_key: str
+) -> TelemetryConfig:
+    channels = [
+        ChannelConfig(name=name, data_type=ChannelDataType.DOUBLE)
+        for name in channel_names(path)
+    ]
 
     return TelemetryConfig(
-           asset_name=asset_name, 
-           ingestion_client_key = ingestion_client_key, 
-           flows=[FlowConfig(name="data", channels=channels)] # one flow for one csv?
+           asset_name=asset_name,
+           ingestion_client_key = ingestion_client_key,
+           flows=[FlowConfig(name="data", channels=channels)] # one flow for one file
     )
 
-def main(filename, runname, path_to_csv):
+
+_BLOCK_READERS = {
+    'hdf5': iter_hdf5_blocks,
+    'npy': iter_npy_blocks,
+    'arrow': iter_arrow_blocks,
+    'parquet': iter_parquet_blocks,
+    'csv': iter_csv_blocks,
+}
+
+
+def iter_source_blocks(path: Path, batch_size: int = INGEST_BATCH_SIZE, start_row: int = 0) -> Iterator[Block]:
+    return _BLOCK_READERS[source_format(path)](path, batch_size, start_row)
+
+
+def count_source_rows(path: Path) -> int:
+    format = source_format(path)
+    if format == 'hdf5':
+        with open_file(path) as f:
+            return count_readings(f)
+    if format == 'npy':
+        return len(np.load(path, mmap_mode='r'))
+    if format == 'arrow':
+        import pyarrow as pa
+        with pa.memory_map(str(path)) as source:
+            reader = pa.ipc.open_file(source)
+            return sum(reader.get_batch(index).num_rows for index in range(reader.num_record_batches))
+    if format == 'parquet':
+        import pyarrow.parquet as pq
+        return pq.ParquetFile(path).metadata.num_rows
+    return count_csv_rows(path)
+
+
+def upload_segment(ingestion_service, flows, attempts=UPLOAD_ATTEMPTS, backoff=RETRY_BACKOFF):
+    """
+    Sends a segment of flows over one gRPC stream, retrying transient failures.
+
+    A retried segment is sent whole again, points the failed stream already
+    delivered are sent twice.
+
+    :return: The number of retries it took.
+    """
+    requests = [
+        ingestion_service.create_ingestion_request(flow["flow_name"], flow["timestamp"], flow["channel_values"])
+        for flow in flows
+    ]
+    for attempt in range(attempts):
+        try:
+            with SEGMENT_SECONDS.time():
+                ingestion_service.ingest(*requests)
+            return attempt
+        except grpc.RpcError as e:
+            if e.code() not in RETRYABLE_CODES or attempt == attempts - 1:
+                INGEST_FAILURES.inc()
+                raise
+            INGEST_RETRIES.inc()
+            print(f"Segment upload failed ({e.code().name}), retrying in {backoff * 2 ** attempt:.1f}s")
+            time.sleep(backoff * 2 ** attempt)
+
+
+def ingest_blocks(ingestion_service, flow_name, blocks, progress=None, total=None, workers=INGEST_WORKERS,
+                  start_row=0, checkpoint=None, attempts=UPLOAD_ATTEMPTS, backoff=RETRY_BACKOFF):
+    """
+    Uploads `blocks` as ordered segments, one per block, with up to `workers` in flight.
+
+    Segments are acknowledged in order: once a segment and all the ones before
+    it are uploaded, `checkpoint(rows, timestamp)` is called with the number
+    of rows of the source now safely ingested (counting the `start_row` skipped
+    ones) and the last timestamp among them. Resuming from `rows` never leaves a gap.
+    At most `2 * workers` segments are held in memory.
+
+    :param progress: Optional `progress(rows_ingested, total_rows)` callback, called after each segment.
+    :param checkpoint: Optional `checkpoint(rows, timestamp)` callback, see above.
+    :return: `(rows, retries)`, the rows uploaded by this call and the number of segment retries.
+    """
+    rows = start_row
+    retries = 0
+    in_flight = deque()
+
+    def acknowledge():
+        nonlocal rows, retries
+        future, num_rows, last_timestamp = in_flight.popleft()
+        SEGMENTS_IN_FLIGHT.dec()
+        retries += future.result()
+        rows += num_rows
+        INGEST_ROWS.inc(num_rows)
+        LAST_INGESTED.set(last_timestamp)
+        if checkpoint:
+            checkpoint(rows, last_timestamp)
+        if progress:
+            progress(rows, total)
+
+    with ThreadPoolExecutor(max_workers=workers, thread_name_prefix='sift-upload') as executor:
+        try:
+            for flows in iter_flows(blocks, flow_name):
+                if not flows:
+                    continue
+                future = executor.submit(upload_segment, ingestion_service, flows, attempts, backoff)
+                in_flight.append((future, len(flows), flows[-1]["timestamp"].timestamp()))
+                SEGMENTS_IN_FLIGHT.inc()
+                if len(in_flight) >= 2 * workers:
+                    acknowledge()
+            while in_flight:
+                acknowledge()
+        finally:
+            for future, _, _ in in_flight:
+                future.cancel()
+            SEGMENTS_IN_FLIGHT.dec(len(in_flight))
+
+    return rows - start_row, retries
+
+
+def main(filename, runname, path, progress=None, batch_size=INGEST_BATCH_SIZE, workers=INGEST_WORKERS,
+         run_name=None, start_row=0, checkpoint=None):
+    """
+    Ingests a csv, a Parquet, Arrow IPC or `.npy` export, or a lidar HDF5 file at `path` into a sift run.
+
+    The source is streamed: it is read, converted and uploaded `batch_size`
+    rows at a time, by `workers` concurrent gRPC streams, so memory use does
+    not depend on its size.
+
+    :param progress: Optional `progress(rows_ingested, total_rows)` callback, called after each batch.
+    :param batch_size: Number of rows per segment, each segment is one gRPC stream.
+    :param workers: Number of segments uploaded concurrently.
+    :param run_name: Sift run to ingest into, reused if it exists. A new `{runname}-{now}` run by default.
+    :param start_row: Rows of the source already ingested into `run_name`, skipped.
+    :param checkpoint: Optional `checkpoint(rows, timestamp)` callback, see `ingest_blocks`.
+    :return: Dict with the `run_name`, the `rows` ingested by this call, `resumed_from`,
+        `seconds`, `points_per_second` and `retries`.
+    """
     load_dotenv()
 
     sift_uri = os.getenv("SIFT_API_URI")
@@ -79,21 +435,43 @@ def main(filename, runname, path_to_csv):
     ingestion_client_key = os.getenv("INGESTION_CLIENT_KEY")
     assert ingestion_client_key, "expected 'INGESTION_CLIENT_KEY' environment variable to be set"
 
+    # plaintext gRPC, only meant for a local ingestion server
+    use_ssl = os.getenv("SIFT_USE_SSL", "true").lower() not in ("0", "false", "no")
+
     telemetry_config = load_telemetry_config(
-            path_to_csv, asset_name, ingestion_client_key
+            path, asset_name, ingestion_client_key
     )
-    flows_data = parse_csv(path_to_csv, telemetry_config)
+    total = count_source_rows(path) if progress else None
+    run_name = run_name or f"{runname}-{datetime.now()}"
 
-    sift_channel_conf = SiftChannelConfig(uri = sift_uri, apikey = apikey)
+    sift_channel_conf = SiftChannelConfig(uri = sift_uri, apikey = apikey, use_ssl = use_ssl)
 
     with use_sift_channel(sift_channel_conf) as channel:
         ingestion_service = IngestionService(
                 channel = channel,
                 config = telemetry_config
         )
+        ingestion_service.attach_run(channel, run_name, f"ingestion of {filename}")
 
-        run_name = f"{runname}-{datetime.now()}"
-        ingestion_service.attach_run(channel, run_name, "test csv ingestion")
+        started = time.perf_counter()
+        rows, retries = ingest_blocks(
+            ingestion_service,
+            telemetry_config.flows[0].name,
+            iter_source_blocks(path, batch_size, start_row),
+            progress=progress,
+            total=total,
+            workers=workers,
+            start_row=start_row,
+            checkpoint=checkpoint,
+        )
+        seconds = time.perf_counter() - started
 
-        with ingestion_service.buffered_ingestion() as buffered_ingestion:
-            buffered_ingestion.ingest_flows(*flows_data)
+    print(f"Ingested {rows} rows into '{run_name}' in {seconds:.1f}s ({rows / seconds if seconds else 0:.0f} points/s)")
+    return {
+        'run_name': run_name,
+        'rows': rows,
+        'resumed_from': start_row,
+        'seconds': round(seconds, 3),
+        'points_per_second': round(rows / seconds, 1) if seconds else None,
+        'retries': retries,
+    }
@@ -1,52 +1,363 @@
+from contextlib import contextmanager
 from datetime import datetime
 
 import os
+import re
 import sys
 import csv
 import time
-import ydlidar
 import subprocess
 import signal
+import queue
 import threading
+import json
+import fcntl
+import hashlib
+import tempfile
 
-import h5py
 import numpy as np
 
-# track status of lidar
-lidar_process = None
-lidar = None
+from lidar_storage import (
+    create_session, append_scans, storage_options, read_storage_defaults, open_file, start_swmr, session_summary
+)
+from lidar_live import LiveScans
+from lidar_lod import LodBuilder, create_lod, available_levels
+from lidar_metrics import counter, gauge, histogram
+
+# capture pipeline defaults: the device thread hands scans to the writer
+# thread through a bounded queue, the writer appends them in batches
+SCAN_QUEUE_SIZE = 600          # ~1 minute of scans at 10 Hz
+WRITER_BATCH_SCANS = 50        # scans appended per HDF5 write
+WRITER_FLUSH_INTERVAL = 5.0    # seconds before a partial batch is written anyway
+MAX_SCAN_POINTS = 2048         # points kept per scan, ~4x what the TOF sensor produces at 10 Hz
+
+# device settings, the environment can override them: LIDAR_DEVICE=simulated
+# runs the capture against `lidar_simulator` instead of the ydlidar SDK
+LIDAR_DEVICE = os.environ.get('LIDAR_DEVICE', 'ydlidar')
+LIDAR_PORT = os.environ.get('LIDAR_PORT', '/dev/ttyUSB0')
+LIDAR_SCAN_FREQUENCY = float(os.environ.get('LIDAR_SCAN_FREQUENCY', 10.0))  # Hz
+LIDAR_SAMPLE_RATE = int(os.environ.get('LIDAR_SAMPLE_RATE', 5))              # thousand points per second
+DRIVERS = ('ydlidar', 'simulated')
+
+# settings of each configured LiDAR, the LIDAR_* variables above are the defaults;
+# lidar_type and device_type name constants of the driver module
+DEVICE_DEFAULTS = {
+    'driver': LIDAR_DEVICE,
+    'port': LIDAR_PORT,
+    'baudrate': 128000,
+    'lidar_type': 'TYPE_TOF',
+    'device_type': 'YDLIDAR_TYPE_SERIAL',
+    'scan_frequency': LIDAR_SCAN_FREQUENCY,
+    'sample_rate': LIDAR_SAMPLE_RATE,
+    'single_channel': True,
+}
+
+# LIDAR_DEVICES is a JSON object of device name -> settings overriding
+# DEVICE_DEFAULTS, e.g. {"front": {}, "rear": {"port": "/dev/ttyUSB1"}}; the
+# first device is the default one. Without it there is one device, `default`.
+LIDAR_DEVICES = os.environ.get('LIDAR_DEVICES')
+DEFAULT_DEVICE = 'default'
+DEVICE_NAME = re.compile(r'^[A-Za-z0-9_-]{1,64}$')
+
+# directory of the lock files coordinating the processes of the service:
+# lidar-<device>.lock keeps two processes from driving the same device (see
+# Capture.start), lidar-file-<hash>.lock marks a file being recorded (see
+# writing_file) and lidar-jobs.lock elects the process running the jobs (see
+# controller.jobs)
+LIDAR_LOCK_DIR = os.environ.get('LIDAR_LOCK_DIR', tempfile.gettempdir())
+DROP_NEWEST, DROP_OLDEST, BLOCK = 'drop_newest', 'drop_oldest', 'block'
+DROP_POLICIES = (DROP_NEWEST, DROP_OLDEST, BLOCK)
+
+# capture metrics by device, see lidar_metrics; every CaptureStats counter is
+# also a process-wide lidar_<name>_total counter that survives captures
+CAPTURE_COUNTERS = {
+    name: counter(f'lidar_{name}_total', documentation, ('device',))
+    for name, documentation in (
+        ('scans_read', 'Scans read from the device'),
+        ('scans_skipped', 'Scans left out by the rate and every settings'),
+        ('scans_captured', 'Scans queued for the writer'),
+        ('scans_written', 'Scans written to HDF5 files'),
+        ('scans_dropped', 'Scans lost to a full queue or a failed writer'),
+        ('points_written', 'Points written to HDF5 files'),
+        ('points_truncated', 'Points beyond MAX_SCAN_POINTS left out of their scan'),
+        ('read_failures', 'Failed doProcessSimple calls'),
+        ('flushes', 'HDF5 flushes after a batch'),
+        ('files_rotated', 'Files a rolling capture moved on to'),
+        ('rotation_failures', 'Failed moves of a rolling capture to its next file'),
+    )
+}
+SCAN_READ_SECONDS = histogram(
+    'lidar_scan_read_seconds', 'Time spent in doProcessSimple per scan, mostly waiting for the device', ('device',),
+    buckets=(0.001, 0.005, 0.01, 0.025, 0.05, 0.075, 0.1, 0.125, 0.15, 0.2, 0.3, 0.5, 1.0, 2.5),
+)
+SCAN_LATENCY_SECONDS = histogram(
+    'lidar_scan_latency_seconds', 'Seconds from a scan being read to the flush of the batch holding it', ('device',),
+    buckets=(0.01, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 7.5, 10.0, 15.0, 30.0, 60.0),
+)
+WRITE_BATCH_SECONDS = histogram(
+    'lidar_write_batch_seconds', 'Time to append a batch of scans to the HDF5 file', ('device',)
+)
+FLUSH_SECONDS = histogram('lidar_flush_seconds', 'Time to flush the HDF5 file after a batch', ('device',))
+BYTES_WRITTEN = counter(
+    'lidar_bytes_written_total', 'Bytes of scans and points appended to HDF5 files, before compression', ('device',)
+)
+CAPTURE_RUNNING = gauge('lidar_capture_running', 'Whether a capture is running', ('device',))
+QUEUE_DEPTH = gauge('lidar_scan_queue_depth', 'Scans waiting for the writer', ('device',))
+QUEUE_CAPACITY = gauge('lidar_scan_queue_capacity', 'Size of the scan queue of the current capture', ('device',))
+LIVE_VIEWERS = gauge('lidar_live_viewers', 'Clients connected to the live view', ('device',))
+
+# names of the metrics above, reported by the process that runs the captures
+CAPTURE_METRICS = tuple(metric.name for metric in (
+    *CAPTURE_COUNTERS.values(), SCAN_READ_SECONDS, SCAN_LATENCY_SECONDS, WRITE_BATCH_SECONDS, FLUSH_SECONDS,
+    BYTES_WRITTEN, CAPTURE_RUNNING, QUEUE_DEPTH, QUEUE_CAPACITY, LIVE_VIEWERS,
+))
 
 ERROR = lambda error_code, message : {'error_code': error_code, 'message': message}
 SUCCESS = lambda status, message : {'status': status, 'message': message}
-stop_event = threading.Event() 
 
-def init_lidar():
+
+class CaptureError(RuntimeError):
+    """
+    A capture cannot start or stop in the current state of its device.
+    """
+
+
+class CaptureStats:
+    """
+    Thread-safe counters shared by the device and writer threads of a capture,
+    with the metrics of its device.
+    """
+
+    def __init__(self, device=DEFAULT_DEVICE):
+        self.lock = threading.Lock()
+        self.counters = {name: metric.labels(device) for name, metric in CAPTURE_COUNTERS.items()}
+        self.read_seconds = SCAN_READ_SECONDS.labels(device)
+        self.latency_seconds = SCAN_LATENCY_SECONDS.labels(device)
+        self.write_seconds = WRITE_BATCH_SECONDS.labels(device)
+        self.flush_seconds = FLUSH_SECONDS.labels(device)
+        self.bytes_written = BYTES_WRITTEN.labels(device)
+        self.reset()
+
+    def reset(self, queue_capacity=0, target_rate=None, every=1):
+        with self.lock:
+            self.started_at = None
+            self.started_monotonic = None
+            self.queue_capacity = queue_capacity
+            self.target_rate = target_rate
+            self.every = every
+            self.scans_read = 0
+            self.scans_skipped = 0
+            self.scans_captured = 0
+            self.scans_written = 0
+            self.scans_dropped = 0
+            self.points_written = 0
+            self.points_truncated = 0
+            self.read_failures = 0
+            self.flushes = 0
+            self.files_rotated = 0
+            self.rotation_failures = 0
+            self.session = None
+            self.swmr = False
+
+    def add(self, **counts):
+        with self.lock:
+            for name, count in counts.items():
+                setattr(self, name, getattr(self, name) + count)
+        for name, count in counts.items():
+            self.counters[name].inc(count)
+
+    def snapshot(self, scan_queue=None):
+        with self.lock:
+            elapsed = time.monotonic() - self.started_monotonic if self.started_monotonic else 0
+            rate = lambda count: count / elapsed if elapsed else None
+            return {
+                'started_at': self.started_at,
+                'session': self.session,
+                'target_rate': self.target_rate,
+                'every': self.every,
+                # achieved scans per second since the capture started
+                'device_rate': rate(self.scans_read),
+                'capture_rate': rate(self.scans_captured),
+                'write_rate': rate(self.scans_written),
+                'scans_read': self.scans_read,
+                'scans_skipped': self.scans_skipped,
+                'scans_captured': self.scans_captured,
+                'scans_written': self.scans_written,
+                'scans_dropped': self.scans_dropped,
+                'points_written': self.points_written,
+                'points_truncated': self.points_truncated,
+                'read_failures': self.read_failures,
+                'flushes': self.flushes,
+                'files_rotated': self.files_rotated,
+                'rotation_failures': self.rotation_failures,
+                'queue_depth': scan_queue.qsize() if scan_queue is not None else 0,
+                'queue_capacity': self.queue_capacity,
+                'swmr': self.swmr,
+            }
+
+
+class ScanDecimator:
+    """
+    Picks which device scans a capture keeps: every scan, one scan every
+    `every` scans, and/or scans at no more than `rate` Hz.
+
+    Decisions follow the scan timestamps, so the capture runs at the device's
+    own cadence and nothing sleeps. A scan is kept once the next one is due
+    within half a device interval, which keeps e.g. exactly every other scan
+    when asking for 5 Hz from a 10 Hz sensor despite timing jitter.
+    """
+
+    def __init__(self, rate=None, every=1):
+        self.period = 1.0 / rate if rate else 0.0
+        self.every = every
+        self.index = 0
+        self.next_due = None
+        self.last_stamp = None
+        self.device_interval = 0.0
+
+    def keep(self, stamp):
+        if self.last_stamp is not None:
+            interval = stamp - self.last_stamp
+            self.device_interval = interval if not self.device_interval else 0.9 * self.device_interval + 0.1 * interval
+        self.last_stamp = stamp
+
+        self.index += 1
+        if (self.index - 1) % self.every:
+            return False
+        if not self.period:
+            return True
+
+        if self.next_due is not None and stamp < self.next_due - self.device_interval / 2:
+            return False
+        if self.next_due is None or stamp > self.next_due + self.period:
+            # first scan, or we fell behind: restart the schedule from here
+            self.next_due = stamp
+        self.next_due += self.period
+        return True
+
+
+class ScanBuffers:
+    """
+    Preallocated scan storage shared by the device and writer threads.
+
+    Each slot holds one scan as `(angle, range, intensity)` float32 rows. The
+    device thread fills a free slot in place and queues its index, the writer
+    reads views of the slot and hands it back, so the capture loop allocates
+    no Python lists or fresh arrays per scan. With one slot per queue entry,
+    per scan of a writer batch and one being filled, a slot is always free.
+    """
+
+    def __init__(self, num_slots, max_points=MAX_SCAN_POINTS):
+        self.max_points = max_points
+        self.points = np.zeros((num_slots, max_points, 3), dtype=np.float32)
+        self.free = queue.SimpleQueue()
+        for slot in range(num_slots):
+            self.free.put(slot)
+
+    def acquire(self):
+        return self.free.get()
+
+    def release(self, slot):
+        self.free.put(slot)
+
+    def fill(self, slot, points):
+        """
+        Copies the points of a `LaserScan` into `slot` in a single pass.
+
+        :return: `(count, truncated)` points stored and points that did not fit.
+        """
+        total = len(points)
+        count = min(total, self.max_points)
+        if count:
+            values = (value for point in points for value in (point.angle, point.range, point.intensity))
+            self.points[slot, :count] = np.fromiter(values, dtype=np.float32, count=3 * count).reshape(count, 3)
+        return count, total - count
+
+    def view(self, slot, count):
+        """
+        Returns `(angles, distances, intensities)` views of the first `count` points of `slot`.
+        """
+        points = self.points[slot, :count]
+        return points[:, 0], points[:, 1], points[:, 2]
+
+
+def device_configs(devices=LIDAR_DEVICES):
+    """
+    Returns the settings of every configured LiDAR by device name, default device first.
+
+    :param devices: JSON object or dict of device name -> overrides of `DEVICE_DEFAULTS`,
+        one `default` device with the defaults when empty.
+    """
+    if isinstance(devices, str):
+        devices = json.loads(devices) if devices.strip() else None
+    devices = devices or {DEFAULT_DEVICE: {}}
+    if not isinstance(devices, dict):
+        raise ValueError("LIDAR_DEVICES must be a JSON object of device name -> settings")
+
+    configs = {}
+    for name, overrides in devices.items():
+        if not DEVICE_NAME.match(name):
+            raise ValueError(f"Invalid LiDAR device name '{name}', use letters, digits, '_' and '-'")
+        unknown = set(overrides or {}) - set(DEVICE_DEFAULTS)
+        if unknown:
+            raise ValueError(f"Unknown settings {', '.join(sorted(unknown))} for LiDAR device '{name}'")
+        config = dict(DEVICE_DEFAULTS, **(overrides or {}))
+        if config['driver'] not in DRIVERS:
+            raise ValueError(f"Unknown driver '{config['driver']}' for LiDAR device '{name}', use one of {', '.join(DRIVERS)}")
+        configs[name] = config
+    return configs
+
+def load_device(name=None):
+    """
+    Returns the module driving the LiDAR: the ydlidar SDK bindings or `lidar_simulator`.
+
+    :param name: One of `DRIVERS`, `LIDAR_DEVICE` when `None`.
+    """
+    name = name or LIDAR_DEVICE
+    if name == 'ydlidar':
+        import ydlidar
+        return ydlidar
+    if name == 'simulated':
+        import lidar_simulator
+        return lidar_simulator
+    raise ValueError(f"Unknown LiDAR driver '{name}', use one of {', '.join(DRIVERS)}")
+
+def init_lidar(ydlidar=None, config=None):
+    """
+    :param ydlidar: Module from `load_device`, the driver of `config` when `None`.
+    :param config: Device settings, see `DEVICE_DEFAULTS`.
+    """
+    config = dict(DEVICE_DEFAULTS, **(config or {}))
+    ydlidar = ydlidar or load_device(config['driver'])
     lidar = ydlidar.CYdLidar()
-    lidar.setlidaropt(ydlidar.LidarPropSerialPort, "/dev/ttyUSB0")
-    lidar.setlidaropt(ydlidar.LidarPropSerialBaudrate, 128000)
-    lidar.setlidaropt(ydlidar.LidarPropLidarType, ydlidar.TYPE_TOF)
-    lidar.setlidaropt(ydlidar.LidarPropDeviceType, ydlidar.YDLIDAR_TYPE_SERIAL)
-    lidar.setlidaropt(ydlidar.LidarPropScanFrequency, 10.0)
-    lidar.setlidaropt(ydlidar.LidarPropSampleRate, 5)
-    lidar.setlidaropt(ydlidar.LidarPropSingleChannel, True)
+    lidar.setlidaropt(ydlidar.LidarPropSerialPort, config['port'])
+    lidar.setlidaropt(ydlidar.LidarPropSerialBaudrate, int(config['baudrate']))
+    lidar.setlidaropt(ydlidar.LidarPropLidarType, getattr(ydlidar, config['lidar_type']))
+    lidar.setlidaropt(ydlidar.LidarPropDeviceType, getattr(ydlidar, config['device_type']))
+    lidar.setlidaropt(ydlidar.LidarPropScanFrequency, float(config['scan_frequency']))
+    lidar.setlidaropt(ydlidar.LidarPropSampleRate, int(config['sample_rate']))
+    lidar.setlidaropt(ydlidar.LidarPropSingleChannel, bool(config['single_channel']))
 
     ret = lidar.initialize()
     if not ret:
-        print("Lidar initialization failed.")
-        sys.exit(1)
+        # other devices keep recording, so this must not take the process down
+        raise CaptureError(f"Lidar initialization failed on {config['port']}")
 
     return lidar
 
-def append_to_hdf5(timestamp_dataset, angle_dataset, distance_dataset, epoch_time, angles, distances):
+def append_to_hdf5(timestamp_dataset, angle_dataset, distance_dataset, epoch_time, angles, distances,
+                   intensity_dataset=None, intensities=None):
     """
     Appends data to the HDF5 datasets for the LiDAR readings.
     
     :param timestamp_dataset: The HDF5 dataset for timestamps.
     :param angle_dataset: The HDF5 dataset for angles.
     :param distance_dataset: The HDF5 dataset for distances.
-    :param epoch_time: The timestamp for the current scan.
-    :param angles: List of angle readings.
-    :param distances: List of distance readings.
+    :param epoch_time: The timestamp for the current scan, or one timestamp per reading.
+    :param angles: Array of angle readings.
+    :param distances: Array of distance readings.
+    :param intensity_dataset: The HDF5 dataset for intensities, if the session has one.
+    :param intensities: Array of intensity readings.
     """
     # Calculate the number of new entries
     num_new_entries = len(angles)
@@ -57,130 +368,567 @@ def append_to_hdf5(timestamp_dataset, angle_dataset, distance_dataset, epoch_tim
     distance_dataset.resize(distance_dataset.shape[0] + num_new_entries, axis=0)
 
     # Append the new data to the end of the datasets
-    timestamp_dataset[-num_new_entries:] = np.full(num_new_entries, epoch_time)
+    timestamp_dataset[-num_new_entries:] = np.broadcast_to(epoch_time, num_new_entries)
     angle_dataset[-num_new_entries:] = angles
     distance_dataset[-num_new_entries:] = distances
 
-def start_scanning(lidar, h5_file, path):
-    global stop_event
+    if intensity_dataset is not None:
+        intensity_dataset.resize(intensity_dataset.shape[0] + num_new_entries, axis=0)
+        intensity_dataset[-num_new_entries:] = intensities
 
-    # Turn on the LiDAR sensor
-    lidar.turnOn()
-    print("LiDAR scanning started.")
+def enqueue_scan(scan_queue, scan, drop_policy, stats, buffers):
+    """
+    Hands a `(epoch_time, slot, count)` scan to the writer without ever
+    stalling the device read, unless `drop_policy` is `BLOCK`. The slots of
+    dropped scans go back to `buffers`.
 
-    # Open the HDF5 file in append mode to write data
-    with h5py.File(path, 'a') as f:
-        # Get today's date as the group name
-        today_date = datetime.now().strftime('%Y_%m_%d')
-        
-        # Ensure the group for today exists
-        if today_date not in f:
-            print(f"Error: Group '{today_date}' not found in the HDF5 file.")
-            return
+    :return: True if the scan was queued.
+    """
+    if drop_policy == BLOCK:
+        scan_queue.put(scan)
+        return True
+
+    try:
+        scan_queue.put_nowait(scan)
+        return True
+    except queue.Full:
+        pass
+
+    if drop_policy == DROP_OLDEST:
+        # make room by discarding the scan that has waited the longest
+        try:
+            _, oldest_slot, _ = scan_queue.get_nowait()
+            buffers.release(oldest_slot)
+        except queue.Empty:
+            pass
+        stats.add(scans_dropped=1)
+        try:
+            scan_queue.put_nowait(scan)
+            return True
+        except queue.Full:
+            pass
+
+    buffers.release(scan[1])
+    stats.add(scans_dropped=1)
+    return False
+
+def start_scanning(lidar, scan_queue, buffers, drop_policy=DROP_NEWEST, decimator=None, stats=None,
+                   ydlidar=None, stop_event=None):
+    """
+    Device thread: reads scans from the LiDAR into `buffers` and queues them for `write_scans`.
 
-        # Access today's group
-        day_group = f[today_date]
-        
-        # Find the last session created (or any other session as needed)
-        existing_sessions = [key for key in day_group.keys() if key.startswith('session_')]
-        latest_session = max(existing_sessions, default=None)
-        
-        if latest_session is None:
-            print(f"Error: No session found under '{today_date}' group.")
-            return
+    It never touches the HDF5 file, so a slow disk only fills the queue, and it
+    never sleeps: `doProcessSimple` blocks until the device delivers the next
+    scan and `decimator` (a `ScanDecimator`) decides which ones are kept.
+    Runs until `stop_event` is set.
+    """
+    decimator = decimator or ScanDecimator()
+    stats = stats or CaptureStats()
+    ydlidar = ydlidar or load_device()
 
-        # Access the session group
-        session_group = day_group[latest_session]
+    # Turn on the LiDAR sensor
+    lidar.turnOn()
+    print("LiDAR scanning started.")
 
-        # Access the datasets for timestamp, angle, and distance
-        timestamp_dataset = session_group['readings/timestamp']
-        angle_dataset = session_group['readings/angle']
-        distance_dataset = session_group['readings/distance']
+    while not stop_event.is_set():
+        outscan = ydlidar.LaserScan()  # Create a LaserScan object to store the scan data
+        read_started = time.perf_counter()
+        ret = lidar.doProcessSimple(outscan)  # Pass outscan to capture data
+        stats.read_seconds.observe(time.perf_counter() - read_started)
 
-        while not stop_event.is_set():
-            outscan = ydlidar.LaserScan()  # Create a LaserScan object to store the scan data
-            ret = lidar.doProcessSimple(outscan)  # Pass outscan to capture data
+        if ret:
+            epoch_time = time.time()  # Get the current epoch time
+            stats.add(scans_read=1)
 
-            if ret:
-                epoch_time = time.time()  # Get the current epoch time
+            if not decimator.keep(epoch_time):
+                stats.add(scans_skipped=1)
+                continue
 
-                # Extract the angle and distance data from the scan points
-                angles = [point.angle for point in outscan.points]
-                distances = [point.range for point in outscan.points]
+            # Copy angle, distance and intensity of the scan points into a preallocated slot
+            slot = buffers.acquire()
+            count, truncated = buffers.fill(slot, outscan.points)
 
-                # Append data to the HDF5 file
-                append_to_hdf5(timestamp_dataset, angle_dataset, distance_dataset, epoch_time, angles, distances)
+            stats.add(scans_captured=1, points_truncated=truncated)
+            enqueue_scan(scan_queue, (epoch_time, slot, count), drop_policy, stats, buffers)
+        else:
+            stats.add(read_failures=1)
+            print("Failed to get LiDAR data.")
 
-                # Adjust the delay as needed (e.g., for a 1-second interval)
-                time.sleep(1)
-            else:
-                print("Failed to get LiDAR data.")
+    # tell the writer no more scans are coming
+    scan_queue.put(None)
 
     # Turn off the LiDAR when `stop_event` is set
     lidar.turnOff()
     print("LiDAR scanning stopped.")
 
+def write_batch(f, session_group, batch, buffers, stats, lod=None):
+    """
+    Appends a batch of `(epoch_time, slot, count)` scans to `session_group`
+    with a single resize per dataset, then returns their slots to `buffers`.
+    The points also go to `lod`, a `lidar_lod.LodBuilder`, if given.
+    """
+    timestamps = np.array([epoch_time for epoch_time, _, _ in batch], dtype=np.float64)
+    counts = np.array([count for _, _, count in batch], dtype=np.uint32)
+    points = np.concatenate([buffers.points[slot, :count] for _, slot, count in batch])
+    for _, slot, _ in batch:
+        buffers.release(slot)
+
+    with stats.write_seconds.time():
+        append_scans(session_group, timestamps, counts, points[:, 0], points[:, 1], points[:, 2])
+        if lod:
+            lod.add(np.repeat(timestamps, counts), points[:, 0], points[:, 1])
+    with stats.flush_seconds.time():
+        f.flush()
+    stats.latency_seconds.observe_many(time.time() - timestamps)
+    # timestamp, offset and count per scan, angle, distance and intensity per point
+    stats.bytes_written.inc(len(batch) * 20 + points.nbytes)
+    stats.add(scans_written=len(batch), points_written=len(points), flushes=1)
+
+def _file_lock_path(path):
+    digest = hashlib.sha1(os.path.realpath(path).encode()).hexdigest()[:16]
+    return os.path.join(LIDAR_LOCK_DIR, f'lidar-file-{digest}.lock')
+
+
+@contextmanager
+def writing_file(path, blocking=True):
+    """
+    Holds the write lock of the lidar file at `path`, a lock file in
+    `LIDAR_LOCK_DIR`. The capture holds it while the file is open for
+    writing, so other processes can tell the file is being recorded without
+    opening it, and hold it to keep the capture off the file.
+
+    :raises BlockingIOError: When not `blocking` and someone else holds it.
+    """
+    with open(_file_lock_path(path), 'a+') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX | (0 if blocking else fcntl.LOCK_NB))
+        yield
+
 
-def start_lidar(filename, path):
+def is_being_written(path):
     """
-    1. init the lidar
-    2. create data directory if it doesnt exist
-    3. check if the file exists, ret error if it does not
-    4. create the thread for the lidar
-    5. start the thread for the lidar
+    Whether a capture holds the lidar file at `path` open for writing, see `writing_file`.
     """
-    global lidar_process, lidar, stop_event
+    try:
+        with writing_file(path, blocking=False):
+            return False
+    except BlockingIOError:
+        return True
 
-    lidar = init_lidar()
 
-    h5_file = os.path.join('lidar_files', filename)
-    with h5py.File(path, 'a') as f:
+def new_session(path, device, storage=None):
+    """
+    Creates the next session of today in the HDF5 file at `path`, with the
+    file's storage defaults overridden by `storage`.
+
+    :return: The `day/session` name of the session.
+    """
+    with writing_file(path), open_file(path, 'a') as f:
         # Generate today's date as the group name
         today_date = datetime.now().strftime('%Y_%m_%d')
-        
+
         # Check if the day group exists, and create it if not
         if today_date not in f:
             day_group = f.create_group(today_date)
             print(f"Group '{today_date}' created.")
         else:
             day_group = f[today_date]
-        
+
         # Get the existing session subgroups in the day's group
         existing_sessions = [key for key in day_group.keys() if key.startswith('session_')]
-        
+
         next_session_number = len(existing_sessions) + 1
         next_session_name = f'session_{next_session_number:03d}'
-        
-        session_group = day_group.create_group(next_session_name)
+
+        # one row per scan in scans/, points back to back in points/, see lidar_storage
+        options = storage_options(read_storage_defaults(f), **(storage or {}))
+        session_group = create_session(day_group, next_session_name, options)
+        session_group.attrs['device'] = device
+        if options['lod']:
+            # overviews the writer extends as it goes, see lidar_lod
+            create_lod(session_group, options)
         print(f"Session group '{next_session_name}' created under '{today_date}'.")
-        session_group.create_dataset('readings/timestamp', shape=(0,), maxshape=(None,), dtype='float64')
-        session_group.create_dataset('readings/angle', shape=(0,), maxshape=(None,), dtype='float32')
-        session_group.create_dataset('readings/distance', shape=(0,), maxshape=(None,))
-        session_group.attrs['start_time'] = datetime.now().isoformat()
-    
-    stop_event.clear()
+        return f'{today_date}/{next_session_name}'
 
-    lidar_process = threading.Thread(target=start_scanning, args=(lidar, h5_file, path))
-    lidar_process.start()
 
-    return SUCCESS(200, "Lidar Scanning Started") 
+class Rotation:
+    """
+    When a rolling capture moves on to a new file: once the file it writes
+    reaches `max_bytes` on disk, or after `max_seconds` of recording into it,
+    whichever comes first. Checked by the writer after every batch.
+
+    :param next_file: Called as `next_file()` from the writer thread when the
+        file is full, returns the `(filename, path, index)` of the (existing,
+        empty or not) HDF5 file the capture goes on in, `index` being the
+        session index callback of that file, see `write_scans`.
+    """
 
-def stop_lidar():
-    global lidar_process, lidar
+    def __init__(self, next_file, max_bytes=None, max_seconds=None):
+        if not (max_bytes or max_seconds):
+            raise ValueError("A rotation needs a maximum size or duration")
+        if (max_bytes is not None and max_bytes <= 0) or (max_seconds is not None and max_seconds <= 0):
+            raise ValueError("Rotation size and duration must be positive")
+        self.next_file = next_file
+        self.max_bytes = max_bytes
+        self.max_seconds = max_seconds
+
+    def due(self, path, started):
+        """
+        Whether the file at `path`, written since `started` (`time.monotonic`), is full.
+        """
+        if self.max_seconds and time.monotonic() - started >= self.max_seconds:
+            return True
+        return bool(self.max_bytes) and os.path.getsize(path) >= self.max_bytes
+
+
+def write_scans(path, session, scan_queue, buffers, batch_scans=WRITER_BATCH_SCANS,
+                flush_interval=WRITER_FLUSH_INTERVAL, stats=None, live=None, index=None, stop_event=None,
+                rotation=None, next_segment=None):
+    """
+    Writer thread: drains `scan_queue` into `session` (`day/session` name).
+
+    Scans are appended `batch_scans` at a time, or after `flush_interval`
+    seconds when the device is slow, and the file is flushed after each batch.
+    The file is written in SWMR mode, so every flush is a consistent state
+    other readers can open while the capture goes on.
+    Each scan is also published to `live` as it comes off the queue.
+    Runs until the device thread queues the `None` sentinel, if writing fails
+    it sets `stop_event` to stop the device thread.
+
+    :param index: Called as `index(session, summary)` with the session's
+        `lidar_storage.session_summary` plus `recording`, once when writing
+        starts, after every batch and with `recording` False once the capture ended.
+    :param rotation: A `Rotation`: once it is due the session is finished (as
+        at the end of a capture) and the writer goes on in the `(path, session,
+        index)` returned by `next_segment()`; when that returns `None` it goes
+        on in the same session and tries again after the next batch.
+    """
+    stats = stats or CaptureStats()
+    live = live or LiveScans()
+    finished = False
+    segment = (path, session, index)
+    try:
+        while segment:
+            path, session, index = segment
+            segment = None
+            # Open the HDF5 file in append mode to write data
+            with writing_file(path), open_file(path, 'a') as f:
+                if session not in f:
+                    print(f"Error: Session '{session}' not found in the HDF5 file.")
+                    return
+                session_group = f[session]
+
+                # from here on the writer only grows datasets, readers may open the file
+                swmr = start_swmr(f)
+                with stats.lock:
+                    stats.session = session
+                    stats.swmr = swmr
+
+                def update_index(recording=True):
+                    if not index:
+                        return
+                    # the capture goes on whatever happens to the index
+                    try:
+                        index(session, dict(session_summary(session_group), recording=recording))
+                    except Exception as e:
+                        print(f"Session index update failed: {e}")
+
+                lod = LodBuilder(session_group) if available_levels(session_group) else None
+
+                update_index()
+                started = time.monotonic()
+                batch = []
+                deadline = None
+                while not finished and not segment:
+                    timeout = None if deadline is None else max(deadline - time.monotonic(), 0)
+                    try:
+                        scan = scan_queue.get(timeout=timeout)
+                        if scan is None:
+                            finished = True
+                        else:
+                            batch.append(scan)
+                            live.publish(scan[0], *buffers.view(scan[1], scan[2]))
+                            if deadline is None:
+                                deadline = time.monotonic() + flush_interval
+                    except queue.Empty:
+                        pass
+
+                    if batch and (finished or len(batch) >= batch_scans or time.monotonic() >= deadline):
+                        write_batch(f, session_group, batch, buffers, stats, lod)
+                        update_index()
+                        batch = []
+                        deadline = None
+                        if rotation and not finished and rotation.due(path, started):
+                            # the next file is ready before this one is closed, scans keep queuing meanwhile
+                            segment = next_segment()
+                            if segment:
+                                stats.add(files_rotated=1)
+                            else:
+                                stats.add(rotation_failures=1)
+                if lod:
+                    # the overview rows of the last period
+                    lod.finish()
+                    f.flush()
+                update_index(recording=False)
+    finally:
+        if not finished:
+            # stop the device thread and keep draining so it never blocks on a full queue
+            if stop_event:
+                stop_event.set()
+            while (scan := scan_queue.get()) is not None:
+                buffers.release(scan[1])
+                stats.add(scans_dropped=1)
+
+    print("LiDAR writer stopped.")
+
+
+class Capture:
+    """
+    One configured LiDAR and its capture: device and writer threads, scan
+    queue, counters and live view. Every device records to its own file,
+    independently of the others.
+    """
 
-    stop_event.set()
-    lidar_process.join()
-    lidar_process = None
+    def __init__(self, name, config):
+        self.name = name
+        self.config = config
+        self.lock = threading.Lock()
+        self.stop_event = threading.Event()
+        self.stats = CaptureStats(name)
+        # latest scan for live viewers, fed by the writer thread
+        self.live = LiveScans()
+        self.lidar = None
+        self.device_thread = None
+        self.writer_thread = None
+        self.scan_queue = None
+        self.filename = None
+        self.path = None
+        self.device_lock = None
+
+        CAPTURE_RUNNING.labels(name).function = lambda: int(self.running)
+        QUEUE_DEPTH.labels(name).function = lambda: self.scan_queue.qsize() if self.scan_queue is not None else 0
+        QUEUE_CAPACITY.labels(name).function = lambda: self.stats.queue_capacity
+        LIVE_VIEWERS.labels(name).function = lambda: self.live.viewers
+
+    @property
+    def running(self):
+        return self.device_thread is not None
+
+    def start(self, filename, path, queue_size=SCAN_QUEUE_SIZE, batch_scans=WRITER_BATCH_SCANS,
+              flush_interval=WRITER_FLUSH_INTERVAL, drop_policy=DROP_NEWEST, rate=None, every=1,
+              storage=None, index=None, rotation=None):
+        """
+        Starts recording a new session of `path`, see `start_lidar`.
+        """
+        if drop_policy not in DROP_POLICIES:
+            raise ValueError(f"drop_policy must be one of {', '.join(DROP_POLICIES)}")
+        if rate is not None and rate <= 0:
+            raise ValueError("rate must be a positive number of scans per second")
+        if every < 1:
+            raise ValueError("every must be at least 1")
+        storage = storage or {}
+        storage_options(**storage)
+
+        with self.lock:
+            if self.running:
+                raise CaptureError(f"Lidar {self.name} is already running")
+            # a file has a single writer, see lidar_storage.start_swmr
+            with _captures_lock:
+                for other in _captures.values():
+                    if other is not self and other.path == path:
+                        raise CaptureError(f"{filename} is being recorded by lidar {other.name}")
+                self.path = path
+            try:
+                self._lock_device()
+                self._start(filename, path, queue_size, batch_scans, flush_interval, drop_policy, rate, every,
+                            storage, index, rotation)
+            except BaseException:
+                self.path = None
+                if self.lidar:
+                    self._cleanup()
+                self._unlock_device()
+                raise
+
+    def _lock_device(self):
+        """
+        Takes the lock file of the device, held until the capture stops or the
+        process exits, so a capture started by another process is refused.
+        """
+        lock = open(os.path.join(LIDAR_LOCK_DIR, f'lidar-{self.name}.lock'), 'a+')
+        try:
+            fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            lock.close()
+            raise CaptureError(f"Lidar {self.name} is running in another process")
+        # the pid of the owner, for whoever wonders who holds it
+        lock.truncate(0)
+        lock.write(str(os.getpid()))
+        lock.flush()
+        self.device_lock = lock
+
+    def _unlock_device(self):
+        if self.device_lock:
+            self.device_lock.close()
+            self.device_lock = None
+
+    def _start(self, filename, path, queue_size, batch_scans, flush_interval, drop_policy, rate, every, storage,
+               index, rotation):
+        ydlidar = load_device(self.config['driver'])
+        self.lidar = init_lidar(ydlidar, self.config)
+
+        session = new_session(path, self.name, storage)
+
+        self.filename = filename
+        self.stop_event.clear()
+        self.stats.reset(queue_size, rate, every)
+        self.stats.started_at = datetime.now().isoformat()
+        self.stats.started_monotonic = time.monotonic()
+        self.scan_queue = queue.Queue(maxsize=queue_size)
+        buffers = ScanBuffers(queue_size + batch_scans + 1)
+        # a rolling capture goes on in the files `rotation` hands out, see write_scans
+        next_segment = self._next_segment(rotation.next_file, storage) if rotation else None
+
+        self.writer_thread = threading.Thread(
+            target=write_scans, args=(path, session, self.scan_queue, buffers, batch_scans, flush_interval),
+            kwargs={'stats': self.stats, 'live': self.live, 'index': index, 'stop_event': self.stop_event,
+                    'rotation': rotation, 'next_segment': next_segment},
+            name=f'lidar-writer-{self.name}'
+        )
+        self.writer_thread.start()
+
+        self.device_thread = threading.Thread(
+            target=start_scanning,
+            args=(self.lidar, self.scan_queue, buffers, drop_policy, ScanDecimator(rate, every), self.stats),
+            kwargs={'ydlidar': ydlidar, 'stop_event': self.stop_event}, name=f'lidar-device-{self.name}'
+        )
+        self.device_thread.start()
+
+    def _next_segment(self, next_file, storage):
+        """
+        Returns the `next_segment` callback of the writer of a rolling capture,
+        which starts a new session in the file `next_file()` returns, see `Rotation`.
+        """
+        def next_segment():
+            try:
+                filename, path, index = next_file()
+                session = new_session(path, self.name, storage)
+            except Exception as e:
+                # the capture goes on in the current file
+                print(f"Lidar {self.name} could not move on to a new file: {e}")
+                return None
+            with _captures_lock:
+                self.filename = filename
+                self.path = path
+            print(f"Lidar {self.name} moved on to {filename}.")
+            return path, session, index
+        return next_segment
+
+    def stop(self):
+        """
+        Stops the capture once the writer has written every queued scan.
+        """
+        with self.lock:
+            if not self.running:
+                raise CaptureError(f"Lidar {self.name} is already stopped")
+            self.stop_event.set()
+            self.device_thread.join()
+            self.device_thread = None
+
+            # the writer exits once it has drained the queue up to the sentinel
+            self.writer_thread.join()
+            self.writer_thread = None
+            self.path = None
+
+            self._cleanup()
+            self._unlock_device()
+
+    def _cleanup(self):
+        self.lidar.turnOff()
+        self.lidar.disconnecting()
+        self.lidar = None
+        print(f'Lidar {self.name} cleanup complete.')
+
+    def status(self):
+        """
+        Returns the counters of the current (or last) capture.
+        """
+        status = self.stats.snapshot(self.scan_queue)
+        status['device'] = self.name
+        status['driver'] = self.config['driver']
+        status['port'] = self.config['port']
+        status['filename'] = self.filename
+        status['running'] = self.running
+        status['live_viewers'] = self.live.viewers
+        return status
+
+
+# configured devices by name, created on first use
+_captures = {}
+_captures_lock = threading.RLock()
+
+def captures():
+    """
+    Returns the `Capture` of every configured device by name, default device first.
+    """
+    with _captures_lock:
+        if not _captures:
+            for name, config in device_configs().items():
+                _captures[name] = Capture(name, config)
+        return dict(_captures)
 
-    cleanup()
-    return SUCCESS(200, 'Lidar stopped successfully')
+def get_capture(device=None):
+    """
+    Returns the `Capture` of `device`, the default device when `None`.
 
-def cleanup():
-    global lidar
-    if not lidar:
-        return ERROR(400, 'Cleanup called but lidar not initialized.')
-    lidar.turnOff()
-    lidar.disconnecting()
+    :raise KeyError: `device` is not configured.
+    """
+    devices = captures()
+    if device is None:
+        return next(iter(devices.values()))
+    if device not in devices:
+        raise KeyError(f"Unknown lidar device '{device}'")
+    return devices[device]
+
+def capture_status(device=None):
+    """
+    Returns the counters of the current (or last) capture of `device`.
+    """
+    return get_capture(device).status()
 
-    lidar = None
-    print('Lidar cleanup complete.')
+def start_lidar(filename, path, queue_size=SCAN_QUEUE_SIZE, batch_scans=WRITER_BATCH_SCANS,
+                flush_interval=WRITER_FLUSH_INTERVAL, drop_policy=DROP_NEWEST, rate=None, every=1,
+                storage=None, index=None, device=None, rotation=None):
+    """
+    1. init the lidar
+    2. create data directory if it doesnt exist
+    3. check if the file exists, ret error if it does not
+    4. create the device and writer threads for the lidar
+    5. start the threads for the lidar
+
+    :param queue_size: Scans buffered between the device and writer threads.
+    :param batch_scans: Scans appended to the file per write.
+    :param flush_interval: Seconds before a partial batch is written.
+    :param drop_policy: What the device thread does when the queue is full:
+        `drop_newest` discards the new scan, `drop_oldest` discards the oldest
+        queued scan, `block` waits for the writer (and may miss device data).
+    :param rate: Maximum scans per second to keep, `None` keeps the full device rate.
+    :param every: Keep one scan out of every `every` read from the device.
+    :param storage: Storage option overrides for the new session (chunk_points,
+        compression, compression_level, shuffle, quantize), on top of the
+        file's defaults, see `lidar_storage.storage_options`.
+    :param index: Keeps a session index up to date, see `write_scans`.
+    :param device: Name of a configured device, see `device_configs`, the default device when `None`.
+    :param rotation: Records continuously into a series of files: a `Rotation`
+        telling when the file is full and which file comes next.
+    :raise CaptureError: The device is already running or another device is recording `path`.
+    """
+    get_capture(device).start(
+        filename, path, queue_size, batch_scans, flush_interval, drop_policy, rate, every, storage, index, rotation
+    )
+    return SUCCESS(200, "Lidar Scanning Started")
+
+def stop_lidar(device=None):
+    """
+    :raise CaptureError: The device is not running.
+    """
+    get_capture(device).stop()
+    return SUCCESS(200, 'Lidar stopped successfully')
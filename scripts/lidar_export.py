@@ -0,0 +1,595 @@
+import multiprocessing
+import os
+import shutil
+import tempfile
+import time
+import zlib
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import contextmanager
+
+import numpy as np
+
+from lidar_metrics import counter, gauge, histogram
+from lidar_storage import SessionReader, open_file
+
+# number of points read from each readings dataset per slice; bounds the
+# memory used by a conversion regardless of how long a session ran
+CHUNK_SIZE = 1 << 18
+
+CSV_HEADER = ['Timestamp', 'Angle', 'Distance']
+CSV_LINE_TERMINATOR = '\r\n'  # matches csv.writer's default dialect
+
+# decimals written for each column: microseconds for the epoch timestamps,
+# which is also the resolution of time.time(), and well below the sensor's
+# precision for the angle (radians) and distance (metres)
+CSV_DECIMALS = (6, 6, 6)
+
+# export formats and the extension of their files, see `convert_hdf5`: csv,
+# Parquet, Arrow IPC (random access file format) and a NumPy `.npy` record
+# array that `np.load(path, mmap_mode='r')` maps without reading it
+EXPORT_FORMATS = {'csv': '.csv', 'parquet': '.parquet', 'arrow': '.arrow', 'npy': '.npy'}
+
+# columns of the binary formats, with the types the capture stores them in
+EXPORT_DTYPE = np.dtype([(CSV_HEADER[0], '<f8'), (CSV_HEADER[1], '<f4'), (CSV_HEADER[2], '<f4')])
+
+# compression of the Parquet column chunks, cheap enough to not slow the export down
+PARQUET_COMPRESSION = 'snappy'
+
+# points converted by one task of a batch export (`export_csv`): long sessions
+# are split so that a single one still keeps every worker busy
+PART_SIZE = 1 << 22
+
+# worker processes of a batch export, leaving a core for the capture
+EXPORT_WORKERS = max(1, (os.cpu_count() or 1) - 1)
+
+# gzip level of `.csv.gz` conversions, gzip's own default
+GZIP_LEVEL = 6
+
+# bytes copied at a time when concatenating the parts of a batch export
+COPY_BUFFER = 1 << 20
+
+CONVERT_ROWS = counter('lidar_convert_rows_total', 'Rows written by HDF5 to CSV conversions')
+CONVERT_BYTES = counter('lidar_convert_bytes_total', 'CSV bytes written by conversions')
+CONVERT_SLICE_SECONDS = histogram('lidar_convert_slice_seconds', 'Time to read, format and write one slice')
+CONVERT_SECONDS = histogram(
+    'lidar_convert_seconds', 'Duration of whole conversions',
+    buckets=(0.1, 0.5, 1.0, 5.0, 10.0, 30.0, 60.0, 120.0, 300.0, 600.0, 1800.0),
+)
+CONVERT_RATE = gauge('lidar_convert_rows_per_second', 'Rows per second of the last finished conversion')
+CONVERSIONS_RUNNING = gauge('lidar_conversions_running', 'Conversions in progress')
+
+_MINUS, _DOT = ord('-'), ord('.')
+_ZERO = ord('0')
+
+# largest scaled magnitude `_encode_fixed` takes, its int64 digit arithmetic
+# would overflow beyond it; kept below 2**63 so rounding cannot reach it
+_FIXED_LIMIT = 2.0 ** 62
+
+
+def iter_sessions(h5_file):
+    """
+    Yields `(day_name, session_name, session_group)` for every session in an open HDF5 file.
+    """
+    for day_group_name in h5_file.keys():
+        day_group = h5_file[day_group_name]
+        for session_name in day_group:
+            yield day_group_name, session_name, day_group[session_name]
+
+
+def iter_reading_blocks(session_group, chunk_size=CHUNK_SIZE, start=0, stop=None):
+    """
+    Yields `(timestamps, angles, distances)` slices of at most `chunk_size` points.
+
+    Works for both session layouts, see `lidar_storage`.
+
+    :param session_group: The session group, or a `SessionReader` of it.
+    :param chunk_size: Maximum number of points per slice.
+    :param start: Index of the first point.
+    :param stop: Index after the last point, the end of the session by default.
+    """
+    reader = session_group if isinstance(session_group, SessionReader) else SessionReader(session_group)
+    for timestamps, angles, distances, _ in reader.iter_blocks(chunk_size, start, stop):
+        yield timestamps, angles, distances
+
+
+def _fits_fixed(values, decimals):
+    """
+    Whether every value is finite and small enough for `_encode_fixed`.
+    """
+    values = np.asarray(values, dtype=np.float64)
+    # NaN compares False, so it fails the bound like inf does
+    return bool((np.abs(values) * 10 ** decimals < _FIXED_LIMIT).all())
+
+
+def _encode_fixed(values, decimals):
+    """
+    Renders `values` as fixed-point decimal text, one row per value.
+    Every value must pass `_fits_fixed`.
+
+    Returns a `(chars, mask)` pair of `(n, width)` arrays: `chars` holds the
+    ASCII bytes right-aligned in a fixed-width field and `mask` marks which of
+    them are part of the number (leading zeros and unused sign slots are off).
+    """
+    scale = 10 ** decimals
+    values = np.asarray(values, dtype=np.float64)
+    quantized = np.rint(np.abs(values) * scale).astype(np.int64)
+    whole, frac = np.divmod(quantized, scale)
+
+    int_width = len(str(int(whole.max()))) if len(whole) else 1
+    width = 1 + int_width + 1 + decimals
+    chars = np.empty((len(values), width), dtype=np.uint8)
+    mask = np.ones((len(values), width), dtype=bool)
+
+    # sign, only when the rounded value is not zero so we never emit "-0.000000"
+    chars[:, 0] = _MINUS
+    mask[:, 0] = (values < 0) & (quantized > 0)
+
+    # integer part, least significant digit first
+    remaining = whole
+    for i in range(int_width, 0, -1):
+        remaining, digit = np.divmod(remaining, 10)
+        chars[:, i] = digit + _ZERO
+
+    # hide leading zeros but always keep the units digit
+    num_digits = np.ones(len(values), dtype=np.int64)
+    for power in range(1, int_width):
+        num_digits += whole >= 10 ** power
+    mask[:, 1:1 + int_width] = np.arange(int_width) >= (int_width - num_digits)[:, None]
+
+    chars[:, 1 + int_width] = _DOT
+
+    remaining = frac
+    for i in range(width - 1, 1 + int_width, -1):
+        remaining, digit = np.divmod(remaining, 10)
+        chars[:, i] = digit + _ZERO
+
+    return chars, mask
+
+
+def format_csv_block(columns, decimals=CSV_DECIMALS):
+    """
+    Formats a block of equally sized columns as CSV text in a single pass.
+
+    All the digit arithmetic is done on whole columns with NumPy, the rows are
+    then stitched together by dropping the masked padding, so the cost per
+    point is a handful of vector operations instead of a Python call.
+    Blocks holding NaN, inf or values too large for fixed-point digits
+    (see `_fits_fixed`) fall back to `repr` formatting for every row.
+
+    :param columns: Sequence of 1-D arrays of the same length.
+    :param decimals: Number of decimals written for each column.
+    :return: The encoded rows as `bytes`.
+    """
+    num_rows = len(columns[0])
+    if num_rows == 0:
+        return b''
+
+    if not all(_fits_fixed(column, column_decimals) for column, column_decimals in zip(columns, decimals)):
+        row = ','.join(['%r'] * len(columns)) + CSV_LINE_TERMINATOR
+        rows = np.column_stack([np.asarray(c, dtype=np.float64) for c in columns])
+        return ((row * num_rows) % tuple(rows.ravel().tolist())).encode('ascii')
+
+    all_chars, all_masks = [], []
+    for index, (column, column_decimals) in enumerate(zip(columns, decimals)):
+        chars, mask = _encode_fixed(column, column_decimals)
+        all_chars.append(chars)
+        all_masks.append(mask)
+
+        separator = ',' if index < len(columns) - 1 else CSV_LINE_TERMINATOR
+        all_chars.append(np.tile(np.frombuffer(separator.encode('ascii'), dtype=np.uint8), (num_rows, 1)))
+        all_masks.append(np.ones((num_rows, len(separator)), dtype=bool))
+
+    chars = np.hstack(all_chars)
+    mask = np.hstack(all_masks)
+    return chars[mask].tobytes()
+
+
+def count_readings(h5_file):
+    """
+    Returns the number of rows `iter_reading_blocks` yields over all sessions of an open HDF5 file.
+    """
+    return sum(SessionReader(session_group).num_points for _, _, session_group in iter_sessions(h5_file))
+
+
+class GzipMembers:
+    """
+    Binary file object compressing what is written to it into `raw` as gzip.
+
+    Every `tell`, `seek` or `flush` ends the gzip member being written, so the
+    offsets `tell` returns are member boundaries: the file can be cut back to
+    one of them and written on, gzip readers decompress consecutive members as
+    one stream. That lets `update_csv` keep a `.csv.gz` up to date like a csv.
+    """
+
+    def __init__(self, raw, level=GZIP_LEVEL):
+        self.raw = raw
+        self.level = level
+        self.compressor = None
+
+    def write(self, data):
+        if data:
+            if self.compressor is None:
+                self.compressor = zlib.compressobj(self.level, zlib.DEFLATED, 31)
+            self.raw.write(self.compressor.compress(data))
+        return len(data)
+
+    def _end_member(self):
+        if self.compressor is not None:
+            self.raw.write(self.compressor.flush())
+            self.compressor = None
+
+    def tell(self):
+        self._end_member()
+        return self.raw.tell()
+
+    def seek(self, offset, whence=0):
+        self._end_member()
+        return self.raw.seek(offset, whence)
+
+    def truncate(self, size=None):
+        self._end_member()
+        return self.raw.truncate(size)
+
+    def flush(self):
+        self._end_member()
+        self.raw.flush()
+
+    def close(self):
+        """
+        Ends the last member, `raw` stays open.
+        """
+        self._end_member()
+
+
+@contextmanager
+def _conversion():
+    """
+    Keeps the conversion metrics, the block sets `rows` on what it yields.
+    """
+    started = time.perf_counter()
+    CONVERSIONS_RUNNING.inc()
+    result = {'rows': 0}
+    try:
+        yield result
+    finally:
+        CONVERSIONS_RUNNING.dec()
+
+    elapsed = time.perf_counter() - started
+    CONVERT_SECONDS.observe(elapsed)
+    CONVERT_RATE.set(result['rows'] / elapsed if elapsed else 0)
+
+
+def _write_rows(csv_file, reader, chunk_size, start=0, done=0, progress=None, total=None, stop=None):
+    """
+    Writes the rows of a session from point `start` (up to `stop`) to `csv_file`, a slice at a time.
+
+    :param reader: `SessionReader` of the session.
+    :param done: Rows the conversion wrote before, for `progress`.
+    :return: The number of rows written.
+    """
+    num_rows = 0
+    blocks = iter_reading_blocks(reader, chunk_size, start, stop)
+    while True:
+        slice_started = time.perf_counter()
+        block = next(blocks, None)
+        if block is None:
+            return num_rows
+        data = format_csv_block(block)
+        csv_file.write(data)
+        CONVERT_SLICE_SECONDS.observe(time.perf_counter() - slice_started)
+        CONVERT_ROWS.inc(len(block[0]))
+        CONVERT_BYTES.inc(len(data))
+        num_rows += len(block[0])
+        if progress:
+            progress(done + num_rows, total)
+
+
+def convert_hdf5_to_csv(h5_file_path, csv_file, chunk_size=CHUNK_SIZE, progress=None):
+    """
+    Writes every session of the HDF5 file at `h5_file_path` to `csv_file`.
+
+    :param h5_file_path: Path of the lidar HDF5 file.
+    :param csv_file: Binary file object the CSV is written to.
+    :param chunk_size: Number of points converted per slice.
+    :param progress: Optional `progress(rows_written, total_rows)` callback, called after each slice.
+    :return: The number of data rows written.
+    """
+    with _conversion() as result:
+        csv_file.write((','.join(CSV_HEADER) + CSV_LINE_TERMINATOR).encode('ascii'))
+
+        with open_file(h5_file_path) as f:
+            total = count_readings(f) if progress else None
+            for _, _, session_group in iter_sessions(f):
+                result['rows'] += _write_rows(
+                    csv_file, SessionReader(session_group), chunk_size, 0, result['rows'], progress, total
+                )
+
+    return result['rows']
+
+
+class _NpyWriter:
+    """
+    Writes a `.npy` file of `num_rows` `EXPORT_DTYPE` records a block at a time.
+    """
+
+    def __init__(self, out_file, num_rows):
+        self.out_file = out_file
+        np.lib.format.write_array_header_1_0(out_file, {
+            'descr': np.lib.format.dtype_to_descr(EXPORT_DTYPE),
+            'fortran_order': False,
+            'shape': (num_rows,),
+        })
+
+    def write(self, timestamps, angles, distances):
+        records = np.empty(len(timestamps), dtype=EXPORT_DTYPE)
+        for name, column in zip(EXPORT_DTYPE.names, (timestamps, angles, distances)):
+            records[name] = column
+        self.out_file.write(records.tobytes())
+
+    def close(self):
+        pass
+
+
+class _ArrowWriter:
+    """
+    Writes an Arrow IPC file, or a Parquet file with one row group per block.
+    """
+
+    def __init__(self, out_file, num_rows, parquet=False):
+        import pyarrow as pa
+
+        self.pa = pa
+        self.schema = pa.schema([(name, pa.from_numpy_dtype(EXPORT_DTYPE[name])) for name in EXPORT_DTYPE.names])
+        if parquet:
+            import pyarrow.parquet as pq
+            self.writer = pq.ParquetWriter(out_file, self.schema, compression=PARQUET_COMPRESSION)
+        else:
+            self.writer = pa.ipc.new_file(out_file, self.schema)
+
+    def write(self, timestamps, angles, distances):
+        columns = [
+            np.asarray(column, dtype=EXPORT_DTYPE[name])
+            for name, column in zip(EXPORT_DTYPE.names, (timestamps, angles, distances))
+        ]
+        self.writer.write_batch(self.pa.record_batch(columns, schema=self.schema))
+
+    def close(self):
+        self.writer.close()
+
+
+_WRITERS = {
+    'parquet': lambda out_file, num_rows: _ArrowWriter(out_file, num_rows, parquet=True),
+    'arrow': _ArrowWriter,
+    'npy': _NpyWriter,
+}
+
+
+def convert_hdf5(h5_file_path, out_file, format='csv', chunk_size=CHUNK_SIZE, progress=None):
+    """
+    Writes every session of the HDF5 file at `h5_file_path` to `out_file` in one of `EXPORT_FORMATS`.
+
+    The binary formats hold the columns of the csv with the stored precision
+    (float64 timestamps, float32 angle and distance) and are written a slice
+    at a time like the csv. Parquet and Arrow IPC need `pyarrow`.
+
+    :param out_file: Binary file object the export is written to.
+    :param format: `csv`, `parquet`, `arrow` or `npy`.
+    :param chunk_size: Number of points per slice, and per Parquet row group or Arrow record batch.
+    :param progress: Optional `progress(rows_written, total_rows)` callback, called after each slice.
+    :return: The number of data rows written.
+    """
+    if format == 'csv':
+        return convert_hdf5_to_csv(h5_file_path, out_file, chunk_size, progress)
+    if format not in _WRITERS:
+        raise ValueError(f"Unknown export format '{format}', expected one of {', '.join(EXPORT_FORMATS)}")
+
+    with _conversion() as result, open_file(h5_file_path) as f:
+        # the points on disk now, a session still being recorded keeps growing
+        readers = [SessionReader(session_group) for _, _, session_group in iter_sessions(f)]
+        total = sum(reader.num_points for reader in readers)
+
+        offset = out_file.tell()
+        writer = _WRITERS[format](out_file, total)
+        for reader in readers:
+            blocks = iter_reading_blocks(reader, chunk_size)
+            while True:
+                slice_started = time.perf_counter()
+                block = next(blocks, None)
+                if block is None:
+                    break
+                writer.write(*block)
+                CONVERT_SLICE_SECONDS.observe(time.perf_counter() - slice_started)
+                CONVERT_ROWS.inc(len(block[0]))
+                result['rows'] += len(block[0])
+                if progress:
+                    progress(result['rows'], total)
+        writer.close()
+        CONVERT_BYTES.inc(out_file.tell() - offset)
+
+    return result['rows']
+
+
+def _last_timestamp(reader, rows):
+    return float(reader.point_timestamps(rows - 1, rows)[0]) if rows else None
+
+
+def _unchanged(reader, converted):
+    """
+    Whether the first `converted['rows']` points of a session are the ones
+    that were converted: sessions only ever grow, so the count and the
+    timestamp of the last converted point identify them.
+    """
+    rows = converted['rows']
+    return rows <= reader.num_points and _last_timestamp(reader, rows) == converted['last_timestamp']
+
+
+def update_csv(h5_file_path, csv_file, converted=None, chunk_size=CHUNK_SIZE, progress=None):
+    """
+    Brings a CSV of the HDF5 file at `h5_file_path` up to date, converting only
+    what the file gained since the CSV was last written.
+
+    The CSV holds the sessions in file order. Sessions that did not change are
+    kept as they are, a session that grew gets its new rows appended and new
+    sessions are appended after it. A session that changed any other way is
+    converted again from its start, with every session after it.
+
+    :param csv_file: Binary file object opened for reading and writing (`r+b`).
+    :param converted: What the CSV holds, as returned by the previous call;
+        empty or `None` converts everything.
+    :param progress: Optional `progress(rows_written, total_rows)` callback for
+        the rows converted by this call.
+    :return: `(converted, rows_written)`: one `{'session', 'rows', 'end',
+        'last_timestamp'}` per session now in the CSV, `end` being the byte
+        offset its rows end at, and the number of rows written by this call.
+    """
+    header = (','.join(CSV_HEADER) + CSV_LINE_TERMINATOR).encode('ascii')
+    converted = list(converted or [])
+    csv_file.seek(0, 2)
+    size = csv_file.tell()
+
+    with _conversion() as result, open_file(h5_file_path) as f:
+        sessions = [(f'{day}/{name}', SessionReader(group)) for day, name, group in iter_sessions(f)]
+
+        # the sessions the CSV already holds in full, and where to resume
+        kept = []
+        offset = len(header)
+        resume, start = len(sessions), 0
+        for index, (session, reader) in enumerate(sessions):
+            cached = converted[index] if index < len(converted) else None
+            if cached is None or cached['session'] != session or cached['end'] > size or not _unchanged(reader, cached):
+                resume = index
+                break
+            if reader.num_points > cached['rows']:
+                # recorded on since: append the new rows after the old ones
+                resume, start, offset = index, cached['rows'], cached['end']
+                break
+            kept.append(cached)
+            offset = cached['end']
+
+        if size < len(header) or (not kept and not start):
+            offset = 0
+        csv_file.seek(offset)
+        csv_file.truncate()
+        if not offset:
+            csv_file.write(header)
+
+        total = sum(reader.num_points for _, reader in sessions[resume:]) - start if progress else None
+        for session, reader in sessions[resume:]:
+            result['rows'] += _write_rows(csv_file, reader, chunk_size, start, result['rows'], progress, total)
+            start = 0
+            kept.append({
+                'session': session,
+                'rows': reader.num_points,
+                'end': csv_file.tell(),
+                'last_timestamp': _last_timestamp(reader, reader.num_points),
+            })
+
+    return kept, result['rows']
+
+
+def plan_export(h5_file_paths, first_day=None, last_day=None, part_size=PART_SIZE):
+    """
+    Splits the sessions of HDF5 files into the parts of a batch export, in the order of the CSV.
+
+    :param h5_file_paths: Paths of the lidar HDF5 files, their sessions are exported in this order.
+    :param first_day: Name of the first day group exported (`YYYY_MM_DD`), every day when `None`.
+    :param last_day: Name of the last day group exported, every day when `None`.
+    :return: A list of `(h5_file_path, session, start, stop)`, `session` being `day/session`
+        and `start`/`stop` the points of the session the part holds.
+    """
+    parts = []
+    for path in h5_file_paths:
+        with open_file(path) as f:
+            for day, name, session_group in iter_sessions(f):
+                if (first_day and day < first_day) or (last_day and day > last_day):
+                    continue
+                num_points = SessionReader(session_group).num_points
+                for start in range(0, num_points, part_size):
+                    parts.append((path, f'{day}/{name}', start, min(start + part_size, num_points)))
+    return parts
+
+
+def _export_part(part, part_path, chunk_size, gzip_level=None):
+    """
+    Converts one part of a batch export to the file `part_path`, run by the worker processes.
+
+    :param gzip_level: Compress the part as a gzip member at this level.
+    :return: The number of rows written.
+    """
+    h5_file_path, session, start, stop = part
+    with open_file(h5_file_path) as f, open(part_path, 'wb') as part_file:
+        out = GzipMembers(part_file, gzip_level) if gzip_level else part_file
+        rows = _write_rows(out, SessionReader(f[session]), chunk_size, start, stop=stop)
+        out.flush()
+        return rows
+
+
+def export_csv(parts, csv_file, workers=EXPORT_WORKERS, work_dir=None, chunk_size=CHUNK_SIZE, progress=None,
+               gzip_level=None):
+    """
+    Writes the parts planned by `plan_export` to `csv_file` as one CSV, with
+    the same rows as converting each file with `convert_hdf5_to_csv` and
+    concatenating them.
+
+    The parts are converted by `workers` processes, each to a temporary file
+    in `work_dir` that is appended to `csv_file` once the parts before it are
+    and then removed. At most two parts per worker are in flight, which bounds
+    the temporary disk space.
+
+    :param csv_file: Binary file object the CSV is written to.
+    :param workers: Worker processes, `1` converts the parts in this process.
+    :param work_dir: Directory of the temporary files, best on the disk of the CSV.
+    :param progress: Optional `progress(rows_written, total_rows)` callback, called after each part.
+    :param gzip_level: Write a `.csv.gz` compressed at this level. Each part
+        is compressed by its worker as a gzip member of its own, so the
+        compression is spread over the workers too.
+    :return: The number of data rows written.
+    """
+    total = sum(stop - start for _, _, start, stop in parts)
+    with _conversion() as result:
+        out = GzipMembers(csv_file, gzip_level) if gzip_level else csv_file
+        out.write((','.join(CSV_HEADER) + CSV_LINE_TERMINATOR).encode('ascii'))
+
+        if workers <= 1:
+            for h5_file_path, session, start, stop in parts:
+                with open_file(h5_file_path) as f:
+                    result['rows'] += _write_rows(
+                        out, SessionReader(f[session]), chunk_size, start, result['rows'], progress, total, stop
+                    )
+            out.flush()
+            return result['rows']
+        out.flush()
+
+        # spawned, not forked: the web process has capture and job threads running
+        context = multiprocessing.get_context('spawn')
+        with tempfile.TemporaryDirectory(prefix='lidar-export-', dir=work_dir) as tmp, \
+                ProcessPoolExecutor(max_workers=workers, mp_context=context) as pool:
+            pending = deque()
+
+            def append_oldest():
+                future, part_path = pending.popleft()
+                rows = future.result()
+                with open(part_path, 'rb') as part_file:
+                    shutil.copyfileobj(part_file, csv_file, COPY_BUFFER)
+                CONVERT_ROWS.inc(rows)
+                CONVERT_BYTES.inc(os.path.getsize(part_path))
+                os.unlink(part_path)
+                result['rows'] += rows
+                if progress:
+                    progress(result['rows'], total)
+
+            try:
+                for index, part in enumerate(parts):
+                    if len(pending) >= 2 * workers:
+                        append_oldest()
+                    part_path = os.path.join(tmp, f'part-{index:06d}.csv')
+                    pending.append((pool.submit(_export_part, part, part_path, chunk_size, gzip_level), part_path))
+                while pending:
+                    append_oldest()
+            except BaseException:
+                for future, _ in pending:
+                    future.cancel()
+                raise
+
+    return result['rows']
@@ -0,0 +1,187 @@
+"""
+Live view of the running capture.
+
+The capture's writer thread publishes every scan it takes off the queue to
+a `LiveScans`, which keeps only the latest one. Viewers never talk to the
+capture: each polls `LiveScans` at its own pace and skips whatever it was
+too slow or too decimated to see. Publishing is a copy of one scan when at
+least one viewer is connected and nothing otherwise, however many viewers
+there are, and each scan is encoded once per distinct viewer setting.
+
+Events are Server-Sent Events, `iter_events` serves them from a thread
+(WSGI) and `aiter_events` from the event loop (ASGI).
+"""
+import asyncio
+import json
+import math
+import threading
+import time
+
+import numpy as np
+
+# seconds between two looks at the latest scan, bounds the added latency
+POLL_INTERVAL = 0.02
+
+# seconds without a scan after which a comment line keeps proxies from
+# closing the connection
+KEEPALIVE_INTERVAL = 15.0
+
+# angular bins a viewer may ask for, 0.1 degree at most
+MAX_BINS = 3600
+
+# decimals sent for angles (radians) and distances (metres)
+LIVE_DECIMALS = 4
+
+KEEPALIVE_EVENT = b': keepalive\n\n'
+
+
+def bin_scan(angles, distances, bins):
+    """
+    Reduces a scan to the nearest valid distance in each of `bins` equal
+    angular sectors over `[-pi, pi)`, `nan` for sectors without a point.
+
+    :return: `(bin_centres, distances)` float32 arrays.
+    """
+    sector = np.floor((np.asarray(angles, dtype=np.float64) + math.pi) * (bins / (2 * math.pi))).astype(np.intp) % bins
+    valid = distances > 0
+    nearest = np.full(bins, np.inf, dtype=np.float32)
+    np.minimum.at(nearest, sector[valid], distances[valid])
+    nearest[np.isinf(nearest)] = np.nan
+    centres = (-math.pi + (np.arange(bins) + 0.5) * (2 * math.pi / bins)).astype(np.float32)
+    return centres, nearest
+
+
+def _json_values(values):
+    return [None if math.isnan(value) else value for value in np.round(values.astype(np.float64), LIVE_DECIMALS).tolist()]
+
+
+class LiveScans:
+    """
+    Latest scan of the capture, shared by every live viewer.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.viewers = 0
+        self.seq = 0
+        self.latest = None
+        self._events = {}
+
+    def subscribe(self):
+        with self.lock:
+            self.viewers += 1
+
+    def unsubscribe(self):
+        with self.lock:
+            self.viewers -= 1
+            if not self.viewers:
+                self.latest = None
+                self._events.clear()
+
+    def publish(self, timestamp, angles, distances, intensities):
+        """
+        Makes a scan the latest one. Called by the capture for every scan,
+        it only copies the scan when someone is watching.
+        """
+        if not self.viewers:
+            return
+        scan = (self.seq + 1, timestamp, angles.copy(), distances.copy(), intensities.copy())
+        # a single reference swap, viewers read `latest` without locking
+        self.latest = scan
+        self.seq = scan[0]
+
+    def event(self, bins=None):
+        """
+        Returns `(seq, event)` for the latest scan as an SSE `scan` event,
+        encoded once per `bins` setting, or `None` before the first scan.
+        """
+        scan = self.latest
+        if scan is None:
+            return None
+        seq, timestamp, angles, distances, intensities = scan
+
+        with self.lock:
+            cached = self._events.get(bins)
+        if cached and cached[0] == seq:
+            return cached
+
+        if bins:
+            angles, distances = bin_scan(angles, distances, bins)
+            data = {'seq': seq, 'timestamp': timestamp, 'bins': bins,
+                    'angle': _json_values(angles), 'distance': _json_values(distances)}
+        else:
+            data = {'seq': seq, 'timestamp': timestamp, 'angle': _json_values(angles),
+                    'distance': _json_values(distances), 'intensity': _json_values(intensities)}
+        event = f'id: {seq}\nevent: scan\ndata: {json.dumps(data, separators=(",", ":"))}\n\n'.encode()
+
+        with self.lock:
+            self._events[bins] = (seq, event)
+        return seq, event
+
+
+class _Viewer:
+    """
+    What one connection has seen and when it may receive the next scan.
+    """
+
+    def __init__(self, live, rate=None, bins=None):
+        self.live = live
+        self.period = 1.0 / rate if rate else 0.0
+        self.bins = bins
+        self.seen = 0
+        self.next_due = 0.0
+        self.last_sent = time.monotonic()
+
+    def next_event(self):
+        """
+        Returns the event to send now, if any, and the seconds to wait before asking again.
+        """
+        now = time.monotonic()
+        if now >= self.next_due and self.live.seq != self.seen:
+            latest = self.live.event(self.bins)
+            if latest is not None:
+                self.seen, event = latest
+                self.next_due = now + self.period
+                self.last_sent = now
+                return event, max(self.period, POLL_INTERVAL)
+        if now - self.last_sent >= KEEPALIVE_INTERVAL:
+            self.last_sent = now
+            return KEEPALIVE_EVENT, POLL_INTERVAL
+        return None, max(min(self.next_due - now, KEEPALIVE_INTERVAL), POLL_INTERVAL)
+
+
+def iter_events(live, rate=None, bins=None):
+    """
+    Yields SSE events of the latest scans for one viewer, forever.
+
+    :param rate: Maximum scans per second sent to this viewer, `None` for every scan.
+    :param bins: Number of angular bins to reduce each scan to, `None` for every point.
+    """
+    live.subscribe()
+    try:
+        viewer = _Viewer(live, rate, bins)
+        yield b'retry: 1000\n\n'
+        while True:
+            event, wait = viewer.next_event()
+            if event:
+                yield event
+            time.sleep(wait)
+    finally:
+        live.unsubscribe()
+
+
+async def aiter_events(live, rate=None, bins=None):
+    """
+    Same as `iter_events`, waiting on the event loop instead of a thread.
+    """
+    live.subscribe()
+    try:
+        viewer = _Viewer(live, rate, bins)
+        yield b'retry: 1000\n\n'
+        while True:
+            event, wait = viewer.next_event()
+            if event:
+                yield event
+            await asyncio.sleep(wait)
+    finally:
+        live.unsubscribe()
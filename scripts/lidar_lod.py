@@ -0,0 +1,193 @@
+"""
+Level-of-detail overviews of a session, for plotting long time windows.
+
+Each level reduces a session to one row per `period` seconds and one column
+per angular bin over `[-pi, pi)`, holding the min, mean and max valid
+distance and the number of points that fell into the cell:
+
+    session_001
+    |-- lod/1s/timestamp    float64, start of each period
+    |-- lod/1s/min          float32, (rows, LOD_BINS)
+    |-- lod/1s/mean         float32, (rows, LOD_BINS)
+    |-- lod/1s/max          float32, (rows, LOD_BINS)
+    |-- lod/1s/count        uint32, (rows, LOD_BINS)
+    |-- lod/60s/...
+
+Periods without a valid point have no row. A capture with the `lod` storage
+option creates the levels together with the session and extends them with a
+`LodBuilder` after every batch, `build_lod` builds them for a recorded session.
+"""
+import json
+import math
+
+import numpy as np
+
+from lidar_storage import SessionReader, dataset_filters, storage_options
+
+# level name -> seconds per row, finest first
+LOD_LEVELS = {'1s': 1.0, '60s': 60.0}
+
+# angular bins per row, 1 degree
+LOD_BINS = 360
+
+# rows per chunk of the lod/ datasets
+LOD_CHUNK_ROWS = 64
+
+# points read at once by `build_lod`
+LOD_BUILD_CHUNK = 1_000_000
+
+LOD_FIELDS = {'min': 'float32', 'mean': 'float32', 'max': 'float32', 'count': 'uint32'}
+
+
+def bin_centres(bins=LOD_BINS):
+    """
+    Returns the angle (radians) at the centre of each bin.
+    """
+    return (-math.pi + (np.arange(bins) + 0.5) * (2 * math.pi / bins)).astype(np.float32)
+
+
+def available_levels(session_group):
+    """
+    Returns the names of the levels a session has, finest first.
+    """
+    return [name for name in LOD_LEVELS if f'lod/{name}/timestamp' in session_group]
+
+
+def create_lod(session_group, options=None):
+    """
+    Creates empty levels in a session. A session written in SWMR mode needs
+    them before the writer switches to it, see `lidar_storage.start_swmr`.
+
+    :param options: Storage options from `lidar_storage.storage_options`, for the compression filters.
+    """
+    filters = dataset_filters(options) if options else {}
+    for name in LOD_LEVELS:
+        level = session_group.create_group(f'lod/{name}')
+        level.attrs['period'] = LOD_LEVELS[name]
+        level.attrs['bins'] = LOD_BINS
+        level.create_dataset(
+            'timestamp', shape=(0,), maxshape=(None,), dtype='float64', chunks=(LOD_CHUNK_ROWS,), **filters
+        )
+        for field, dtype in LOD_FIELDS.items():
+            level.create_dataset(
+                field, shape=(0, LOD_BINS), maxshape=(None, LOD_BINS), dtype=dtype,
+                chunks=(LOD_CHUNK_ROWS, LOD_BINS), **filters
+            )
+
+
+class _LevelBuilder:
+    """
+    Reduces points into the rows of one level. The row of the latest period
+    stays pending until a later period starts or `finish` is called.
+    """
+
+    def __init__(self, level, period):
+        self.level = level
+        self.period = period
+        self.pending = None
+
+    def add(self, timestamps, sectors, distances):
+        periods, row = np.unique(np.floor(timestamps / self.period).astype(np.int64), return_inverse=True)
+        cells = row * LOD_BINS + sectors
+        size = len(periods) * LOD_BINS
+
+        count = np.bincount(cells, minlength=size).reshape(-1, LOD_BINS)
+        total = np.bincount(cells, weights=distances, minlength=size).reshape(-1, LOD_BINS)
+        low = np.full(size, np.inf, dtype=np.float32)
+        np.minimum.at(low, cells, distances)
+        high = np.full(size, -np.inf, dtype=np.float32)
+        np.maximum.at(high, cells, distances)
+        low, high = low.reshape(-1, LOD_BINS), high.reshape(-1, LOD_BINS)
+
+        if self.pending is not None:
+            pending_period, pending_count, pending_total, pending_low, pending_high = self.pending
+            if pending_period == periods[0]:
+                count[0] += pending_count
+                total[0] += pending_total
+                np.minimum(low[0], pending_low, out=low[0])
+                np.maximum(high[0], pending_high, out=high[0])
+            else:
+                self._append(*(np.asarray([value]) for value in self.pending))
+
+        self._append(periods[:-1], count[:-1], total[:-1], low[:-1], high[:-1])
+        self.pending = (periods[-1], count[-1], total[-1], low[-1], high[-1])
+
+    def finish(self):
+        if self.pending is not None:
+            self._append(*(np.asarray([value]) for value in self.pending))
+            self.pending = None
+
+    def _append(self, periods, count, total, low, high):
+        if not len(periods):
+            return
+        empty = count == 0
+        with np.errstate(invalid='ignore', divide='ignore'):
+            mean = (total / count).astype(np.float32)
+        mean[empty] = np.nan
+        low = np.where(empty, np.nan, low)
+        high = np.where(empty, np.nan, high)
+
+        # timestamps last, a reader never sees a row before its values
+        for name, values in (('min', low), ('mean', mean), ('max', high), ('count', count)):
+            dataset = self.level[name]
+            start = dataset.shape[0]
+            dataset.resize(start + len(periods), axis=0)
+            dataset[start:] = values
+        dataset = self.level['timestamp']
+        start = dataset.shape[0]
+        dataset.resize(start + len(periods), axis=0)
+        dataset[start:] = periods * self.period
+
+
+class LodBuilder:
+    """
+    Extends every level of a session with points given in time order.
+
+    Points of the latest period of each level are held back until it is
+    over, `finish` writes them at the end of the session.
+    """
+
+    def __init__(self, session_group):
+        self.levels = [
+            _LevelBuilder(session_group[f'lod/{name}'], period) for name, period in LOD_LEVELS.items()
+        ]
+
+    def add(self, timestamps, angles, distances):
+        """
+        :param timestamps: Epoch time of every point.
+        :param angles: Radians.
+        :param distances: Points with a distance of 0 (no return) are left out.
+        """
+        distances = np.asarray(distances, dtype=np.float32)
+        valid = distances > 0
+        if not valid.any():
+            return
+        timestamps = np.asarray(timestamps, dtype=np.float64)[valid]
+        angles = np.asarray(angles, dtype=np.float64)[valid]
+        sectors = np.floor((angles + math.pi) * (LOD_BINS / (2 * math.pi))).astype(np.intp) % LOD_BINS
+        for level in self.levels:
+            level.add(timestamps, sectors, distances[valid])
+
+    def finish(self):
+        for level in self.levels:
+            level.finish()
+
+
+def build_lod(session_group, chunk_size=LOD_BUILD_CHUNK):
+    """
+    (Re)builds every level of a recorded session from its points.
+
+    :return: Rows written per level.
+    """
+    if 'lod' in session_group:
+        del session_group['lod']
+    # same filters as the session's own datasets
+    stored = session_group.attrs.get('storage')
+    create_lod(session_group, storage_options(json.loads(stored)) if stored else None)
+
+    builder = LodBuilder(session_group)
+    for timestamps, angles, distances, _ in SessionReader(session_group).iter_blocks(chunk_size):
+        builder.add(timestamps, angles, distances)
+    builder.finish()
+    return {name: session_group[f'lod/{name}/timestamp'].shape[0] for name in LOD_LEVELS}
+
@@ -0,0 +1,243 @@
+"""
+Process-wide metrics, exposed in the Prometheus text format by `/metrics`.
+
+    SCANS = counter('lidar_scans_read_total', 'Scans read from the device')
+    SCANS.inc()
+
+    with READ_TIME.time():
+        ...
+
+Counters, gauges and histograms live in one registry per process and are
+updated under a lock that is held for a couple of additions, so they can be
+used in the capture loop. Gauges can also be computed when scraped with
+`gauge(..., function=...)`, which costs nothing until then.
+"""
+import bisect
+import math
+import threading
+import time
+
+import numpy as np
+
+# seconds, from a fraction of a millisecond to a few seconds
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+_registry = {}
+_registry_lock = threading.Lock()
+
+
+def _format_value(value):
+    if math.isinf(value):
+        return '+Inf' if value > 0 else '-Inf'
+    if math.isnan(value):
+        return 'NaN'
+    return repr(float(value)) if not float(value).is_integer() else str(int(value))
+
+
+def _format_labels(labels):
+    if not labels:
+        return ''
+    escaped = (
+        (name, str(value).replace('\\', r'\\').replace('"', r'\"').replace('\n', r'\n'))
+        for name, value in labels
+    )
+    return '{' + ','.join(f'{name}="{value}"' for name, value in escaped) + '}'
+
+
+class _Metric:
+    kind = None
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.lock = threading.Lock()
+        self._children = {}
+
+    def labels(self, *values):
+        """
+        Returns the child metric for one combination of label values.
+        """
+        if len(values) != len(self.labelnames):
+            raise ValueError(f"{self.name} takes labels {', '.join(self.labelnames)}")
+        values = tuple(str(value) for value in values)
+        with self.lock:
+            child = self._children.get(values)
+            if child is None:
+                child = self._children[values] = self._child()
+            return child
+
+    def _child(self):
+        return type(self)(self.name, self.documentation)
+
+    def _series(self):
+        if not self.labelnames:
+            return [((), self)]
+        with self.lock:
+            return [(tuple(zip(self.labelnames, values)), child) for values, child in sorted(self._children.items())]
+
+    def expose(self):
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} {self.kind}']
+        for labels, metric in self._series():
+            lines.extend(metric._samples(labels))
+        return lines
+
+
+class Counter(_Metric):
+    kind = 'counter'
+
+    def __init__(self, name, documentation, labelnames=()):
+        super().__init__(name, documentation, labelnames)
+        self.value = 0.0
+
+    def inc(self, amount=1):
+        with self.lock:
+            self.value += amount
+
+    def _samples(self, labels):
+        return [f'{self.name}{_format_labels(labels)} {_format_value(self.value)}']
+
+
+class Gauge(_Metric):
+    kind = 'gauge'
+
+    def __init__(self, name, documentation, labelnames=(), function=None):
+        super().__init__(name, documentation, labelnames)
+        self.value = 0.0
+        self.function = function
+
+    def set(self, value):
+        self.value = value
+
+    def inc(self, amount=1):
+        with self.lock:
+            self.value += amount
+
+    def dec(self, amount=1):
+        self.inc(-amount)
+
+    def _samples(self, labels):
+        value = self.function() if self.function else self.value
+        return [f'{self.name}{_format_labels(labels)} {_format_value(value if value is not None else math.nan)}']
+
+
+class Histogram(_Metric):
+    kind = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets))
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0.0
+
+    def _child(self):
+        return Histogram(self.name, self.documentation, buckets=self.buckets)
+
+    def observe(self, value):
+        index = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            self.counts[index] += 1
+            self.sum += value
+
+    def observe_many(self, values):
+        """
+        Observes an array of values at once, e.g. the latency of every scan of a batch.
+        """
+        values = np.asarray(values, dtype=np.float64)
+        if not values.size:
+            return
+        counts = np.bincount(np.searchsorted(self.buckets, values, side='left'), minlength=len(self.counts))
+        total = float(values.sum())
+        with self.lock:
+            for index, count in enumerate(counts.tolist()):
+                self.counts[index] += count
+            self.sum += total
+
+    def time(self):
+        """
+        Context manager observing the seconds spent in its block.
+        """
+        return _Timer(self)
+
+    def _samples(self, labels):
+        with self.lock:
+            counts, total = list(self.counts), self.sum
+        lines = []
+        cumulative = 0
+        for bound, count in zip(self.buckets + (math.inf,), counts):
+            cumulative += count
+            lines.append(f'{self.name}_bucket{_format_labels(labels + (("le", _format_value(bound)),))} {cumulative}')
+        lines.append(f'{self.name}_sum{_format_labels(labels)} {_format_value(total)}')
+        lines.append(f'{self.name}_count{_format_labels(labels)} {cumulative}')
+        return lines
+
+
+class _Timer:
+    __slots__ = ('histogram', 'start')
+
+    def __init__(self, histogram):
+        self.histogram = histogram
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.histogram.observe(time.perf_counter() - self.start)
+
+
+def _register(metric_class, name, *args, **kwargs):
+    with _registry_lock:
+        metric = _registry.get(name)
+        if metric is None:
+            metric = _registry[name] = metric_class(name, *args, **kwargs)
+        elif not isinstance(metric, metric_class):
+            raise ValueError(f"Metric {name} already registered as a {metric.kind}")
+        return metric
+
+
+def counter(name, documentation, labelnames=()):
+    """
+    Returns the counter `name`, registering it on first use.
+    """
+    return _register(Counter, name, documentation, labelnames)
+
+
+def gauge(name, documentation, labelnames=(), function=None):
+    """
+    Returns the gauge `name`, registering it on first use.
+
+    :param function: Called at every scrape for the value, instead of `set`.
+    """
+    metric = _register(Gauge, name, documentation, labelnames)
+    if function is not None:
+        metric.function = function
+    return metric
+
+
+def histogram(name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+    """
+    Returns the histogram `name`, registering it on first use.
+    """
+    return _register(Histogram, name, documentation, labelnames, buckets)
+
+
+def expose(names=None, exclude=()):
+    """
+    Returns registered metrics in the Prometheus text format.
+
+    :param names: Only these metrics, every registered one when `None`.
+    :param exclude: Metrics left out, e.g. ones another process reports.
+    """
+    with _registry_lock:
+        metrics = sorted(
+            (metric for metric in _registry.values()
+             if (names is None or metric.name in names) and metric.name not in exclude),
+            key=lambda metric: metric.name,
+        )
+    lines = []
+    for metric in metrics:
+        lines.extend(metric.expose())
+    return '\n'.join(lines) + '\n'
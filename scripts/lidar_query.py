@@ -0,0 +1,254 @@
+"""
+Reads a time window of one session without touching the rest of the file.
+
+`read_window` locates the window with `SessionReader.time_range` and reads
+only its slices, `encode_window` packs the result into the compact binary
+payload served by the readings API.
+
+Long windows can be read from the session's level-of-detail overviews
+instead of its points (see `lidar_lod`), `auto` picks the finest resolution
+that fits the point budget.
+"""
+import bisect
+import math
+
+import numpy as np
+
+from lidar_lod import LOD_LEVELS, LOD_FIELDS, available_levels, bin_centres
+from lidar_storage import SessionReader
+
+# points returned by one query at most, longer windows are cut and report
+# where the next query should start
+MAX_QUERY_POINTS = 1_000_000
+
+# decimals kept in JSON responses, same precision as the CSV export
+JSON_DECIMALS = 6
+
+# dtypes of the binary payload columns, little-endian
+BINARY_COLUMNS = (('timestamp', '<f8'), ('angle', '<f4'), ('distance', '<f4'), ('intensity', '<f4'))
+
+# same for overview windows: one value per non-empty (period, angular bin) cell
+# with the bin's centre angle and the number of points it summarizes
+LOD_COLUMNS = (
+    ('timestamp', '<f8'), ('angle', '<f4'), ('min', '<f4'), ('mean', '<f4'), ('max', '<f4'), ('points', '<u4'),
+)
+
+RAW_RESOLUTION = 'raw'
+AUTO_RESOLUTION = 'auto'
+RESOLUTIONS = (RAW_RESOLUTION, AUTO_RESOLUTION) + tuple(LOD_LEVELS)
+
+# overview rows read at once while filling a window
+LOD_READ_ROWS = 4096
+
+
+def session_names(h5_file):
+    """
+    Returns every session of an open HDF5 file as `day/session` names, oldest first.
+    """
+    return [
+        f'{day_name}/{session_name}'
+        for day_name in sorted(h5_file.keys())
+        for session_name in sorted(h5_file[day_name].keys())
+    ]
+
+
+def find_session(h5_file, session=None):
+    """
+    Returns `(name, group)` of a session.
+
+    :param session: `day/session` name, e.g. `2024_10_08/session_001`, a bare
+        session name when the file holds a single day, or `None`/`latest` for
+        the most recent session.
+    :raises KeyError: When there is no such session.
+    """
+    names = session_names(h5_file)
+    if session in (None, '', 'latest'):
+        if not names:
+            raise KeyError('File has no sessions')
+        name = names[-1]
+    elif session in names:
+        name = session
+    else:
+        matches = [name for name in names if name.split('/')[1] == session]
+        if len(matches) != 1:
+            raise KeyError(f"Session '{session}' not found" if not matches else
+                           f"Session '{session}' exists on several days, use day/session")
+        name = matches[0]
+    return name, h5_file[name]
+
+
+def read_window(session_group, start=None, end=None, last=None, limit=MAX_QUERY_POINTS, resolution=RAW_RESOLUTION):
+    """
+    Reads the points of a session recorded in `[start, end)`.
+
+    :param start: Epoch seconds, `None` for the start of the session.
+    :param end: Epoch seconds, `None` for the end of the session.
+    :param last: Seconds before the session's last timestamp, replaces `start`.
+    :param limit: Maximum number of points returned. A longer window is cut at
+        a timestamp boundary and `next_start` tells where to resume.
+    :param resolution: `raw` for the points, a level of `LOD_LEVELS` for its
+        overview (see `read_overview`) or `auto` to pick one for `limit`.
+    :return: Dict with the `timestamp`, `angle`, `distance` and `intensity`
+        arrays (`intensity` is `None` when not recorded), `count`, `truncated`,
+        `next_start`, and the `resolution` read.
+    :raises KeyError: When the session has no overview of the requested level.
+    """
+    reader = SessionReader(session_group)
+    if last is not None:
+        _, last_time = reader.time_bounds()
+        if last_time is not None:
+            start = last_time - last
+
+    if resolution == AUTO_RESOLUTION:
+        resolution = choose_resolution(session_group, reader, start, end, limit)
+    if resolution != RAW_RESOLUTION:
+        return dict(read_overview(session_group, resolution, start, end, limit), layout=reader.layout)
+
+    first, stop = reader.time_range(start, end)
+    truncated = stop - first > limit
+    next_start = None
+    if truncated:
+        # resume at the first timestamp left out; points sharing it with the
+        # last ones kept are left out too, so no point is ever sent twice
+        next_start = float(reader.point_timestamps(first + limit, first + limit + 1)[0])
+        cut, _ = reader.time_range(next_start, None)
+        if cut <= first:
+            # a single scan holds more than `limit` points, send all of it
+            cut, _ = reader.time_range(float(np.nextafter(next_start, np.inf)), None)
+            cut = min(cut, stop)
+            truncated = cut < stop
+            next_start = float(reader.point_timestamps(cut, cut + 1)[0]) if truncated else None
+        stop = cut
+
+    timestamps, angles, distances, intensities = reader.read_points(first, stop)
+
+    return {
+        'layout': reader.layout,
+        'timestamp': timestamps,
+        'angle': angles,
+        'distance': distances,
+        'intensity': intensities,
+        'count': len(timestamps),
+        'truncated': truncated,
+        'next_start': next_start,
+        'resolution': RAW_RESOLUTION,
+    }
+
+
+def _overview_rows(level, start, end):
+    """
+    Returns the `(first, stop)` rows of an overview level covering `[start, end)`.
+    """
+    timestamps = level['timestamp']
+    rows = min([timestamps.shape[0]] + [level[field].shape[0] for field in LOD_FIELDS])
+    period = level.attrs['period']
+    # the row of the period `start` falls in covers it too
+    first = 0 if start is None else bisect.bisect_left(timestamps, math.floor(start / period) * period, 0, rows)
+    stop = rows if end is None else bisect.bisect_left(timestamps, end, first, rows)
+    return first, stop
+
+
+def choose_resolution(session_group, reader, start, end, limit):
+    """
+    Returns `raw` when the points of `[start, end)` fit in `limit`, else the
+    finest overview level whose cells surely fit, else the coarsest one.
+    Sessions without overviews are always read raw.
+    """
+    first, stop = reader.time_range(start, end)
+    if stop - first <= limit:
+        return RAW_RESOLUTION
+
+    levels = available_levels(session_group)
+    for name in levels:
+        level = session_group[f'lod/{name}']
+        first, stop = _overview_rows(level, start, end)
+        if (stop - first) * level.attrs['bins'] <= limit:
+            return name
+    return levels[-1] if levels else RAW_RESOLUTION
+
+
+def read_overview(session_group, name, start=None, end=None, limit=MAX_QUERY_POINTS):
+    """
+    Reads the non-empty cells of overview level `name` in `[start, end)`.
+
+    Rows are returned whole, a window with more than `limit` cells is cut
+    before the first row that does not fit (but always holds one row) and
+    `next_start` is where that row starts.
+
+    :return: Dict with the `timestamp` (period start), `angle` (bin centre),
+        `min`, `mean`, `max` and `points` arrays, one value per cell, `count`,
+        `truncated`, `next_start` and `resolution`.
+    :raises KeyError: When the session has no such level.
+    """
+    if name not in available_levels(session_group):
+        raise KeyError(f"Session has no '{name}' overview, build it with manage.py build_lod")
+    level = session_group[f'lod/{name}']
+    first, stop = _overview_rows(level, start, end)
+    centres = bin_centres(level.attrs['bins'])
+
+    pieces = []
+    cells = 0
+    next_start = None
+    row = first
+    while row < stop:
+        block_stop = min(row + LOD_READ_ROWS, stop)
+        counts = level['count'][row:block_stop]
+        filled = counts > 0
+        fits = np.searchsorted(np.cumsum(filled.sum(axis=1)) + cells, limit, side='right')
+        keep = max(fits, 1) if not pieces else fits
+
+        filled, counts = filled[:keep], counts[:keep]
+        rows, bins = np.nonzero(filled)
+        pieces.append({
+            'timestamp': level['timestamp'][row:row + keep][rows],
+            'angle': centres[bins],
+            'min': level['min'][row:row + keep][filled],
+            'mean': level['mean'][row:row + keep][filled],
+            'max': level['max'][row:row + keep][filled],
+            'points': counts[filled],
+        })
+        cells += len(rows)
+        row += keep
+        if row < block_stop:
+            next_start = float(level['timestamp'][row])
+            break
+
+    columns = {
+        column: np.concatenate([piece[column] for piece in pieces]) if pieces else np.empty(0, dtype=dtype)
+        for column, dtype in LOD_COLUMNS
+    }
+    return dict(
+        columns, count=cells, truncated=next_start is not None, next_start=next_start, resolution=name
+    )
+
+
+def window_columns(window):
+    """
+    Returns the `(name, dtype)` pairs of the columns present in a `read_window` result.
+    """
+    columns = BINARY_COLUMNS if window['resolution'] == RAW_RESOLUTION else LOD_COLUMNS
+    return [(name, dtype) for name, dtype in columns if window[name] is not None]
+
+
+def encode_window(window):
+    """
+    Packs a `read_window` result as its columns back to back, see `BINARY_COLUMNS`.
+
+    Nothing but the raw values is sent: a client splits the body with the
+    point count and `window_columns`, 20 bytes per point with intensity.
+    """
+    return b''.join(
+        np.ascontiguousarray(window[name], dtype=dtype).tobytes()
+        for name, dtype in window_columns(window)
+    )
+
+
+def window_to_json(window):
+    """
+    Returns the columns of a `read_window` result as lists, values rounded to `JSON_DECIMALS`.
+    """
+    return {
+        name: np.asarray(window[name]).tolist() if dtype[1] == 'u' else
+        np.round(np.asarray(window[name], dtype=np.float64), JSON_DECIMALS).tolist()
+        for name, dtype in window_columns(window)
+    }
@@ -0,0 +1,237 @@
+"""
+Rewriting lidar HDF5 files into compact, compressed sessions.
+
+Files recorded without compression, or in the older `readings` layout with
+one timestamp per point, take several times the space they need, and their
+datasets, grown one batch at a time, are spread in small pieces over the
+whole file. `repack_file` writes a copy where every session has the
+scan-indexed layout with the given storage options, each dataset allocated
+once at its final size and written front to back, and checks that the copy
+holds the same points. Sessions smaller than `merge_below` points can be
+merged into the session before them.
+
+The `repack_lidar` management command runs it over many files in worker
+processes and swaps the copies in.
+"""
+import json
+import os
+
+import h5py
+import numpy as np
+
+from lidar_storage import (
+    SCANS_LAYOUT, SessionReader, create_session, encode_values, open_file, session_layout, storage_options,
+)
+
+# points copied at a time, bounds memory whatever the size of a session
+REPACK_CHUNK = 1 << 20
+
+# storage options of repacked sessions, on top of `lidar_storage.STORAGE_DEFAULTS`
+REPACK_OPTIONS = {'compression': 'gzip', 'compression_level': 4, 'shuffle': True}
+
+# session attributes `create_session` sets for the new layout and options
+_LAYOUT_ATTRS = ('layout', 'storage')
+
+
+def _scan_table(reader, chunk_size=REPACK_CHUNK):
+    """
+    Returns the `(timestamps, counts)` of the scans of a session in either layout.
+
+    In the `readings` layout every point of a scan carries the scan's
+    timestamp, so a scan is a run of points with the same timestamp.
+    """
+    if reader.layout == SCANS_LAYOUT:
+        num_scans = reader.num_scans
+        return reader.scan_timestamps[:num_scans].astype(np.float64), reader.scan_counts[:num_scans].astype(np.uint32)
+
+    timestamps, starts = [], []
+    previous = None
+    for start in range(0, reader.num_points, chunk_size):
+        block = reader.timestamps[start:min(start + chunk_size, reader.num_points)]
+        first = np.empty(len(block), dtype=bool)
+        first[0] = previous is None or block[0] != previous
+        first[1:] = block[1:] != block[:-1]
+        index = np.flatnonzero(first)
+        timestamps.append(block[index])
+        starts.append(index + start)
+        previous = block[-1]
+
+    if not timestamps:
+        return np.empty(0, dtype=np.float64), np.empty(0, dtype=np.uint32)
+    starts = np.concatenate(starts)
+    counts = np.diff(np.append(starts, reader.num_points)).astype(np.uint32)
+    return np.concatenate(timestamps).astype(np.float64), counts
+
+
+def plan_sessions(h5_file, merge_below=0):
+    """
+    Groups the sessions of an open file into the sessions of its repacked copy.
+
+    A session with fewer than `merge_below` points is merged into the session
+    before it in the same day when both were recorded by the same device,
+    both have intensities or neither has, and it starts no earlier than that
+    one ends, so timestamps keep increasing.
+
+    :return: A list of `(day, name, [source session groups])`, in file order.
+    """
+    plan = []
+    for day, day_group in h5_file.items():
+        if not isinstance(day_group, h5py.Group):
+            continue
+        previous = None
+        for name, session_group in day_group.items():
+            try:
+                session_layout(session_group)
+            except ValueError:
+                # not a session, copied as it is
+                previous = None
+                continue
+            reader = SessionReader(session_group)
+            if previous is not None and reader.num_points < merge_below:
+                last = previous[2][-1]
+                last_reader = SessionReader(last)
+                _, previous_end = last_reader.time_bounds()
+                start, _ = reader.time_bounds()
+                if (last.attrs.get('device', '') == session_group.attrs.get('device', '')
+                        and (last_reader.intensities is None) == (reader.intensities is None)
+                        and (start is None or previous_end is None or start >= previous_end)):
+                    previous[2].append(session_group)
+                    continue
+            previous = (day, name, [session_group])
+            plan.append(previous)
+    return plan
+
+
+def _copy_attrs(source, target, skip=()):
+    for name, value in source.attrs.items():
+        if name not in skip:
+            target.attrs[name] = value
+
+
+def _write_session(target, sources, chunk_size):
+    """
+    Writes the points of `sources` back to back into the empty session `target`.
+
+    :return: The number of scans of each of `sources`.
+    """
+    readers = [SessionReader(source) for source in sources]
+    tables = [_scan_table(reader, chunk_size) for reader in readers]
+    timestamps = np.concatenate([table[0] for table in tables])
+    counts = np.concatenate([table[1] for table in tables])
+    num_points = sum(reader.num_points for reader in readers)
+
+    # merged sessions all have intensities or none has, see `plan_sessions`
+    if readers[0].intensities is None:
+        del target['points/intensity']
+
+    # allocated once at their final size, then filled front to back
+    for dataset in target['points'].values():
+        dataset.resize((num_points,))
+    offset = 0
+    for reader in readers:
+        for start in range(0, reader.num_points, chunk_size):
+            _, angles, distances, intensities = reader.read_points(start, start + chunk_size)
+            stop = offset + start + len(angles)
+            target['points/angle'][offset + start:stop] = encode_values(target['points/angle'], angles)
+            target['points/distance'][offset + start:stop] = encode_values(target['points/distance'], distances)
+            if 'intensity' in target['points']:
+                target['points/intensity'][offset + start:stop] = intensities
+        offset += reader.num_points
+
+    offsets = np.concatenate(([0], np.cumsum(counts[:-1], dtype=np.int64)))
+    for name, values in (('timestamp', timestamps), ('offset', offsets), ('count', counts)):
+        target[f'scans/{name}'].resize((len(values),))
+        target[f'scans/{name}'][:] = values
+    return [len(table[0]) for table in tables]
+
+
+def verify_copy(target_path, plan):
+    """
+    Checks that every session of the copy has the points, scans and time span
+    of the sessions it was made from.
+
+    :param plan: `[(day, name, [(source session, points, scans, start, end)])]` of the copy.
+    :raises ValueError: On the first difference.
+    """
+    with open_file(target_path) as f:
+        for day, name, sources in plan:
+            reader = SessionReader(f[f'{day}/{name}'])
+            points = sum(source[1] for source in sources)
+            scans = sum(source[2] for source in sources)
+            start = next((source[3] for source in sources if source[3] is not None), None)
+            end = next((source[4] for source in reversed(sources) if source[4] is not None), None)
+            if (reader.num_points, reader.num_scans) != (points, scans):
+                raise ValueError(
+                    f'{day}/{name}: {reader.num_points} points in {reader.num_scans} scans '
+                    f'written, {points} in {scans} expected'
+                )
+            if reader.time_bounds() != (start, end):
+                raise ValueError(f'{day}/{name}: time span {reader.time_bounds()} written, {(start, end)} expected')
+
+
+def repack_file(source_path, target_path, options=None, merge_below=0, chunk_size=REPACK_CHUNK):
+    """
+    Writes a repacked copy of the lidar HDF5 file `source_path` to `target_path`
+    and verifies it, see the module documentation. Groups and datasets that
+    are not sessions, and the overviews of sessions that are not merged, are
+    copied as they are; the attributes of the file, days and sessions are kept.
+
+    :param options: Storage options of the copied sessions, `REPACK_OPTIONS` when `None`.
+    :param merge_below: Merge sessions with fewer points into the one before them, see `plan_sessions`.
+    :return: Dict with `sessions` in the source and in the copy, `points`,
+        `bytes_before`, `bytes_after` and `lod_dropped`, the merged sessions whose overviews are gone.
+    :raises ValueError: When the copy does not match the source, `target_path` is removed then.
+    """
+    options = storage_options(**(REPACK_OPTIONS if options is None else options))
+    verify_plan = []
+    lod_dropped = []
+    sessions_in = 0
+
+    try:
+        with open_file(source_path) as source, open_file(target_path, 'w') as target:
+            _copy_attrs(source, target)
+            plan = plan_sessions(source, merge_below)
+            planned = {group.name for _, _, groups in plan for group in groups}
+
+            for day, day_group in source.items():
+                if not isinstance(day_group, h5py.Group):
+                    source.copy(day_group, target, day)
+                    continue
+                target_day = target.require_group(day)
+                _copy_attrs(day_group, target_day)
+                for name, item in day_group.items():
+                    if item.name not in planned:
+                        source.copy(item, target_day, name)
+
+            for day, name, groups in plan:
+                sessions_in += len(groups)
+                session = create_session(target[day], name, options)
+                _copy_attrs(groups[0], session, _LAYOUT_ATTRS)
+                scans = _write_session(session, groups, chunk_size)
+                if len(groups) > 1:
+                    session.attrs['merged_sessions'] = json.dumps([group.name.rsplit('/', 1)[-1] for group in groups[1:]])
+                    if any('lod' in group for group in groups):
+                        lod_dropped.append(f'{day}/{name}')
+                elif 'lod' in groups[0]:
+                    source.copy(groups[0]['lod'], session, 'lod')
+
+                readers = [SessionReader(group) for group in groups]
+                verify_plan.append((day, name, [
+                    (group.name, reader.num_points, num_scans, *reader.time_bounds())
+                    for group, reader, num_scans in zip(groups, readers, scans)
+                ]))
+
+        verify_copy(target_path, verify_plan)
+    except BaseException:
+        if os.path.exists(target_path):
+            os.unlink(target_path)
+        raise
+
+    return {
+        'sessions': sessions_in,
+        'sessions_after': len(verify_plan),
+        'points': sum(source[1] for _, _, sources in verify_plan for source in sources),
+        'bytes_before': os.path.getsize(source_path),
+        'bytes_after': os.path.getsize(target_path),
+        'lod_dropped': lod_dropped,
+    }
@@ -0,0 +1,151 @@
+"""
+Simulated YDLidar, a stand-in for the parts of the `ydlidar` SDK bindings
+used by `lidar_control`, for running and measuring the capture without a
+sensor attached.
+
+Select it with `LIDAR_DEVICE=simulated`, or with `"driver": "simulated"`
+for one device of `LIDAR_DEVICES` (see `lidar_control.device_configs`). The
+scan frequency (Hz) and the sample rate (thousands of points per second) are
+set like on the real device through `setlidaropt`, so `scan_frequency` and
+`sample_rate` of the device control the scan rate and points per scan.
+
+Scans see a rectangular room with a few objects moving through it, with
+range noise and dropped returns (range 0). `doProcessSimple` blocks until
+the next scan is due like the SDK does. A caller that falls behind gets the
+current scan, the ones it was too slow for are lost.
+"""
+import math
+import os
+import time
+
+import numpy as np
+
+LidarPropSerialPort = 'serial_port'
+LidarPropSerialBaudrate = 'serial_baudrate'
+LidarPropLidarType = 'lidar_type'
+LidarPropDeviceType = 'device_type'
+LidarPropScanFrequency = 'scan_frequency'
+LidarPropSampleRate = 'sample_rate'
+LidarPropSingleChannel = 'single_channel'
+
+TYPE_TOF = 0
+TYPE_TRIANGLE = 1
+TYPE_TOF_NET = 2
+YDLIDAR_TYPE_SERIAL = 0
+YDLIDAR_TYPE_TCP = 1
+
+# half width and half depth of the room in metres, and where the sensor stands in it
+ROOM_SIZE = (4.0, 2.5)
+SENSOR_POSITION = (0.7, -0.4)
+
+# moving objects as (radius, orbit radius, orbit period in seconds)
+OBJECTS = ((0.3, 1.5, 12.0), (0.2, 2.2, 20.0), (0.5, 1.0, 45.0))
+
+# standard deviation of the range noise in metres, and share of points without a return
+RANGE_NOISE = 0.01
+DROPOUT = 0.02
+
+# seed of the noise, the same seed gives the same scans
+SEED = int(os.environ.get('LIDAR_SIMULATOR_SEED', 0))
+
+
+class LaserPoint:
+    __slots__ = ('angle', 'range', 'intensity')
+
+    def __init__(self, angle, range, intensity):
+        self.angle = angle
+        self.range = range
+        self.intensity = intensity
+
+
+class LaserScan:
+    def __init__(self):
+        self.points = []
+        self.stamp = 0
+        self.scanFreq = 0.0
+
+
+def simulate_ranges(angles, t):
+    """
+    Returns the exact distance seen along each angle (radians) at time `t` (seconds).
+    """
+    dx, dy = np.cos(angles), np.sin(angles)
+    px, py = SENSOR_POSITION
+    half_width, half_depth = ROOM_SIZE
+
+    # nearest wall hit by each ray
+    with np.errstate(divide='ignore'):
+        wall_x = np.where(dx > 0, half_width - px, -half_width - px) / dx
+        wall_y = np.where(dy > 0, half_depth - py, -half_depth - py) / dy
+    ranges = np.minimum(np.abs(wall_x), np.abs(wall_y))
+
+    for radius, orbit, period in OBJECTS:
+        phase = 2 * math.pi * t / period
+        cx, cy = orbit * math.cos(phase) - px, orbit * math.sin(phase) * 0.6 - py
+        # ray-circle intersection, nearest of the two roots in front of the sensor
+        along = dx * cx + dy * cy
+        miss = along * along - (cx * cx + cy * cy - radius * radius)
+        with np.errstate(invalid='ignore'):
+            hit = along - np.sqrt(miss)
+        ranges = np.where((miss >= 0) & (hit > 0) & (hit < ranges), hit, ranges)
+    return ranges
+
+
+class CYdLidar:
+    def __init__(self):
+        self.options = {LidarPropScanFrequency: 10.0, LidarPropSampleRate: 5}
+        self.rng = np.random.default_rng(SEED)
+        self.running = False
+        self.next_scan = None
+        self.started = None
+
+    def setlidaropt(self, option, value):
+        self.options[option] = value
+        return True
+
+    def initialize(self):
+        return self.options[LidarPropScanFrequency] > 0 and self.options[LidarPropSampleRate] > 0
+
+    def turnOn(self):
+        self.running = True
+        self.started = time.monotonic()
+        self.next_scan = self.started
+        return True
+
+    def turnOff(self):
+        self.running = False
+        return True
+
+    def disconnecting(self):
+        self.running = False
+
+    def doProcessSimple(self, outscan):
+        if not self.running:
+            return False
+        frequency = float(self.options[LidarPropScanFrequency])
+        period = 1.0 / frequency
+
+        self.next_scan += period
+        delay = self.next_scan - time.monotonic()
+        if delay > 0:
+            time.sleep(delay)
+        elif delay < -period:
+            # the device kept spinning while nobody was reading
+            self.next_scan = time.monotonic()
+
+        count = int(round(float(self.options[LidarPropSampleRate]) * 1000 / frequency))
+        start = -math.pi + self.rng.uniform(0, 2 * math.pi / count)
+        angles = start + np.arange(count) * (2 * math.pi / count)
+        ranges = simulate_ranges(angles, self.next_scan - self.started)
+        ranges = ranges + self.rng.normal(0, RANGE_NOISE, count)
+        ranges[self.rng.random(count) < DROPOUT] = 0.0
+        intensities = np.where(ranges > 0, np.clip(1000 / (1 + ranges * ranges), 0, 1000), 0)
+
+        # one object per point, like the SDK bindings
+        outscan.points = [
+            LaserPoint(angle, distance, intensity)
+            for angle, distance, intensity in zip(angles.tolist(), ranges.tolist(), intensities.tolist())
+        ]
+        outscan.stamp = time.time_ns()
+        outscan.scanFreq = frequency
+        return True
@@ -0,0 +1,423 @@
+"""
+On-disk layout of capture sessions.
+
+Sessions written by `lidar_control` store every scan once in a scan table and
+the points of all scans back to back:
+
+    session_001
+    |-- scans/timestamp     float64, epoch time of the scan
+    |-- scans/offset        int64, index of the scan's first point
+    |-- scans/count         uint32, number of points in the scan
+    |-- points/angle        float32
+    |-- points/distance     float32
+    |-- points/intensity    float32
+
+Older files use the `readings` layout, one timestamp per point:
+
+    session_001
+    |-- readings/timestamp  float64
+    |-- readings/angle      float32
+    |-- readings/distance   float32
+    |-- readings/intensity  float32 (only in some files)
+
+`SessionReader` reads both layouts the same way. Timestamps never decrease
+within a session, which is what lets it find a time window by binary search.
+Sessions may also hold `lod/` overviews for plotting, see `lidar_lod`.
+
+How the scan-indexed datasets are chunked, compressed and whether angle and
+distance are stored as fixed-point integers is chosen per file or per capture
+through `storage_options`.
+
+A capture writes in single-writer/multiple-reader (SWMR) mode: once the
+session exists the writer only grows datasets and flushes after every batch,
+and readers opened with `open_file` see a consistent file up to the last
+flush while it is being written, from this or any other process.
+"""
+import bisect
+import json
+from datetime import datetime
+
+import h5py
+import numpy as np
+
+SCANS_LAYOUT = 'scans'
+READINGS_LAYOUT = 'readings'
+
+SCAN_FIELDS = {'timestamp': 'float64', 'offset': 'int64', 'count': 'uint32'}
+POINT_FIELDS = {'angle': 'float32', 'distance': 'float32', 'intensity': 'float32'}
+
+# fixed-point encodings used when `quantize` is on: value = stored * scale
+QUANTIZED_FIELDS = {
+    'angle': ('int16', 1e-4),      # 0.1 mrad steps, covers +-3.27 rad
+    'distance': ('uint16', 1e-3),  # millimetres, up to 65.5 m
+}
+
+COMPRESSIONS = (None, 'gzip', 'lzf')
+SCAN_CHUNK_ROWS = 4096
+
+STORAGE_DEFAULTS = {
+    'chunk_points': 65536,      # points per chunk of the points/ datasets
+    'compression': None,        # None, 'gzip' or 'lzf'
+    'compression_level': None,  # gzip only, 0-9
+    'shuffle': False,           # byte shuffle filter, helps compression
+    'quantize': False,          # fixed-point angle/distance, see QUANTIZED_FIELDS
+    'lod': False,               # min/mean/max overviews kept during capture, see lidar_lod
+}
+
+# root attribute holding a file's default storage options
+STORAGE_ATTR = 'storage'
+
+# file format used for writing, SWMR needs the one introduced in HDF5 1.10
+LIBVER = 'latest'
+
+
+def open_file(path, mode='r'):
+    """
+    Opens a lidar HDF5 file.
+
+    Readers (`mode='r'`) open in SWMR mode, so they work while a capture is
+    writing the file. Writers use the latest file format, which new files
+    need for a capture to switch to SWMR later.
+    """
+    if mode == 'r':
+        return h5py.File(path, 'r', swmr=True)
+    return h5py.File(path, mode, libver=LIBVER)
+
+
+def start_swmr(h5_file):
+    """
+    Switches a file opened with `open_file(path, 'a')` to SWMR writing.
+
+    No group, dataset or attribute can be created afterwards, only datasets grown.
+
+    :return: False for files created in the old format, which are then
+        written without SWMR and read by other processes at their own risk.
+    """
+    try:
+        h5_file.swmr_mode = True
+        return True
+    except (RuntimeError, ValueError) as e:
+        print(f"SWMR not available for {h5_file.filename}: {e}")
+        return False
+
+
+def session_layout(session_group):
+    """
+    Returns `SCANS_LAYOUT` or `READINGS_LAYOUT` for a session group.
+    """
+    if 'scans' in session_group:
+        return SCANS_LAYOUT
+    if 'readings' in session_group:
+        return READINGS_LAYOUT
+    raise ValueError(f"Session '{session_group.name}' has neither scans nor readings")
+
+
+def storage_options(defaults=None, **options):
+    """
+    Validates storage options and fills in the missing ones.
+
+    :param defaults: Options to start from instead of `STORAGE_DEFAULTS`, e.g. a file's stored defaults.
+    :param options: Overrides, `None` values are ignored.
+    :return: A complete options dict.
+    :raises ValueError: For unknown options or invalid values.
+    """
+    unknown = set(options) - set(STORAGE_DEFAULTS)
+    if unknown:
+        raise ValueError(f"Unknown storage options: {', '.join(sorted(unknown))}")
+
+    merged = dict(STORAGE_DEFAULTS)
+    merged.update(defaults or {})
+    merged.update({name: value for name, value in options.items() if value is not None})
+
+    if merged['compression'] in ('none', ''):
+        merged['compression'] = None
+    merged['chunk_points'] = int(merged['chunk_points'])
+    if merged['chunk_points'] < 1:
+        raise ValueError("chunk_points must be positive")
+    if merged['compression'] not in COMPRESSIONS:
+        raise ValueError("compression must be one of gzip, lzf or none")
+    if merged['compression_level'] is not None:
+        merged['compression_level'] = int(merged['compression_level'])
+        if merged['compression'] != 'gzip' or not 0 <= merged['compression_level'] <= 9:
+            raise ValueError("compression_level needs gzip compression and must be 0-9")
+    merged['shuffle'] = bool(merged['shuffle'])
+    merged['quantize'] = bool(merged['quantize'])
+    merged['lod'] = bool(merged['lod'])
+    return merged
+
+
+def read_storage_defaults(h5_file):
+    """
+    Returns the storage options saved on a file with `write_storage_defaults`, or `{}`.
+    """
+    return json.loads(h5_file.attrs[STORAGE_ATTR]) if STORAGE_ATTR in h5_file.attrs else {}
+
+
+def write_storage_defaults(h5_file, options):
+    """
+    Saves storage options on a file, used for every session started on it.
+    """
+    h5_file.attrs[STORAGE_ATTR] = json.dumps(storage_options(**options))
+
+
+def dataset_filters(options):
+    """
+    Returns the `create_dataset` compression arguments of storage options.
+    """
+    return {
+        'compression': options['compression'],
+        'compression_opts': options['compression_level'],
+        'shuffle': options['shuffle'],
+    }
+
+
+def create_session(day_group, session_name, options=None):
+    """
+    Creates an empty session with the scan-indexed layout under `day_group`.
+
+    :param options: Storage options from `storage_options`, defaults when `None`.
+    """
+    options = options or storage_options()
+
+    session_group = day_group.create_group(session_name)
+    for name, dtype in SCAN_FIELDS.items():
+        session_group.create_dataset(
+            f'scans/{name}', shape=(0,), maxshape=(None,), dtype=dtype,
+            chunks=(SCAN_CHUNK_ROWS,), **dataset_filters(options)
+        )
+    for name, dtype in POINT_FIELDS.items():
+        scale = None
+        if options['quantize'] and name in QUANTIZED_FIELDS:
+            dtype, scale = QUANTIZED_FIELDS[name]
+        dataset = session_group.create_dataset(
+            f'points/{name}', shape=(0,), maxshape=(None,), dtype=dtype,
+            chunks=(options['chunk_points'],), **dataset_filters(options)
+        )
+        if scale:
+            dataset.attrs['scale'] = scale
+
+    session_group.attrs['layout'] = SCANS_LAYOUT
+    session_group.attrs['storage'] = json.dumps(options)
+    session_group.attrs['start_time'] = datetime.now().isoformat()
+    return session_group
+
+
+def encode_values(dataset, values):
+    """
+    Returns `values` the way `dataset` stores them, the inverse of `read_values`.
+    """
+    scale = dataset.attrs.get('scale')
+    if scale is not None:
+        # fixed-point: round to the nearest step and saturate at the type's range
+        info = np.iinfo(dataset.dtype)
+        values = np.clip(np.rint(np.asarray(values, dtype=np.float64) / scale), info.min, info.max)
+    return values
+
+
+def _append(dataset, values):
+    values = encode_values(dataset, values)
+    start = dataset.shape[0]
+    dataset.resize(start + len(values), axis=0)
+    dataset[start:] = values
+
+
+def read_values(dataset, start, stop):
+    """
+    Reads `dataset[start:stop]`, decoding fixed-point datasets back to float32.
+    """
+    values = dataset[start:stop]
+    scale = dataset.attrs.get('scale')
+    if scale is not None:
+        values = values.astype(np.float32) * np.float32(scale)
+    return values
+
+
+def append_scans(session_group, timestamps, counts, angles, distances, intensities):
+    """
+    Appends a batch of scans to a session with the scan-indexed layout.
+
+    :param timestamps: One epoch time per scan.
+    :param counts: Number of points of each scan.
+    :param angles: Points of all scans back to back, `sum(counts)` values.
+    :param distances: Same as `angles`.
+    :param intensities: Same as `angles`.
+    """
+    counts = np.asarray(counts, dtype=np.uint32)
+    point_offset = session_group['points/angle'].shape[0]
+    offsets = point_offset + np.concatenate(([0], np.cumsum(counts[:-1], dtype=np.int64)))
+
+    # points first, a reader never sees a scan row pointing past the points
+    _append(session_group['points/angle'], angles)
+    _append(session_group['points/distance'], distances)
+    _append(session_group['points/intensity'], intensities)
+
+    _append(session_group['scans/offset'], offsets)
+    _append(session_group['scans/count'], counts)
+    _append(session_group['scans/timestamp'], timestamps)
+
+
+class SessionReader:
+    """
+    Uniform read access to a session group in either layout.
+
+    Points are addressed by their index in the session, `read_points` returns
+    `(timestamps, angles, distances, intensities)` arrays for a range of them
+    (`intensities` is `None` for sessions recorded without it).
+    """
+
+    def __init__(self, session_group):
+        self.group = session_group
+        self.layout = session_layout(session_group)
+
+        if self.layout == SCANS_LAYOUT:
+            self.scan_timestamps = session_group['scans/timestamp']
+            self.scan_offsets = session_group['scans/offset']
+            self.scan_counts = session_group['scans/count']
+            self.angles = session_group['points/angle']
+            self.distances = session_group['points/distance']
+            self.intensities = session_group.get('points/intensity')
+
+            # only scans whose points are all on disk
+            self.num_scans = min(self.scan_timestamps.shape[0], self.scan_offsets.shape[0], self.scan_counts.shape[0])
+            stored_points = min(self.angles.shape[0], self.distances.shape[0])
+            if self.intensities is not None and self.intensities.shape[0] < stored_points:
+                self.intensities = None
+            while self.num_scans:
+                last = self.num_scans - 1
+                if int(self.scan_offsets[last]) + int(self.scan_counts[last]) <= stored_points:
+                    break
+                self.num_scans -= 1
+            self.num_points = (
+                int(self.scan_offsets[self.num_scans - 1]) + int(self.scan_counts[self.num_scans - 1])
+                if self.num_scans else 0
+            )
+        else:
+            self.timestamps = session_group['readings/timestamp']
+            self.angles = session_group['readings/angle']
+            self.distances = session_group['readings/distance']
+            self.intensities = session_group.get('readings/intensity')
+
+            # a session interrupted mid-append can leave the datasets with
+            # different lengths, only the rows present in all of them count
+            point_datasets = [self.timestamps, self.angles, self.distances]
+            if self.intensities is not None and self.intensities.shape[0] >= self.timestamps.shape[0]:
+                point_datasets.append(self.intensities)
+            else:
+                self.intensities = None
+            self.num_points = min(dataset.shape[0] for dataset in point_datasets)
+            self.num_scans = None
+
+    def scan_of_point(self, index):
+        """
+        Returns the index of the scan holding point `index` (scan layout only).
+        """
+        return bisect.bisect_right(self.scan_offsets, index, 0, self.num_scans) - 1
+
+    def time_range(self, start_time=None, end_time=None):
+        """
+        Returns the `(start, stop)` points recorded in `[start_time, end_time)`.
+
+        Timestamps are monotonic within a session, so both ends are found with
+        a binary search over the timestamp dataset (one timestamp per scan in
+        the scan layout), touching a few dozen values whatever the session's size.
+
+        :param start_time: Epoch seconds, `None` for the start of the session.
+        :param end_time: Epoch seconds, `None` for the end of the session.
+        """
+        if self.layout == SCANS_LAYOUT:
+            timestamps, length = self.scan_timestamps, self.num_scans
+        else:
+            timestamps, length = self.timestamps, self.num_points
+
+        first = 0 if start_time is None else bisect.bisect_left(timestamps, start_time, 0, length)
+        last = length if end_time is None else bisect.bisect_left(timestamps, end_time, first, length)
+        if self.layout == READINGS_LAYOUT:
+            return first, last
+        return self._scan_offset(first), self._scan_offset(last)
+
+    def _scan_offset(self, scan):
+        return self.num_points if scan >= self.num_scans else int(self.scan_offsets[scan])
+
+    def time_bounds(self):
+        """
+        Returns the `(first, last)` timestamps of the session, `(None, None)` when empty.
+        """
+        if not self.num_points:
+            return None, None
+        if self.layout == SCANS_LAYOUT:
+            return float(self.scan_timestamps[0]), float(self.scan_timestamps[self.num_scans - 1])
+        return float(self.timestamps[0]), float(self.timestamps[self.num_points - 1])
+
+    def point_timestamps(self, start, stop):
+        """
+        Returns one timestamp per point for points `start` to `stop`.
+        """
+        if self.layout == READINGS_LAYOUT:
+            return self.timestamps[start:stop]
+
+        first_scan = self.scan_of_point(start)
+        last_scan = self.scan_of_point(stop - 1)
+        timestamps = self.scan_timestamps[first_scan:last_scan + 1]
+        offsets = self.scan_offsets[first_scan:last_scan + 1]
+        counts = self.scan_counts[first_scan:last_scan + 1].astype(np.int64)
+
+        # clip the first and last scans to the requested range
+        ends = offsets + counts
+        counts = np.minimum(ends, stop) - np.maximum(offsets, start)
+        return np.repeat(timestamps, counts)
+
+    def read_points(self, start, stop):
+        stop = min(stop, self.num_points)
+        if stop <= start:
+            empty = np.empty(0, dtype=np.float32)
+            return np.empty(0, dtype=np.float64), empty, empty, None if self.intensities is None else empty
+
+        intensities = self.intensities[start:stop] if self.intensities is not None else None
+        angles = read_values(self.angles, start, stop)
+        distances = read_values(self.distances, start, stop)
+        return self.point_timestamps(start, stop), angles, distances, intensities
+
+    def iter_blocks(self, chunk_size, start=0, stop=None):
+        """
+        Yields `read_points` results for consecutive slices of at most `chunk_size` points,
+        from point `start` up to `stop` (the end of the session by default).
+        """
+        stop = self.num_points if stop is None else min(stop, self.num_points)
+        for first in range(start, stop, chunk_size):
+            yield self.read_points(first, min(first + chunk_size, stop))
+
+    def read_scan(self, index):
+        """
+        Returns `(timestamp, angles, distances, intensities)` of scan `index` (scan layout only).
+        """
+        if self.layout != SCANS_LAYOUT:
+            raise ValueError('Per-scan access needs the scan-indexed layout')
+        offset = int(self.scan_offsets[index])
+        stop = offset + int(self.scan_counts[index])
+        intensities = self.intensities[offset:stop] if self.intensities is not None else None
+        angles = read_values(self.angles, offset, stop)
+        distances = read_values(self.distances, offset, stop)
+        return float(self.scan_timestamps[index]), angles, distances, intensities
+
+
+def session_summary(session_group):
+    """
+    Returns what the session index keeps about a session: its layout, first
+    and last timestamps (epoch seconds, `None` when empty), number of scans
+    (`None` in the readings layout), points, bytes its datasets take on disk,
+    and the name of the device that recorded it (empty when unknown).
+    """
+    reader = SessionReader(session_group)
+    start_time, end_time = reader.time_bounds()
+
+    datasets = []
+    session_group.visititems(lambda name, item: datasets.append(item) if isinstance(item, h5py.Dataset) else None)
+    return {
+        'layout': reader.layout,
+        'start_time': start_time,
+        'end_time': end_time,
+        'scans': reader.num_scans,
+        'points': reader.num_points,
+        'bytes': sum(dataset.id.get_storage_size() for dataset in datasets),
+        'device': session_group.attrs.get('device', ''),
+    }